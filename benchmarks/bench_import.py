@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Measure the time needed to import patchutils.
+
+Each run starts a fresh interpreter with -X importtime and reads the
+cumulative time of the patchutils import.  The script fails if the
+median exceeds --max-ms, or if modules that should only be loaded on
+demand were imported.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules which must not be loaded by a plain "import patchutils".
+LAZY_MODULES = [
+    'dateutil', 'datetime', 'json', 'hashlib', 'concurrent.futures',
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHECK = '''
+import sys
+import patchutils
+print(' '.join(m for m in %r if m in sys.modules))
+''' % (LAZY_MODULES,)
+
+def run_once(python):
+    env = dict(os.environ)
+    # Measure loading from the byte-code cache, as in normal use.
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    proc = subprocess.run([python, '-X', 'importtime', '-c', CHECK],
+                          env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    usec = None
+    for line in proc.stderr.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'patchutils':
+            usec = int(fields[1])
+    loaded = proc.stdout.split()
+    return (usec, loaded)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=20,
+                        help='number of interpreter runs (default: 20)')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median import time is higher')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to measure')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    args = parser.parse_args()
+
+    run_once(args.python)      # warm up the byte-code cache
+    times = []
+    loaded = set()
+    for i in range(args.runs):
+        (usec, modules) = run_once(args.python)
+        times.append(usec / 1000.0)
+        loaded.update(modules)
+    times.sort()
+    median = times[len(times) // 2]
+
+    print('import patchutils: median %.2f ms, min %.2f ms, max %.2f ms'
+          % (median, times[0], times[-1]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'benchmark': 'import', 'runs': args.runs,
+                       'median_ms': median, 'min_ms': times[0],
+                       'max_ms': times[-1], 'eager_modules': sorted(loaded)},
+                      f, indent=2)
+
+    status = 0
+    if loaded:
+        print('modules loaded eagerly: %s' % ', '.join(sorted(loaded)))
+        status = 1
+    if args.max_ms is not None and median > args.max_ms:
+        print('median import time exceeds %.2f ms' % args.max_ms)
+        status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
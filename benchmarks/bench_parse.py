@@ -0,0 +1,353 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmark the patchutils parser on synthetic patch corpora.
+
+Every corpus is generated from a fixed random seed, so runs on the same
+machine are comparable.  Each corpus is parsed with each Reader class;
+the best time of several repeats gives lines/s and MB/s, and a separate
+run under tracemalloc gives the peak memory.  Results can be saved as
+JSON and compared with an earlier run.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+WORDS = ('static int struct return if else for while void char unsigned '
+         'long const sizeof break case switch default goto NULL').split()
+
+def text_line(rng):
+    indent = '\t' * rng.randint(0, 3)
+    return indent + ' '.join(rng.choice(WORDS)
+                             for i in range(rng.randint(1, 8))) + '\n'
+
+def uni_hunk(rng, srcline, context, removed, added):
+    """Return the lines of one unified hunk."""
+    before = [text_line(rng) for i in range(context)]
+    after = [text_line(rng) for i in range(context)]
+    old = [text_line(rng) for i in range(removed)]
+    new = [text_line(rng) for i in range(added)]
+    lines = ['@@ -%d,%d +%d,%d @@ %s' % (
+        srcline, 2 * context + removed, srcline, 2 * context + added,
+        text_line(rng))]
+    lines.extend(' ' + l for l in before)
+    lines.extend('-' + l for l in old)
+    lines.extend('+' + l for l in new)
+    lines.extend(' ' + l for l in after)
+    return lines
+
+def git_patch(rng, name, nhunks, context=3, maxchange=6):
+    lines = [
+        'diff --git a/%s b/%s\n' % (name, name),
+        'index %07x..%07x 100644\n' % (rng.getrandbits(28),
+                                       rng.getrandbits(28)),
+        '--- a/%s\n' % (name,),
+        '+++ b/%s\n' % (name,),
+    ]
+    srcline = 1
+    for i in range(nhunks):
+        srcline += rng.randint(10, 200)
+        lines.extend(uni_hunk(rng, srcline, context,
+                              rng.randint(0, maxchange),
+                              rng.randint(1, maxchange)))
+    return lines
+
+def commit_message(rng, number):
+    lines = [
+        'From %040x Mon Sep 17 00:00:00 2001\n' % rng.getrandbits(160),
+        'From: A U Thor <author@example.com>\n',
+        'Subject: [PATCH %d] %s' % (number, text_line(rng)),
+        '\n',
+    ]
+    lines.extend(text_line(rng) for i in range(rng.randint(2, 10)))
+    lines.append('---\n')
+    return lines
+
+def corpus_small_git(rng):
+    """Many small git diffs with commit messages."""
+    lines = []
+    for i in range(400):
+        lines.extend(commit_message(rng, i))
+        for j in range(rng.randint(1, 4)):
+            lines.extend(git_patch(rng, 'src/dir%d/file%d.c' % (i % 17, j),
+                                   rng.randint(1, 3)))
+        lines.append('-- \n2.20.1\n\n')
+    return lines
+
+def corpus_giant_hunks(rng):
+    """A few files with very large hunks."""
+    lines = []
+    for i in range(3):
+        lines.extend(git_patch(rng, 'big%d.c' % (i,), 2,
+                               context=3, maxchange=20000))
+    return lines
+
+def corpus_crlf(rng):
+    """Plain unified diffs with CRLF line endings."""
+    lines = []
+    for i in range(300):
+        lines.extend(git_patch(rng, 'dos/file%d.txt' % (i,), 2)[2:])
+    return [l[:-1] + '\r\n' for l in lines]
+
+def corpus_indented(rng):
+    """Unified diffs indented and quoted per RFC 934, as in mail."""
+    lines = []
+    for i in range(300):
+        for l in git_patch(rng, 'mail/file%d.c' % (i,), 2)[2:]:
+            if l.startswith('-'):
+                l = '- ' + l
+            lines.append('  ' + l)
+    return lines
+
+def corpus_cquoted(rng):
+    """Git diffs with C-quoted file names."""
+    lines = []
+    for i in range(300):
+        name = 'dir/f\\303\\251 %d\\t\\"q\\"' % (i,)
+        patch = git_patch(rng, 'x', 1)
+        patch[0] = 'diff --git "a/%s" "b/%s"\n' % (name, name)
+        patch[2] = '--- "a/%s"\n' % (name,)
+        patch[3] = '+++ "b/%s"\n' % (name,)
+        lines.extend(patch)
+    return lines
+
+def corpus_normal(rng):
+    """Normal (non-unified) diff output."""
+    lines = []
+    for i in range(300):
+        lines.append('diff -r a/file%d b/file%d\n' % (i, i))
+        srcline = 1
+        for j in range(3):
+            srcline += rng.randint(5, 50)
+            removed = rng.randint(1, 5)
+            added = rng.randint(1, 5)
+            lines.append('%d,%dc%d,%d\n' % (srcline, srcline + removed - 1,
+                                            srcline, srcline + added - 1))
+            lines.extend('< ' + text_line(rng) for k in range(removed))
+            lines.append('---\n')
+            lines.extend('> ' + text_line(rng) for k in range(added))
+    return lines
+
+def corpus_context(rng):
+    """New-style context diffs."""
+    lines = []
+    for i in range(300):
+        lines.append('*** a/file%d\t2019-05-22 10:00:00.000000000 +0200\n'
+                     % (i,))
+        lines.append('--- b/file%d\t2019-05-22 10:00:01.000000000 +0200\n'
+                     % (i,))
+        srcline = 1
+        for j in range(2):
+            srcline += rng.randint(10, 100)
+            before = [text_line(rng) for k in range(3)]
+            after = [text_line(rng) for k in range(3)]
+            old = [text_line(rng) for k in range(rng.randint(1, 5))]
+            new = [text_line(rng) for k in range(rng.randint(1, 5))]
+            lines.append('***************\n')
+            lines.append('*** %d,%d ****\n' % (srcline,
+                                                srcline + len(old) + 5))
+            lines.extend('  ' + l for l in before)
+            lines.extend('! ' + l for l in old)
+            lines.extend('  ' + l for l in after)
+            lines.append('--- %d,%d ----\n' % (srcline,
+                                                srcline + len(new) + 5))
+            lines.extend('  ' + l for l in before)
+            lines.extend('! ' + l for l in new)
+            lines.extend('  ' + l for l in after)
+    return lines
+
+def corpus_ed(rng):
+    """Ed scripts, as written by diff -e."""
+    lines = []
+    srcline = 20000
+    for i in range(1500):
+        srcline -= rng.randint(2, 10)
+        r = rng.random()
+        if r < 0.3:
+            lines.append('%d,%dd\n' % (srcline, srcline + rng.randint(0, 3)))
+        else:
+            lines.append('%d%s\n' % (srcline, 'a' if r < 0.6 else 'c'))
+            lines.extend(text_line(rng) for k in range(rng.randint(1, 5)))
+            lines.append('.\n')
+    return lines
+
+CORPORA = [
+    ('small-git', corpus_small_git, patchutils.ANY_DIFF),
+    ('giant-hunks', corpus_giant_hunks, patchutils.ANY_DIFF),
+    ('crlf', corpus_crlf, patchutils.ANY_DIFF),
+    ('indented-rfc934', corpus_indented, patchutils.ANY_DIFF),
+    ('c-quoted-names', corpus_cquoted, patchutils.ANY_DIFF),
+    ('normal', corpus_normal, patchutils.NORMAL_DIFF),
+    ('context', corpus_context, patchutils.ANY_DIFF),
+    ('ed', corpus_ed, patchutils.ED_DIFF),
+]
+
+def open_line_reader(path):
+    with open(path, newline='') as f:
+        return patchutils.LineReader(f.readlines())
+
+def open_file_reader(path):
+    return patchutils.FileReader(open(path, newline=''))
+
+def open_mmap_reader(path):
+    with open(path, 'rb') as f:
+        return patchutils.MmapReader(f)
+
+READERS = [
+    ('LineReader', open_line_reader),
+    ('FileReader', open_file_reader),
+    ('MmapReader', open_mmap_reader),
+]
+
+def parse(path, open_reader, diff_type):
+    reader = open_reader(path)
+    patchfile = patchutils.PatchFile(reader, diff_type)
+    return len(patchfile.patches)
+
+def read_lines(path, open_reader, diff_type):
+    reader = open_reader(path)
+    count = 0
+    while reader.get_line(False):
+        count += 1
+    return count
+
+def measure(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def micro_parse_name(repeat):
+    specs = ['"a/dir/f\\303\\251 %d\\t\\"q\\""' % (i,) for i in range(2000)]
+    specs += ['a/dir/plain%d.c\t2019-05-22 10:00:00 +0200' % (i,)
+              for i in range(2000)]
+    def run():
+        for spec in specs:
+            patchutils.parse_name(spec, tabterm=True)
+        return len(specs)
+    (elapsed, count) = measure(run, repeat)
+    return {'case': 'parse_name', 'reader': None, 'seconds': elapsed,
+            'calls_per_sec': count / elapsed}
+
+def run_benchmarks(workdir, repeat, memory, selected):
+    results = []
+    for (name, generate, diff_type) in CORPORA:
+        if selected and name not in selected:
+            continue
+        rng = random.Random(name)
+        lines = generate(rng)
+        path = os.path.join(workdir, name + '.diff')
+        with open(path, 'w', newline='') as f:
+            f.writelines(lines)
+        nbytes = os.path.getsize(path)
+        nlines = len(lines)
+
+        for (rname, open_reader) in READERS:
+            for (case, func) in (('parse', parse),
+                                 ('get_line', read_lines)):
+                call = lambda: func(path, open_reader, diff_type)
+                entry = {'case': '%s/%s' % (case, name), 'reader': rname,
+                         'lines': nlines, 'bytes': nbytes}
+                try:
+                    (elapsed, count) = measure(call, repeat)
+                except NotImplementedError:
+                    entry['skipped'] = 'not implemented'
+                    results.append(entry)
+                    print('%-28s %-11s skipped' % (entry['case'], rname))
+                    continue
+                entry['seconds'] = elapsed
+                entry['lines_per_sec'] = nlines / elapsed
+                entry['mb_per_sec'] = nbytes / elapsed / 1e6
+                if case == 'parse':
+                    entry['patches'] = count
+                if memory:
+                    entry['peak_bytes'] = peak_memory(call)
+                results.append(entry)
+                print('%-28s %-11s %9.4f s %12.0f lines/s %8.2f MB/s%s' % (
+                    entry['case'], rname, elapsed, entry['lines_per_sec'],
+                    entry['mb_per_sec'],
+                    '  peak %.1f MB' % (entry['peak_bytes'] / 1e6)
+                    if memory else ''))
+
+    if not selected or 'parse_name' in selected:
+        entry = micro_parse_name(repeat)
+        results.append(entry)
+        print('%-28s %-11s %9.4f s %12.0f calls/s' % (
+            entry['case'], '', entry['seconds'], entry['calls_per_sec']))
+    return results
+
+def compare(results, baseline):
+    old = dict(((r['case'], r['reader']), r) for r in baseline['results'])
+    print()
+    print('%-28s %-11s %10s %10s %8s' % ('case', 'reader', 'old s', 'new s',
+                                         'speedup'))
+    for entry in results:
+        prev = old.get((entry['case'], entry['reader']))
+        if prev is None or 'seconds' not in prev or 'seconds' not in entry:
+            continue
+        print('%-28s %-11s %10.4f %10.4f %7.2fx' % (
+            entry['case'], entry['reader'] or '', prev['seconds'],
+            entry['seconds'], prev['seconds'] / entry['seconds']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='repeats per measurement (default: 3)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc peak memory runs')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved by an earlier run')
+    parser.add_argument('cases', nargs='*',
+                        help='corpora to run (default: all), or parse_name')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='patchutils-bench-')
+    try:
+        results = run_benchmarks(workdir, args.repeat, args.memory,
+                                 args.cases)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,17 +3,26 @@
 """Classes to represent patch files."""
 
 from __future__ import print_function
-from builtins import range
 
 __all__ = [
     'Change', 'Hunk', 'FileInfo', 'Header', 'Patch', 'PatchFile',
-    'Reader', 'LineReader', 'FileReader'
+    'Reader', 'LineReader', 'FileReader', 'MmapReader', 'PatchIndex',
+    'HunkResult', 'ApplyResult', 'CompactUniHunk', 'ChangeView',
+    'PatchSeries', 'SeriesEntry', 'PatchFilter', 'parse_parallel',
+    'GitBinaryHunk', 'ParseStats', 'PatchCache', 'fingerprint_files'
 ]
 
+# Keep module loading cheap: datetime, dateutil and the modules needed
+# only by PatchIndex or parallel application are imported on first use.
+import io
 import sys
+import os
 import re
-import datetime
-import dateutil.parser
+import codecs
+import mmap
+import array
+import bisect
+import functools
 
 ANY_DIFF = 0
 CONTEXT_DIFF = 1
@@ -28,10 +37,28 @@ __all__.extend([_var for _var in globals().keys() if _var.endswith('_DIFF')])
 re_cmd = re.compile(r'(\d+)(?:,(\d+))?([acd])(\d+)(?:,(\d+))?[ \t]*\r?\n')
 re_cstring = re.compile(r'("(?:\\.|[^"\\])*")(.*)')
 re_unescape = re.compile(r'\\[0-7]{1,3}|\\x[0-9a-fA-F]+|\\.')
+re_escape = re.compile(r'[\x00-\x1f"\\\x7f-\xff]')
 re_tabterm = re.compile(r'([^\t]*)\t(.*)')
-re_edcmd = re.compile(r'(?:(?:\d+)?([aicd]|s/.//)|\d+,\d+([cd]|s/.//))[ \t]*\r?\n')
+re_edcmd = re.compile(r'(\d+)(?:,(\d+)(?=[cd]))?([acdi])[ \t]*\r?\n')
 re_gitindex = re.compile(r'[0-9a-f]+\.\.[0-9a-f]+(?:\s+(.*))?$')
 re_unihunk = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(?: (.*))?')
+re_eol = re.compile(b'\n')
+re_opruns = re.compile(r' +|[-+]+')
+re_ctxold = re.compile(r'\*\*\* (\d+)(?:,(\d+))?(?: \*\*\*\*)?[ \t]*\r?\n')
+re_ctxnew = re.compile(r'--- (\d+)(?:,(\d+))?(?: ----)?[ \t]*\r?\n')
+re_binhunk = re.compile(r'(literal|delta) (\d+)[ \t]*\r?\n')
+re_mbox_from = re.compile(
+    br'^From \S+ +(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun) '
+    br'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +\d+ '
+    br'\d\d:\d\d(?::\d\d)? (?:\S+ )?\d{4}[ \t]*\r?$', re.M)
+re_mbox_subject = re.compile(br'^Subject: *(.*?)\r?$', re.M)
+re_isotime = re.compile(r'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:\.(\d+))?'
+                        r'(?: ?([+-])(\d\d):?(\d\d))?$')
+re_ctime = re.compile(r'(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun) '
+                      r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +'
+                      r'(\d\d?) (\d\d):(\d\d):(\d\d) (\d{4})$')
+_months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
 def fetchmode(spec):
     try:
@@ -64,6 +91,23 @@ def parse_c_name(spec):
         # wrong escape sequence
         return (None, spec)
 
+def escape(match):
+    c = match.group(0)
+    i = '\a\b\f\n\r\t\v\\\"'.find(c)
+    if i >= 0:
+        return '\\' + 'abfnrtv\\"'[i]
+    return '\\%03o' % ord(c)
+
+def quote_c_name(name):
+    """Turn a name returned by parse_c_name() back into a C string.
+
+    Names which parse_name() did not read as C strings (those without
+    surrounding double quotes) are returned unchanged.
+    """
+    if len(name) < 2 or name[0] != '"' or name[-1] != '"':
+        return name
+    return '"' + re_escape.sub(escape, name[1:-1]) + '"'
+
 def parse_name(spec, tabterm=False):
     spec = spec.lstrip()
     if spec.startswith('"'):
@@ -75,7 +119,21 @@ def parse_name(spec, tabterm=False):
             return (match.group(1).rstrip(), match.group(2))
     return re.match('(\S*)\s*(.*)', spec).groups()
 
+def parse_git_names(spec):
+    """Return the old and new name from the rest of a diff --git line,
+    or (None, None) if they cannot be told apart.
+    """
+    (old_name, s) = parse_name(spec)
+    if old_name is not None and len(s) > 0:
+        (new_name, s) = parse_name(s.lstrip())
+        if len(s) == 0 or s.isspace():
+            return (old_name, new_name)
+    return (None, None)
+
 class Reader(object):
+    # A ParseStats which counts set_pos() calls, or None.
+    stats = None
+
     def __init__(self, value=None):
         self.tab_size = 8
         self.indent = 0
@@ -93,6 +151,8 @@ class Reader(object):
         raise NotImplementedError()
 
     def strip_indent(self):
+        if self.line[:1] not in ' \tX':
+            return 0    # nothing to strip; the usual case
         indent = 0
         for i in range(len(self.line)):
             if self.line[i] == '\t':
@@ -111,16 +171,18 @@ class Reader(object):
             if line is None:
                 return False
 
-            curindent = 0
-            for i in range(len(line)):
-                if curindent >= indent:
-                    break
-                if line[i] == '\t':
-                    curindent += self.tab_size - (curindent % self.tab_size)
-                elif line[i] in ' X':
-                    curindent += 1
-                else:
-                    break
+            i = 0
+            if indent > 0:
+                curindent = 0
+                for i in range(len(line)):
+                    if curindent >= indent:
+                        break
+                    if line[i] == '\t':
+                        curindent += self.tab_size - (curindent % self.tab_size)
+                    elif line[i] in ' X':
+                        curindent += 1
+                    else:
+                        break
 
             nesting = rfc934_nesting
             while nesting > 0 and line.startswith('- ', i):
@@ -146,9 +208,80 @@ class Reader(object):
     def get_raw_line(self, skip_comments=True):
         return self.pget_line(0, 0, False, True)
 
+    def get_lines(self, count, skip_comments=True):
+        """Read up to count lines as get_line() would and return them.
+
+        Fewer lines are returned at the end of the input, or when
+        get_line() would fail on a line; that line is consumed, too.
+        Without indentation and RFC 934 nesting, lines are fetched and
+        classified a block at a time instead of one by one.
+        """
+        lines = []
+        if self.indent > 0 or self.rfc934_nesting > 0:
+            while len(lines) < count and self.get_line(skip_comments):
+                lines.append(self.line)
+            return lines
+
+        while len(lines) < count:
+            block = self._get_lines(count - len(lines))
+            if not block:
+                break
+            rejected = False
+            tails = ''.join([line[-1:] for line in block])
+            if tails.count('\n') != len(block):
+                # get_line() fails on a line without newline (unless it
+                # is a skipped comment); put back what comes after it.
+                for k in range(len(block)):
+                    if (block[k][-1:] != '\n'
+                        and not (skip_comments and block[k][:1] == '#')):
+                        self.set_pos(self.get_pos(k + 1 - len(block)))
+                        del block[k:]
+                        rejected = True
+                        break
+            if skip_comments:
+                heads = ''.join([line[:1] for line in block])
+                if '#' in heads:
+                    block = [line for line in block if line[:1] != '#']
+            if self.strip_cr:
+                block = [line[:-2] + '\n' if line[-2:] == '\r\n' else line
+                         for line in block]
+            lines.extend(block)
+            if rejected:
+                break
+        if lines:
+            self.line = lines[-1]
+        return lines
+
+    def get_heads(self, count):
+        """Skip up to count lines as get_lines() would, and return the
+        first characters of those which are not comments.  Returns None
+        when get_lines() would return fewer lines; the position is then
+        undefined.  reader.line is not updated.
+        """
+        lines = self.get_lines(count)
+        if len(lines) < count:
+            return None
+        return ''.join([line[:1] for line in lines])
+
+    def _get_lines(self, count):
+        # Return up to count raw lines.
+        lines = []
+        while count > 0:
+            line = self._get_line()
+            if line is None:
+                break
+            lines.append(line)
+            count -= 1
+        return lines
+
     def get_raw_lines(self, start, end=None):
         raise NotImplementedError()
 
+    def write_raw(self, fileobj, start, end=None, encoding='utf-8'):
+        """Copy lines start to end (exclusive) to a text or binary file
+        as they are in the input."""
+        line_writer(fileobj, encoding)(self.get_raw_lines(start, end))
+
     def set(self, value):
         raise NotImplementedError()
 
@@ -161,6 +294,8 @@ class LineReader(Reader):
         return self.lineno + lineoff
 
     def set_pos(self, pos):
+        if self.stats is not None:
+            self.stats.seek(self.lineno, pos)
         self.lineno = pos
 
     def _get_line(self):
@@ -170,6 +305,11 @@ class LineReader(Reader):
         self.lineno += 1
         return line
 
+    def _get_lines(self, count):
+        lines = self.lines[self.lineno:self.lineno + count]
+        self.lineno += len(lines)
+        return lines
+
     def get_raw_lines(self, start, end=None):
         return self.lines[start:end]
 
@@ -185,8 +325,14 @@ class FileReader(Reader):
         return self.lineno + lineoff
 
     def set_pos(self, pos):
+        stats = self.stats
+        if stats is not None:
+            stats.seek(self.lineno, pos)
+            start = stats.clock()
         self.f.seek(self.line2pos[pos])
         self.lineno = pos
+        if stats is not None:
+            stats.times['seeks'] += stats.clock() - start
 
     def _get_line(self):
         if self.f is None:
@@ -215,7 +361,235 @@ class FileReader(Reader):
         self.f = f
         self.line2pos = [ self.f.tell() ]
 
+class MmapReader(Reader):
+    """Reader over a byte buffer (bytes, bytearray, mmap or memoryview).
+
+    A binary file object is memory-mapped read-only.  Line boundaries
+    are found lazily, going back is a plain index reset, and only lines
+    which are actually fetched get decoded.  Line endings are kept as-is,
+    like a file opened with newline=''.
+
+    close() (or leaving a with block) unmaps a file mapped by the reader.
+    """
+
+    def __init__(self, value=None, encoding='utf-8',
+                 errors='surrogateescape'):
+        self.encoding = encoding
+        self.errors = errors
+        # Runs of lines can be decoded at once and split at '\n' where
+        # the encoding never uses that byte inside a character.
+        self.ascii_compatible = codecs.lookup(encoding).name in (
+            'utf-8', 'ascii', 'iso8859-1', 'cp1252')
+        super(MmapReader, self).__init__(value)
+        self.lineno = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.mapped:
+            self.buf.close()
+            self.mapped = False
+
+    def get_pos(self, lineoff=0):
+        return self.lineno + lineoff
+
+    def set_pos(self, pos):
+        if self.stats is not None:
+            self.stats.seek(self.lineno, pos)
+        self.lineno = pos
+
+    def _find_eol(self, start):
+        # memoryview has no find(); fall back to a regex search
+        match = re_eol.search(self.buf, start)
+        return -1 if match is None else match.start()
+
+    def _get_line(self):
+        line2pos = self.line2pos
+        if self.lineno >= len(line2pos):
+            # set_pos() went past the lines found so far
+            self._find_lines(self.lineno)
+            if self.lineno >= len(line2pos):
+                return None
+        start = line2pos[self.lineno]
+        if start >= self.size:
+            return None
+        self.lineno += 1
+        if self.lineno < len(line2pos):
+            end = line2pos[self.lineno]
+        else:
+            end = self._find_eol(start)
+            end = self.size if end < 0 else end + 1
+            line2pos.append(end)
+        return str(self.buf[start:end], self.encoding, self.errors)
+
+    def _find_lines(self, last):
+        # Extend line2pos up to line last, or to the end of the buffer.
+        line2pos = self.line2pos
+        need = last + 1 - len(line2pos)
+        if need <= 0:
+            return
+        (find, size) = (self._find_eol, self.size)
+        start = line2pos[-1]
+        while need > 0 and start < size:
+            end = find(start)
+            start = size if end < 0 else end + 1
+            line2pos.append(start)
+            need -= 1
+
+    def _get_lines(self, count):
+        if not self.ascii_compatible:
+            return super(MmapReader, self)._get_lines(count)
+        line2pos = self.line2pos
+        lineno = self.lineno
+        self._find_lines(lineno + count)
+        last = min(lineno + count, len(line2pos) - 1)
+        if last <= lineno:
+            return []
+        self.lineno = last
+        text = str(self.buf[line2pos[lineno]:line2pos[last]],
+                   self.encoding, self.errors)
+        lines = text.split('\n')
+        tail = lines.pop()
+        lines = [line + '\n' for line in lines]
+        if tail:
+            lines.append(tail)  # last line without newline
+        return lines
+
+    def get_heads(self, count):
+        """See Reader.get_heads().  Exactly count lines are skipped,
+        comments included, and only the first byte of each is looked at;
+        lines are neither decoded nor copied.
+        """
+        if (self.indent > 0 or self.rfc934_nesting > 0
+            or not self.ascii_compatible):
+            return Reader.get_heads(self, count)
+        (buf, line2pos, lineno) = (self.buf, self.line2pos, self.lineno)
+        last = lineno + count
+        self._find_lines(last)
+        if len(line2pos) <= last or buf[line2pos[last] - 1] != 10:
+            return None     # the input ends, maybe without a newline
+        heads = bytes(map(buf.__getitem__, line2pos[lineno:last]))
+        heads = heads.decode('latin-1')
+        if self.strip_cr and '\r' in heads:
+            return None     # an empty line, which becomes '\n'
+        if '#' in heads:
+            heads = heads.replace('#', '')
+        self.lineno = last
+        return heads
+
+    def get_raw_lines(self, start, end=None):
+        lines = []
+        oldpos = self.get_pos()
+        self.set_pos(start)
+        while self.lineno != end:
+            line = self._get_line()
+            if line is None:
+                break
+            lines.append(line)
+        self.set_pos(oldpos)
+        return lines
+
+    def write_raw(self, fileobj, start, end=None, encoding=None):
+        """Copy lines start to end (exclusive) to a file.  Binary files
+        get a memoryview of the buffer, without copying or decoding."""
+        if isinstance(fileobj, io.TextIOBase):
+            fileobj.writelines(self.get_raw_lines(start, end))
+            return
+        line2pos = self.line2pos
+        self._find_lines(start if end is None else end)
+        begin = line2pos[start] if start < len(line2pos) else self.size
+        stop = self.size
+        if end is not None and end < len(line2pos):
+            stop = line2pos[end]
+        with memoryview(self.buf)[begin:stop] as view:
+            fileobj.write(view)
+
+    def set(self, buf):
+        self.mapped = False
+        if buf is None:
+            buf = b''
+        elif hasattr(buf, 'fileno'):
+            if os.fstat(buf.fileno()).st_size > 0:
+                buf = mmap.mmap(buf.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mapped = True
+            else:
+                buf = b''   # empty files cannot be mapped
+        if isinstance(buf, memoryview):
+            buf = buf.cast('B')
+        else:
+            self._find_eol = functools.partial(buf.find, b'\n')
+        self.buf = buf
+        self.size = len(buf)
+        self.line2pos = [ 0 ]
+
+# Markers for a FileInfo time stamp which has not been computed yet.
+_unparsed = object()
+_epoch = object()
+
+# Bytes which git patch-id removes before hashing (git's isspace(),
+# which unlike C's does not include '\v' and '\f').
+_id_spaces = b' \t\n\r'
+
+@functools.lru_cache(maxsize=256)
+def parse_timestr(timestr):
+    """Parse a time stamp from a file header, or return None.
+
+    The layouts written by diff -u and diff -c are recognized directly;
+    anything else goes to dateutil, if it is installed.  Results are
+    cached, because all files in a patch usually share a few time stamps.
+    """
+    import datetime
+
+    match = re_isotime.match(timestr)
+    if match:
+        (year, month, day, hour, minute, second,
+         frac, sign, tzhour, tzmin) = match.groups()
+        if frac is None:
+            usec = 0
+        else:
+            usec = int(frac[:6].ljust(6, '0'))
+        if sign is None:
+            tzinfo = None
+        else:
+            offset = int(tzhour) * 60 + int(tzmin)
+            if offset == 0:
+                tzinfo = datetime.timezone.utc
+            else:
+                if sign == '-':
+                    offset = -offset
+                tzinfo = datetime.timezone(datetime.timedelta(minutes=offset))
+        try:
+            return datetime.datetime(int(year), int(month), int(day),
+                                     int(hour), int(minute), int(second),
+                                     usec, tzinfo)
+        except ValueError:
+            pass
+    else:
+        match = re_ctime.match(timestr)
+        if match:
+            (month, day, hour, minute, second, year) = match.groups()
+            try:
+                return datetime.datetime(int(year), _months.index(month) + 1,
+                                         int(day), int(hour), int(minute),
+                                         int(second))
+            except ValueError:
+                pass
+    try:
+        import dateutil.parser
+    except ImportError:
+        return None
+    try:
+        return dateutil.parser.parse(timestr)
+    except ValueError:
+        return None
+
 class FileInfo(object):
+    __slots__ = [ 'name', 'timestr', '_stamp', 'mode', 'copy', 'rename' ]
+
     def __init__(self, name=None, timestr=None, mode=None,
                  copy=False, rename=False):
         self.set_timestr(timestr)
@@ -237,35 +611,66 @@ class FileInfo(object):
         if name is not None and len(name) > 0:
             if name == '/dev/null':
                 name = None
-                self.stamp = datetime.datetime.utcfromtimestamp(0)
+                self._stamp = _epoch
         self.name = name
 
     def set_timestr(self, timestr):
+        # The time stamp is parsed on first access to stamp.
         self.timestr = timestr
-        self.stamp = None
+        self._stamp = None
         if timestr is not None and len(timestr) > 0:
             self.timestr = timestr.rstrip()
-            try:
-                self.stamp = dateutil.parser.parse(self.timestr)
-            except ValueError:
-                pass
+            self._stamp = _unparsed
 
-    def set_spec(self, spec):
-        (name, timestr) = parse_name(spec, tabterm=True)
-        self.set_timestr(timestr)
+    @property
+    def stamp(self):
+        stamp = self._stamp
+        if stamp is _unparsed:
+            stamp = self._stamp = parse_timestr(self.timestr)
+        elif stamp is _epoch:
+            import datetime
+            stamp = self._stamp = datetime.datetime(1970, 1, 1)
+        return stamp
+
+    @stamp.setter
+    def stamp(self, stamp):
+        self._stamp = stamp
+
+    def set_spec(self, spec, stats=None):
+        # With stats (a ParseStats), the name and time stamp are timed.
+        if stats is None:
+            (name, timestr) = parse_name(spec, tabterm=True)
+            self.set_timestr(timestr)
+        else:
+            (name, timestr) = stats.timed('names', parse_name, spec, True)
+            stats.timed('timestamps', self.set_timestr, timestr)
         self.set_name(name)
 
+    def is_null(self):
+        """Check whether this side of a patch is a nonexistent file,
+        i.e. /dev/null or a file with a time stamp of the Epoch.
+        """
+        if self.name is None:
+            return True
+        stamp = self.stamp
+        if stamp is None:
+            return False
+        if stamp.tzinfo is None:
+            return stamp == stamp.replace(1970, 1, 1, 0, 0, 0, 0)
+        return stamp.timestamp() == 0
+
 def get_edcmd(line):
+    # Only commands with an address start an ed hunk; 's/.//' and 'a'
+    # without one continue the text of the previous command (see
+    # EdHunk.parse()).
     match = re_edcmd.match(line)
     if not match:
         return None
-
-    letter = match.group(1)
-    if letter is None:
-        letter = match.group(2)
-    return letter
+    return match.group(3)
 
 class Header(object):
+    __slots__ = [ 'old', 'new', 'index', 'begin', 'end' ]
+
     def __init__(self, old=None, new=None, index=None):
         self.old = FileInfo() if old is None else old
         self.new = FileInfo() if new is None else new
@@ -277,6 +682,51 @@ class Header(object):
             self.__class__.__name__, repr(self.old), repr(self.new),
             repr(self.index))
 
+    def iter_lines(self, files=True, git=False, prefixes=('---', '+++')):
+        """Return header lines for the patch, in git format if git is
+        true or there is mode, rename or copy information, and with ---
+        and +++ lines (or other prefixes) unless files is false.
+        """
+        (old, new) = (self.old, self.new)
+        lines = []
+        if (git or old.mode is not None or new.mode is not None
+            or old.rename or new.rename or old.copy or new.copy):
+            old_name = old.name
+            if old_name is None:
+                old_name = git_name(new.name, 'a/')
+            new_name = new.name
+            if new_name is None:
+                new_name = git_name(old.name, 'b/')
+            lines.append('diff --git %s %s\n' % (quote_c_name(old_name),
+                                                 quote_c_name(new_name)))
+            if old.name is None and new.mode is not None:
+                lines.append('new file mode %06o\n' % new.mode)
+            elif new.name is None and old.mode is not None:
+                lines.append('deleted file mode %06o\n' % old.mode)
+            elif old.mode != new.mode:
+                if old.mode is not None:
+                    lines.append('old mode %06o\n' % old.mode)
+                if new.mode is not None:
+                    lines.append('new mode %06o\n' % new.mode)
+            for (info, verb, end) in ((old, 'rename', 'from'),
+                                      (new, 'rename', 'to'),
+                                      (old, 'copy', 'from'),
+                                      (new, 'copy', 'to')):
+                if getattr(info, verb) and info.name is not None:
+                    lines.append('%s %s %s\n' % (
+                        verb, end, quote_c_name(git_name(info.name))))
+        elif self.index is not None:
+            lines.append('Index: %s\n' % quote_c_name(self.index))
+        if files and (old.name is not None or new.name is not None):
+            for (prefix, info) in zip(prefixes, (old, new)):
+                name = '/dev/null' if info.name is None else info.name
+                if info.timestr:
+                    lines.append('%s %s\t%s\n' % (
+                        prefix, quote_c_name(name), info.timestr))
+                else:
+                    lines.append('%s %s\n' % (prefix, quote_c_name(name)))
+        return lines
+
 class Change(object):
     __slots__ = [ 'op', 'text' ]
 
@@ -292,6 +742,9 @@ class Change(object):
         return self.op + self.text
 
 class Hunk(object):
+    __slots__ = [ 'srcline', 'dstline', 'section', 'src', 'dst',
+                  'begin', 'end' ]
+
     def __init__(self, srcline=None, dstline=None, section=None,
                  src=None, dst=None):
         self.srcline = srcline
@@ -306,13 +759,244 @@ class Hunk(object):
             self.__class__.__name__, repr(self.srcline), repr(self.dstline),
             repr(self.section), repr(self.src), repr(self.dst))
 
-    def parse(self, reader):
+    def parse(self, reader, headers_only=False):
         return False
 
+    def iter_lines(self):
+        """Return the lines of the hunk, starting with its header."""
+        raise NotImplementedError()
+
+    def iter_changes(self):
+        """Return the body of the hunk as (op, change) pairs in unified
+        order: removed lines come before added ones between context
+        lines.  op is the change's own op, except for context lines
+        which only appear on one side; those are removed or added.
+        """
+        (src, dst) = (self.src, self.dst)
+        (i, j) = (0, 0)
+        while i < len(src) or j < len(dst):
+            while i < len(src) and src[i].op != ' ':
+                yield ('-', src[i])
+                i += 1
+            while j < len(dst) and dst[j].op != ' ':
+                yield ('+', dst[j])
+                j += 1
+            if i < len(src) and j < len(dst):
+                yield (' ', src[i])
+                (i, j) = (i + 1, j + 1)
+            elif i < len(src):
+                yield ('-', src[i])
+                i += 1
+            elif j < len(dst):
+                yield ('+', dst[j])
+                j += 1
+
+    def reversed(self):
+        """Return the hunk with its two sides swapped.
+
+        Context Change objects are shared with this hunk, and on both
+        sides of the new one; removed and added lines become new Change
+        objects with the opposite op.
+        """
+        return type(self)(self.dstline, self.srcline, self.section,
+                          _flip_changes(self.dst, '-'),
+                          _flip_changes(self.src, '+'))
+
+    def load(self, reader, reader_state=None):
+        """Parse the hunk body again from its recorded begin position.
+
+        This fills in src and dst of a hunk which was parsed with
+        headers_only.  reader_state is the Patch.reader_state of the
+        patch the hunk belongs to; the reader settings are restored from
+        it for the duration of the call, as in Patch.load().  The reader
+        position is preserved.
+        """
+        pos = reader.get_pos()
+        saved = (reader.indent, reader.rfc934_nesting, reader.strip_cr)
+        if reader_state is not None:
+            (reader.indent, reader.rfc934_nesting,
+             reader.strip_cr) = reader_state
+        try:
+            reader.set_pos(self.begin)
+            return self.parse(reader)
+        finally:
+            reader.set_pos(pos)
+            (reader.indent, reader.rfc934_nesting,
+             reader.strip_cr) = saved
+
+    def src_count(self, reader=None):
+        """Return the number of lines of the old file which the hunk
+        covers.  For a hunk parsed with headers_only, the count is taken
+        from the hunk header at its begin position in reader; the body
+        is not loaded.  The reader position is preserved.
+        """
+        if reader is None or self.begin is None or _hunk_loaded(self):
+            return len(self.src)
+        pos = reader.get_pos()
+        reader.set_pos(self.begin)
+        try:
+            return self.read_src_count(reader)
+        finally:
+            reader.set_pos(pos)
+
+    def read_src_count(self, reader):
+        # Read the hunk at the reader position and return its old line
+        # count, or 0 if it cannot be parsed.
+        hunk = type(self)()
+        if not hunk.parse(reader):
+            return 0
+        return len(hunk.src)
+
+def _flip_changes(changes, op):
+    # Change objects of the other side of a reversed hunk.
+    return [change if change.op == ' ' else Change(op, change.text)
+            for change in changes]
+
+class HunkResult(object):
+    """Outcome of applying one hunk.
+
+    line is the line number in the output file where the hunk was
+    applied, or None if it failed.  offset and fuzz have the same meaning
+    as in the messages of GNU patch.
+    """
+
+    def __init__(self, number, line=None, offset=0, fuzz=0):
+        self.number = number
+        self.line = line
+        self.offset = offset
+        self.fuzz = fuzz
+
+    def __repr__(self):
+        return '%s(%d, line=%s, offset=%d, fuzz=%d)' % (
+            self.__class__.__name__, self.number, repr(self.line),
+            self.offset, self.fuzz)
+
+    def __str__(self):
+        if self.line is None:
+            return 'Hunk #%d FAILED.' % (self.number,)
+        msg = 'Hunk #%d succeeded at %d' % (self.number, self.line)
+        if self.fuzz:
+            msg += ' with fuzz %d' % (self.fuzz,)
+        if self.offset:
+            msg += ' (offset %d line%s)' % (
+                self.offset, '' if self.offset == 1 else 's')
+        return msg + '.'
+
+    @property
+    def failed(self):
+        return self.line is None
+
+class ApplyResult(object):
+    """Outcome of applying a patch to one file."""
+
+    def __init__(self, name=None, number=None, hunks=None, error=None):
+        self.name = name
+        self.number = number
+        self.hunks = [] if hunks is None else hunks
+        self.error = error
+
+    def __repr__(self):
+        return '%s(name=%s, number=%s, hunks=%s, error=%s)' % (
+            self.__class__.__name__, repr(self.name), repr(self.number),
+            repr(self.hunks), repr(self.error))
+
+    @property
+    def failed(self):
+        return (self.error is not None
+                or any(hunk.failed for hunk in self.hunks))
+
+def git_name(name, prefix=''):
+    """Replace the a/ or b/ prefix of a name in a diff --git line."""
+    if name.startswith('"'):
+        return '"' + git_name(name[1:], prefix)
+    return prefix + name.split('/', 1)[-1]
+
+def line_writer(fileobj, encoding='utf-8', errors='surrogateescape'):
+    """Return a function which writes a list of lines to fileobj.
+
+    Lines are encoded for files which are not text files.
+    """
+    if isinstance(fileobj, io.TextIOBase):
+        return fileobj.writelines
+    def writelines(lines):
+        fileobj.write(''.join(lines).encode(encoding, errors))
+    return writelines
+
+def strip_name(name, strip):
+    """Remove strip leading components from a file name, like patch -p."""
+    if name is None or strip is None:
+        return name
+    components = name.split('/')
+    if strip > 0 and len(components) <= strip:
+        return None
+    return '/'.join(components[strip:])
+
+class LineIndex(object):
+    """Index of the lines of a file, for locating hunks.
+
+    Each distinct line text maps to the sorted list of its positions.
+    Lines are compared exactly, as in GNU patch: a last line without
+    a newline only matches a pattern line marked '\\ No newline'.
+    """
+
+    def __init__(self, lines):
+        self.keys = keys = lines
+        self.positions = {}
+        for i, line in enumerate(keys):
+            self.positions.setdefault(line, []).append(i)
+
+    def locate(self, pattern, first, last, guess, lo, hi):
+        """Find the hunk position closest to guess where pattern[first:last]
+        matches, trying guess, guess + 1, guess - 1, guess + 2, ... like
+        GNU patch.  Positions are 0-based indices of pattern[0] and must
+        lie between lo and hi (inclusive).  Returns None if there is no
+        match.
+        """
+        if lo > hi:
+            return None
+        if first >= last:
+            # nothing to compare; the allowed position closest to guess
+            return min(max(guess, lo), hi)
+
+        # Anchor the search at the pattern line with fewest occurrences.
+        best = None
+        for k in range(first, last):
+            positions = self.positions.get(pattern[k])
+            if positions is None:
+                return None
+            if best is None or len(positions) < len(best):
+                best = positions
+                anchor = k
+                if len(positions) == 1:
+                    break
+
+        lower = bisect.bisect_left(best, lo + anchor)
+        upper = bisect.bisect_right(best, hi + anchor)
+        candidates = [pos - anchor for pos in best[lower:upper]]
+        candidates.sort(key=lambda where: (abs(where - guess), where < guess))
+        keys = self.keys
+        for where in candidates:
+            for k in range(first, last):
+                if keys[where + k] != pattern[k]:
+                    break
+            else:
+                return where
+        return None
+
+def terminate(out):
+    # GNU patch adds the missing newline of an output line when it
+    # copies a line of the input file after it.
+    if out and not out[-1].endswith('\n'):
+        out[-1] += '\n'
+
 class Patch(object):
     """Patch base class."""
 
+    __slots__ = [ 'header', 'hunks', 'begin', 'end', 'reader_state' ]
+
     diff_type = ANY_DIFF
+    binary = False      # apply() takes bytes instead of lines
+    file_prefixes = ('---', '+++')
 
     def __init__(self, header=None, hunks=None):
         """Construct a patch from its header and a list of hunks."""
@@ -320,6 +1004,7 @@ class Patch(object):
         self.hunks = [] if hunks is None else hunks
         self.begin = self.header.begin
         self.end = None
+        self.reader_state = None
 
     def __repr__(self):
         """Return string representation of a patch.
@@ -329,167 +1014,1691 @@ class Patch(object):
         return '%s(%s, %s)' % (self.__class__.__name__,
                                self.header, self.hunks)
 
-    def parse(self, reader):
+    def parse(self, reader, headers_only=False, compact=False):
         """Construct a patch by reading hunks from a Reader,
         using metadata from Header.
+
+        With headers_only, hunk bodies are skipped where the hunk format
+        allows it; only positions and line numbers are recorded.  With
+        compact, hunk formats that support it store their bodies in
+        a compact form (see CompactUniHunk).
         """
         if self.begin is None:
             self.begin = reader.get_pos()
+        self.reader_state = (reader.indent, reader.rfc934_nesting,
+                             reader.strip_cr)
         self.hunks = []
-        hunk = self.next_hunk()
-        while hunk.parse(reader):
+        hunk = self.next_hunk(compact)
+        while hunk.parse(reader, headers_only):
             self.hunks.append(hunk)
-            hunk = self.next_hunk()
+            hunk = self.next_hunk(compact)
         self.end = reader.get_pos(-1)
 
-class NormalHunk(Hunk):
-    def parse(self, reader):
-        if not reader.get_line():
-            return False
-        match = re_cmd.match(reader.line)
-        if not match:
-            reader.set_pos(reader.get_pos(-1))
-            return False
-        cmd = match.group(3)
-        self.srcline = int(match.group(1))
-        ptrn_lines = match.group(2)
-        if ptrn_lines is None:
-            ptrn_lines = 0 if cmd == 'a' else 1
-        else:
-            ptrn_lines = int(ptrn_lines) - self.srcline + 1
-        self.dstline = int(match.group(4))
-        repl_lines = match.group(5)
-
-        return True
-
-class NormalPatch(Patch):
-    diff_type = NORMAL_DIFF
-
-    def next_hunk(self):
-        return NormalHunk()
-
-class EdHunk(Hunk):
-    def parse(self, reader):
-        if not reader.get_line():
-            return False
-        self.begin = reader.get_pos(-1)
-        edcmd = get_edcmd(reader.line)
-        if edcmd in 'ds':
-            self.end = self.begin
-            return True
-        while reader.get_line(False):
-            if reader.line == '.\n':
-                self.end = reader.get_pos(-1)
-                return True
-        return False
+    def iter_lines(self, reader=None):
+        """Return the lines of the patch.
 
-class EdPatch(Patch):
-    diff_type = ED_DIFF
+        A patch parsed from reader is copied from it as it is, unless it
+        has been changed since (see same_as()).  Of a changed patch,
+        the header and the hunks which are still the same are copied
+        from the reader, a header without reader positions is
+        synthesized, and other hunks are formatted from their contents.
+        """
+        parsed = self.parsed(reader)
+        if parsed is not None and self.same_as(parsed):
+            return iter(reader.get_raw_lines(self.begin, self.end + 1))
+        return self._format_lines(reader, parsed)
 
-    def next_hunk(self):
-        return EdHunk()
+    def format_lines(self, reader=None):
+        return self._format_lines(reader, self.parsed(reader))
 
-class UniHunk(Hunk):
-    def parse(self, reader):
-        if not reader.get_line():
-            return False
-        match = re_unihunk.match(reader.line)
-        if not match:
-            reader.set_pos(reader.get_pos(-1))
-            return False
-        self.begin = reader.get_pos(-1)
-        self.srcline = int(match.group(1))
-        ptrn_lines = match.group(2)
-        if ptrn_lines is None:
-            ptrn_lines = 1
-        else:
-            ptrn_lines = int(ptrn_lines)
-            if ptrn_lines == 0:
-                self.srcline += 1     # append rather than insert
-        self.dstline = int(match.group(3))
-        repl_lines = match.group(4)
-        if repl_lines is None:
-            repl_lines = 1
+    def _format_lines(self, reader, parsed):
+        header = self.header
+        if (parsed is not None and header.begin is not None
+            and header.end is not None and _same_header(header, parsed.header)):
+            lines = reader.get_raw_lines(header.begin, header.end + 1)
         else:
-            repl_lines = int(repl_lines)
-            if repl_lines == 0:
-                self.dstline += 1     # append rather than insert
-        self.section = match.group(5)
-        while ptrn_lines > 0 or repl_lines > 0:
-            if not reader.get_line() or len(reader.line) < 1:
-                if repl_lines < 3:
-                    line = ' \n' # assume blank lines got chopped
-                else:
-                    return False # unexpected EOF
+            lines = header.iter_lines(len(self.hunks) > 0 and not self.binary,
+                                      self.binary, self.file_prefixes)
+        for line in lines:
+            yield line
+        parsed_hunks = {}
+        if parsed is not None:
+            parsed_hunks = dict((hunk.begin, hunk) for hunk in parsed.hunks)
+        for hunk in self.hunks:
+            other = parsed_hunks.get(hunk.begin)
+            if other is not None and _same_hunk(hunk, other):
+                lines = reader.get_raw_lines(hunk.begin, hunk.end + 1)
             else:
-                line = reader.line
+                lines = hunk.iter_lines()
+            for line in lines:
+                yield line
 
-            ch = line[0]
-            if ch == '-':
-                if ptrn_lines <= 0:
-                    return False
-                ptrn_lines -= 1
+    def write(self, fileobj, reader=None, encoding='utf-8'):
+        """Write the patch to a text or binary file (see iter_lines()).
 
-                change = Change(ch, line[1:])
-                self.src.append(change)
-            elif ch in ' =\t\n':
-                if ptrn_lines <= 0 or repl_lines <= 0:
-                    return False
-                ptrn_lines -= 1
-                repl_lines -= 1
+        Unchanged patches are copied with Reader.write_raw(), which for
+        a MmapReader and a binary file does not copy the data.
+        """
+        parsed = self.parsed(reader)
+        if parsed is not None and self.same_as(parsed):
+            reader.write_raw(fileobj, self.begin, self.end + 1, encoding)
+        else:
+            line_writer(fileobj, encoding)(
+                list(self._format_lines(reader, parsed)))
 
-                if ch in '\t\n':
-                    # assume the space got eaten
-                    change = Change(' ', line)
-                else:
-                    change = Change(' ', line[1:])
-                self.src.append(change)
-                self.dst.append(change)
-            elif ch == '+':
-                if repl_lines <= 0:
-                    return False
-                repl_lines -= 1
+    def unchanged(self, reader):
+        """Return whether the patch is still as parsed from reader.
 
-                change = Change(ch, line[1:])
-                self.dst.append(change)
-            else:
-                return False
-        self.end = reader.get_pos(-1)
-        return True
+        The patch is parsed again and compared (see parsed() and
+        same_as()), so nothing needs to be kept from the first parse.
+        This is false for a patch without a reader position.
+        """
+        parsed = self.parsed(reader)
+        return parsed is not None and self.same_as(parsed)
 
-class UniPatch(Patch):
-    diff_type = UNI_DIFF
+    def parsed(self, reader):
+        """Parse the patch again from its position in reader, and return
+        the result, or None if the patch has no reader position.
 
-    def next_hunk(self):
-        return UniHunk()
+        Hunks are parsed like those of this patch: in compact form if
+        any of them is compact, and without bodies if none has one.
+        """
+        begin = self.begin
+        if begin is None:
+            begin = self.header.begin
+        if reader is None or begin is None:
+            return None
+        diff_type = self.diff_type
+        if diff_type not in (ED_DIFF, NORMAL_DIFF):
+            diff_type = ANY_DIFF
+        patchfile = PatchFile(
+            diff_type=diff_type,
+            headers_only=not any(_hunk_loaded(hunk) for hunk in self.hunks),
+            compact=any(isinstance(hunk, CompactUniHunk)
+                        for hunk in self.hunks))
+        pos = reader.get_pos()
+        saved = (reader.indent, reader.rfc934_nesting, reader.strip_cr)
+        try:
+            reader.set_pos(begin)
+            patch = patchfile.next_patch(reader, False)
+        finally:
+            reader.set_pos(pos)
+            (reader.indent, reader.rfc934_nesting,
+             reader.strip_cr) = saved
+        if patch is None or patch.begin != begin:
+            return None
+        return patch
 
-class ContextHunk(Hunk):
-    def parse(self, reader):
-        raise NotImplementedError()
+    def same_as(self, other):
+        """Return whether this patch has the same positions, header and
+        hunks as other.  A hunk without its body (see headers_only) is
+        the same as one with the same positions and line numbers."""
+        return (type(self) is type(other) and self.begin == other.begin
+                and self.end == other.end
+                and _same_header(self.header, other.header)
+                and len(self.hunks) == len(other.hunks)
+                and all(_same_hunk(a, b)
+                        for (a, b) in zip(self.hunks, other.hunks)))
 
-class ContextPatch(Patch):
-    diff_type = CONTEXT_DIFF
+    def reversed(self):
+        """Return the reverse of the patch, which undoes it like
+        patch -R or git apply -R.
 
-    def next_hunk(self):
-        return ContextHunk()
+        The old and new FileInfo of the header are swapped, together
+        with their mode, rename and copy information, and so are the
+        sides of each hunk (see Hunk.reversed()).  Nothing is copied
+        that does not change; write the result without a reader.
+        Ed scripts cannot be reversed and raise ValueError.
+        """
+        header = Header(self.header.new, self.header.old, self.header.index)
+        return type(self)(header, [hunk.reversed() for hunk in self.hunks])
 
-class NewContextHunk(Hunk):
-    def parse(self, reader):
-        raise NotImplementedError()
+    def combine(self, other, context=3):
+        """Return a patch with the changes of this patch followed by
+        those of other, which must apply to the result of this one, as
+        combinediff does.  Both patches need their hunk bodies (not
+        headers_only).  The hunks have context lines around changes
+        (all there are with context None).
 
-class NewContextPatch(Patch):
-    diff_type = NEW_CONTEXT_DIFF
+        Only the hunks are combined, not the files they apply to: each
+        line is taken from the hunks, and where both patches cover
+        a line, they must agree on it, or ValueError is raised.
+        """
+        hunks = _compose([_Edit.from_hunk(hunk) for hunk in self.hunks],
+                         [_Edit.from_hunk(hunk) for hunk in other.hunks],
+                         context)
+        new = other.header.new
+        if (new.mode is None and other.header.old.mode is None
+            and self.header.new.mode is not None):
+            # other does not know the mode this patch sets
+            new = FileInfo(new.name, new.timestr, self.header.new.mode,
+                           new.copy, new.rename)
+        return UniPatch(Header(self.header.old, new), hunks)
 
-    def next_hunk(self):
-        return NewContextHunk()
+    def fingerprint(self, reader=None, encoding=None):
+        """Return the git patch-id of the patch, as a hex string.
 
-class GitBinaryPatch(Patch):
-    diff_type = GIT_BINARY_DIFF
+        The SHA-1 covers the git header and the hunk bodies with all
+        whitespace removed, but no line numbers or index lines, so the
+        same change made at another place in the file, or reindented,
+        has the same fingerprint.  Other formats are hashed like the
+        same change in a git patch, without time stamps.  Hunks need
+        their bodies (not headers_only).
 
-    def next_hunk(self):
-        raise NotImplementedError()
+        The header is synthesized unless the reader the patch was parsed
+        from is given: then a git header is hashed as it was read, which
+        also covers the similarity index of renames and the blob names
+        that git patch-id uses for binary patches.  Without a reader,
+        binary patches are hashed by their data instead.  Patches
+        without file names, such as normal diffs and ed scripts, are
+        hashed by their hunks alone; the lines an ed script deletes
+        are not part of it.
+        """
+        return _patch_id([self], reader, encoding)
+
+    def update_fingerprint(self, digest, reader=None, encoding=None,
+                           diff_line=True):
+        """Feed the text behind fingerprint() into a hashlib object, and
+        return whether the patch was hashed as a binary one.  git
+        patch-id leaves out the diff line of a patch which follows
+        a binary one (diff_line false).
+        """
+        if encoding is None:
+            encoding = getattr(reader, 'encoding', 'utf-8')
+        def update(text):
+            digest.update(text.encode(encoding, 'surrogateescape').translate(
+                None, _id_spaces))
+        (header, oids) = self._id_header(reader, diff_line)
+        update(header)
+        if oids is not None:
+            digest.update(oids.encode('ascii'))
+            return True
+        if self.binary:
+            for hunk in self.hunks:
+                update('%s %s' % (hunk.method, hunk.size))
+                update(''.join(hunk.lines))
+            return True
+        for hunk in self.hunks:
+            if isinstance(hunk, CompactUniHunk):
+                update(''.join([op + text for (op, text)
+                                in zip(hunk.ops, hunk.lines)]))
+            else:
+                update(''.join([op + change.text for (op, change)
+                                in hunk.iter_changes()
+                                if change.text is not None]))
+        return False
+
+    def _id_header(self, reader, diff_line):
+        # The header text hashed by git patch-id, and for binary patches
+        # the blob names from the index line (or None).
+        header = self.header
+        lines = None
+        if (reader is not None and header.begin is not None
+            and header.end is not None and self.reader_state is not None
+            and self.reader_state[:2] == (0, 0)):
+            lines = reader.get_raw_lines(header.begin, header.end + 1)
+            for (k, line) in enumerate(lines):
+                if line.startswith('diff '):
+                    lines = lines[k:]
+                    break
+            else:
+                lines = None
+        if lines is None:
+            (old, new) = (header.old, header.new)
+            if old.name is None and new.name is None:
+                return ('', None)       # normal diffs and ed scripts
+            header = Header(
+                FileInfo(old.name, None, old.mode, old.copy, old.rename),
+                FileInfo(new.name, None, new.mode, new.copy, new.rename))
+            lines = header.iter_lines(len(self.hunks) > 0 and not self.binary,
+                                      True)
+        texts = [] if not diff_line else lines[:1]
+        oids = None
+        lines = iter(lines[1:])
+        for line in lines:
+            if line.startswith('index '):
+                (pre, sep, post) = line[6:].partition('..')
+                if sep:
+                    oids = pre + (post.split() or [''])[0]
+            elif (line.startswith('GIT binary patch')
+                  or line.startswith('Binary files')):
+                return (''.join(texts), oids or '')
+            elif line.startswith('--- '):
+                texts.append(line)
+                texts.append(next(lines, ''))
+                break
+            elif 'a' <= line[:1].lower() <= 'z':
+                texts.append(line)
+            else:
+                break
+        if self.binary and oids is not None:
+            return (''.join(texts), oids)
+        return (''.join(texts), None)
+
+    def interdiff(self, other, context=3):
+        """Return a patch from the result of this patch to that of
+        other, where both patches apply to the same file, as interdiff
+        does.  See combine().
+        """
+        hunks = _compose([_Edit.from_hunk(hunk).reversed()
+                          for hunk in self.hunks],
+                         [_Edit.from_hunk(hunk) for hunk in other.hunks],
+                         context)
+        return UniPatch(Header(self.header.new, other.header.new), hunks)
+
+    def apply(self, lines, max_fuzz=2):
+        """Apply the patch to a list of lines.
+
+        Each hunk is looked for at its line number (shifted by the offset
+        of the previous hunk), then at increasing distances from there,
+        and then again ignoring up to max_fuzz lines of context, with
+        the same rules as GNU patch.  Candidate positions come from an
+        index of the lines, so large files are not rescanned per hunk.
+
+        Lines are compared exactly, so a line without a newline only
+        matches one marked '\\ No newline' in the patch.  A missing
+        newline is added where GNU patch adds it, when more lines are
+        output after the line.
+
+        Returns the new list of lines and a list of HunkResult objects.
+        Failed hunks are skipped.
+        """
+        index = LineIndex(lines)
+        nlines = len(lines)
+        out = []
+        results = []
+        copied = 0              # lines[:copied] have been output
+        in_offset = 0
+        out_offset = 0
+        for number, hunk in enumerate(self.hunks, 1):
+            src = hunk.src
+            dst = hunk.dst
+            pattern = [change.text for change in src]
+            pat_lines = len(pattern)
+
+            prefix = 0
+            while (prefix < pat_lines and prefix < len(dst)
+                   and src[prefix].op == ' ' and dst[prefix].op == ' '):
+                prefix += 1
+            suffix = 0
+            while (suffix < pat_lines - prefix and suffix < len(dst) - prefix
+                   and src[-1 - suffix].op == ' '
+                   and dst[-1 - suffix].op == ' '):
+                suffix += 1
+            context = max(prefix, suffix)
+
+            first_guess = hunk.srcline - 1 + in_offset
+            where = None
+            fuzz = 0
+            while where is None and fuzz <= min(max_fuzz, context):
+                prefix_fuzz = fuzz + prefix - context
+                suffix_fuzz = fuzz + suffix - context
+                # Context lines which are ignored may lie beyond the end
+                # of the file, and the trailing context of the previous
+                # hunk may be matched again, as in GNU patch's
+                # locate_hunk().
+                hi = nlines - pat_lines + suffix_fuzz
+                lo = copied
+                if pat_lines == 0:
+                    # matches anywhere (GNU patch uses line 0 for failure)
+                    if first_guess >= 0:
+                        where = first_guess
+                elif prefix_fuzz < 0 and hunk.srcline <= 1:
+                    # can only match start of file
+                    if (copied <= prefix and hi >= 0
+                        and (suffix_fuzz >= 0 or pat_lines == nlines)):
+                        where = index.locate(pattern, 0,
+                                             pat_lines - max(suffix_fuzz, 0),
+                                             0, 0, 0)
+                elif suffix_fuzz < 0:
+                    # can only match end of file
+                    end = nlines - pat_lines
+                    if end >= lo:
+                        where = index.locate(pattern, max(prefix_fuzz, 0),
+                                             pat_lines, end, end, end)
+                else:
+                    where = index.locate(pattern, max(prefix_fuzz, 0),
+                                         pat_lines - suffix_fuzz,
+                                         first_guess, lo, hi)
+                if where is None:
+                    fuzz += 1
+
+            if where is None:
+                results.append(HunkResult(number))
+                continue
+
+            if where > copied:
+                terminate(out)
+                out.extend(lines[copied:where])
+            # Context comes from the file, as in GNU patch.  Trailing
+            # context is left to be copied with the lines after the hunk.
+            # GNU patch only ends a line before the added lines at the end
+            # of a hunk (from tail on), not before those between context.
+            tail = len(dst)
+            while tail > 0 and dst[tail - 1].op != ' ':
+                tail -= 1
+            i = 0
+            for (k, change) in enumerate(dst[:len(dst) - suffix]):
+                if change.op != ' ':
+                    if k == tail:
+                        terminate(out)
+                    out.append(change.text)
+                    continue
+                while src[i].op != ' ':
+                    i += 1
+                if copied <= where + i < nlines:
+                    terminate(out)
+                    out.append(lines[where + i])
+                i += 1
+            copied = max(copied, min(where + pat_lines - suffix, nlines))
+
+            in_offset = where - (hunk.srcline - 1)
+            results.append(HunkResult(number, where + 1 + out_offset,
+                                      in_offset, fuzz))
+            out_offset += len(dst) - pat_lines
+
+        if copied < nlines:
+            terminate(out)
+            out.extend(lines[copied:])
+        return (out, results)
+
+    def apply_tree(self, root, strip=1, max_fuzz=2, dry_run=False,
+                   encoding='utf-8'):
+        """Apply the patch to a file under the directory root.
+
+        File names are taken from the header, with strip leading
+        components removed like patch -p.  Creation, deletion, renames,
+        copies and mode changes are carried out.  If any hunk fails, the
+        file is left untouched.  Returns an ApplyResult.
+        """
+        hdr = self.header
+        old = strip_name(hdr.old.name, strip)
+        new = strip_name(hdr.new.name, strip)
+        result = ApplyResult(new if new is not None else old)
+        if result.name is None:
+            result.error = 'No file name found'
+            return result
+
+        if hdr.old.is_null():
+            source = None
+        elif new is None or hdr.new.rename or hdr.new.copy:
+            source = old
+        elif old is None or os.path.exists(os.path.join(root, new)):
+            source = new
+        else:
+            source = old
+        try:
+            if source is None:
+                lines = b'' if self.binary else []
+                if (new is not None
+                    and os.path.getsize(os.path.join(root, new)) > 0):
+                    result.error = 'File %s already exists' % (new,)
+                    return result
+            elif self.binary:
+                with open(os.path.join(root, source), 'rb') as f:
+                    lines = f.read()
+            else:
+                with open(os.path.join(root, source), newline='',
+                          encoding=encoding, errors='surrogateescape') as f:
+                    lines = f.readlines()
+        except (IOError, OSError) as e:
+            if source is not None:
+                result.error = str(e)
+                return result
+            # file to be created does not exist yet
+            lines = b'' if self.binary else []
+
+        (lines, result.hunks) = self.apply(lines, max_fuzz)
+        if result.failed or dry_run:
+            return result
+
+        try:
+            if hdr.new.is_null():
+                os.remove(os.path.join(root, source))
+                return result
+            path = os.path.join(root, new)
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmppath = path + '.orig~'
+            if self.binary:
+                with open(tmppath, 'wb') as f:
+                    f.write(lines)
+            else:
+                with open(tmppath, 'w', newline='',
+                          encoding=encoding, errors='surrogateescape') as f:
+                    f.writelines(lines)
+            if hdr.new.mode:
+                os.chmod(tmppath, hdr.new.mode & 0o7777)
+            elif os.path.exists(path):
+                os.chmod(tmppath, os.stat(path).st_mode & 0o7777)
+            os.rename(tmppath, path)
+            if hdr.new.rename and source is not None and source != new:
+                os.remove(os.path.join(root, source))
+        except (IOError, OSError) as e:
+            result.error = str(e)
+        return result
+
+    def load(self, reader, hunks=None):
+        """Load hunk bodies skipped by a headers_only parse.
+
+        The reader settings in effect when the patch was parsed are
+        restored for the duration of the call.  If hunks is given, only
+        those hunks are loaded.
+        """
+        for hunk in self.hunks if hunks is None else hunks:
+            if hunk.begin is not None:
+                hunk.load(reader, self.reader_state)
+
+def _same_header(a, b):
+    return (a.begin == b.begin and a.end == b.end and a.index == b.index
+            and all(x.name == y.name and x.timestr == y.timestr
+                    and x.mode == y.mode and x.copy == y.copy
+                    and x.rename == y.rename
+                    for (x, y) in ((a.old, b.old), (a.new, b.new))))
+
+def _patch_spans(patches):
+    return [(patch.begin, patch.end) for patch in patches]
+
+def _hunk_loaded(hunk):
+    # False for a hunk whose body was skipped by headers_only.
+    if isinstance(hunk, CompactUniHunk):
+        return len(hunk.ops) > 0
+    if isinstance(hunk, GitBinaryHunk):
+        return len(hunk.lines) > 0
+    return len(hunk.src) > 0 or len(hunk.dst) > 0
+
+def _same_hunk(a, b):
+    if (type(a) is not type(b) or a.begin != b.begin or a.end != b.end
+        or a.srcline != b.srcline or a.dstline != b.dstline
+        or a.section != b.section):
+        return False
+    if (isinstance(a, GitBinaryHunk)
+        and (a.method, a.size, a.reverse) != (b.method, b.size, b.reverse)):
+        return False
+    if not _hunk_loaded(a) or not _hunk_loaded(b):
+        return True
+    if isinstance(a, CompactUniHunk):
+        return a.ops == b.ops and a.lines == b.lines
+    if isinstance(a, GitBinaryHunk):
+        return a.lines == b.lines
+    return (len(a.src) == len(b.src) and len(a.dst) == len(b.dst)
+            and all(x.op == y.op and x.text == y.text
+                    for (x, y) in zip(a.src, b.src))
+            and all(x.op == y.op and x.text == y.text
+                    for (x, y) in zip(a.dst, b.dst)))
+
+def _patch_id(patches, reader=None, encoding=None, stable=True):
+    """Return the git patch-id of a list of patches."""
+    import hashlib
+
+    (total, digest) = (0, hashlib.sha1())
+    (diff_line, flushed) = (True, True)
+    for patch in patches:
+        diff_line = not patch.update_fingerprint(digest, reader, encoding,
+                                                 diff_line)
+        # git hashes the header of a patch without hunks (a pure rename
+        # or mode change) together with the patch that follows it.
+        flushed = not diff_line or len(patch.hunks) > 0
+        if stable and flushed:
+            total += int.from_bytes(digest.digest(), 'little')
+            digest = hashlib.sha1()
+    if not stable:
+        return digest.hexdigest()
+    if not diff_line or not flushed:
+        # git flushes a binary patch at once, and the rest at the end
+        total += int.from_bytes(digest.digest(), 'little')
+    return (total % (1 << 160)).to_bytes(20, 'little').hex()
+
+def diff_range(line, count):
+    """Return a line range as GNU diff writes it in normal and context
+    diffs and ed scripts.  An empty range is written as the line before
+    it (hunks store the line after it, see UniHunk.parse()).
+    """
+    if count == 0:
+        line -= 1
+    if count == 1 or count == 0:
+        return '%d' % (line,)
+    return '%d,%d' % (line, line + count - 1)
+
+def read_marker(reader, lines):
+    """Consume a '\\ No newline' marker after the last of lines, and
+    remove the newline it refers to.  Any other line is left unread."""
+    if reader.get_line():
+        if reader.line.startswith('\\'):
+            strip_newline(lines)
+        else:
+            reader.set_pos(reader.get_pos(-1))
+
+class NormalHunk(Hunk):
+    """Hunk of a normal diff: a command line like '5,7c5,6', the old
+    lines prefixed with '< ', a '---' line and the new lines prefixed
+    with '> '.  The counts in the command tell how many body lines to
+    read, so a body is read a block at a time.  src holds '-' changes
+    and dst '+' changes; there is no context.
+    """
+
+    __slots__ = ()
+
+    def iter_lines(self):
+        (ptrn_lines, repl_lines) = (len(self.src), len(self.dst))
+        cmd = 'a' if ptrn_lines == 0 else 'd' if repl_lines == 0 else 'c'
+        yield '%s%s%s\n' % (diff_range(self.srcline, ptrn_lines), cmd,
+                            diff_range(self.dstline, repl_lines))
+        for change in self.src:
+            for line in body_line('< ', change.text):
+                yield line
+        if ptrn_lines and repl_lines:
+            yield '---\n'
+        for change in self.dst:
+            for line in body_line('> ', change.text):
+                yield line
+
+    def read_src_count(self, reader):
+        if not reader.get_line():
+            return 0
+        match = re_cmd.match(reader.line)
+        if not match:
+            return 0
+        if match.group(2) is not None:
+            return int(match.group(2)) - int(match.group(1)) + 1
+        return 0 if match.group(3) == 'a' else 1
+
+    def parse(self, reader, headers_only=False):
+        if not reader.get_line():
+            return False
+        match = re_cmd.match(reader.line)
+        if not match:
+            reader.set_pos(reader.get_pos(-1))
+            return False
+        self.begin = reader.get_pos(-1)
+        cmd = match.group(3)
+        self.srcline = int(match.group(1))
+        ptrn_lines = match.group(2)
+        if ptrn_lines is None:
+            ptrn_lines = 0 if cmd == 'a' else 1
+        else:
+            ptrn_lines = int(ptrn_lines) - self.srcline + 1
+        self.dstline = int(match.group(4))
+        repl_lines = match.group(5)
+        if repl_lines is None:
+            repl_lines = 0 if cmd == 'd' else 1
+        else:
+            repl_lines = int(repl_lines) - self.dstline + 1
+        if ptrn_lines == 0:
+            self.srcline += 1     # append rather than insert
+        if repl_lines == 0:
+            self.dstline += 1     # append rather than insert
+
+        old = new = []
+        if ptrn_lines:
+            old = self.read_lines(reader, ptrn_lines, '< ')
+            if old is None:
+                return False
+            if repl_lines:
+                if not reader.get_line():
+                    return False
+                if reader.line.startswith('\\'):
+                    strip_newline(old)
+                    if not reader.get_line():
+                        return False
+                if reader.line != '---\n':
+                    return False
+        if repl_lines:
+            new = self.read_lines(reader, repl_lines, '> ')
+            if new is None:
+                return False
+        read_marker(reader, new or old)
+        if not headers_only:
+            self.src = [Change('-', line[2:]) for line in old]
+            self.dst = [Change('+', line[2:]) for line in new]
+        self.end = reader.get_pos(-1)
+        return True
+
+    @staticmethod
+    def read_lines(reader, count, prefix):
+        """Read count body lines which start with prefix ('< ' or '> ').
+        Returns None if there are fewer or other lines.  '\\ No newline'
+        markers within them remove the newline of the line before.
+        """
+        lines = reader.get_lines(count)
+        if len(lines) < count:
+            return None
+        heads = ''.join([line[:2] for line in lines])
+        if heads != prefix * count:
+            if '\\' in ''.join([line[0] for line in lines]):
+                # a marker is only valid after the last line
+                return None
+            # blank lines may have lost their trailing space
+            lines = [line if line.startswith(prefix)
+                     else prefix + '\n' if line == prefix[0] + '\n'
+                     else None for line in lines]
+            if None in lines:
+                return None
+        return lines
+
+class NormalPatch(Patch):
+    __slots__ = ()
+
+    diff_type = NORMAL_DIFF
+
+    def next_hunk(self, compact=False):
+        return NormalHunk()
+
+class EdHunk(Hunk):
+    """One command of an ed script, as written by diff -e: a line range
+    and a command ('a', 'c', 'd' or 'i'), followed by the new lines and
+    a '.' line for 'a', 'c' and 'i'.  A new line consisting of a '.' is
+    written as '..' and fixed with an 's/.//' command, after which an
+    'a' command without an address continues the text; all of these
+    make one hunk.
+
+    The script does not contain the lines it deletes, so src holds one
+    Change('-', None) per deleted line, and dst holds '+' changes.
+    Patch.fingerprint() skips these changes, and combine() and
+    interdiff() raise ValueError for them.
+    """
+
+    __slots__ = ()
+
+    def iter_lines(self):
+        ptrn_lines = len(self.src)
+        if ptrn_lines == 0:
+            yield '%da\n' % (self.srcline - 1,)
+        else:
+            yield '%s%s\n' % (diff_range(self.srcline, ptrn_lines),
+                              'c' if self.dst else 'd')
+        dst = self.dst
+        for (k, change) in enumerate(dst):
+            if change.text == '.\n':
+                yield '..\n'
+                yield '.\n'
+                yield 's/.//\n'
+                if k + 1 < len(dst):
+                    yield 'a\n'
+            else:
+                yield change.text
+        if dst and dst[-1].text != '.\n':
+            yield '.\n'
+
+    def parse(self, reader, headers_only=False):
+        if not reader.get_line():
+            return False
+        match = re_edcmd.match(reader.line)
+        if not match:
+            reader.set_pos(reader.get_pos(-1))
+            return False
+        self.begin = reader.get_pos(-1)
+        first = int(match.group(1))
+        last = match.group(2)
+        cmd = match.group(3)
+        if cmd in 'ai':
+            ptrn_lines = 0
+            self.srcline = first + 1 if cmd == 'a' else first
+        elif last is None:
+            ptrn_lines = 1
+            self.srcline = first
+        else:
+            ptrn_lines = int(last) - first + 1
+            self.srcline = first
+        self.dstline = self.srcline     # see EdPatch.parse()
+        self.src = [Change('-', None) for i in range(ptrn_lines)]
+        dst = self.dst = []
+        if cmd != 'd':
+            while True:
+                while True:
+                    if not reader.get_line(False):
+                        return False
+                    if reader.line == '.\n':
+                        break
+                    dst.append(Change('+', reader.line))
+                if not reader.get_line():
+                    break
+                if reader.line != 's/.//\n' or not dst:
+                    reader.set_pos(reader.get_pos(-1))
+                    break
+                dst[-1].text = dst[-1].text[1:]
+                if not reader.get_line():
+                    break
+                if reader.line != 'a\n':
+                    reader.set_pos(reader.get_pos(-1))
+                    break
+        self.end = reader.get_pos(-1)
+        return True
+
+    def reversed(self):
+        """Raise ValueError: an ed script does not contain the lines it
+        deletes, so it cannot be reversed without the original file.
+        """
+        raise ValueError('Cannot reverse an ed script')
+
+class EdPatch(Patch):
+    """Ed script.  diff -e writes the commands from the end of the file
+    to its beginning, so each one applies to original line numbers.
+    """
+
+    __slots__ = ()
+
+    diff_type = ED_DIFF
+
+    def parse(self, reader, headers_only=False, compact=False):
+        """Construct the patch from a Reader (see Patch.parse()).  Ed
+        hunks are always read in full, as their text has no count.
+        """
+        Patch.parse(self, reader, headers_only, compact)
+        offset = 0
+        for hunk in reversed(self.hunks):
+            hunk.dstline = hunk.srcline + offset
+            offset += len(hunk.dst) - len(hunk.src)
+
+    def apply(self, lines, max_fuzz=2):
+        """Apply the script to a list of lines, like ed would.
+
+        There is no context to check, so max_fuzz is ignored, and a hunk
+        only fails if it is beyond the end of the file or out of order.
+        Returns the new list of lines and a list of HunkResult objects.
+        """
+        out = []
+        results = [None] * len(self.hunks)
+        copied = 0
+        for (number, hunk) in reversed(list(enumerate(self.hunks, 1))):
+            start = hunk.srcline - 1
+            end = start + len(hunk.src)
+            if start < copied or end > len(lines):
+                results[number - 1] = HunkResult(number)
+                continue
+            out.extend(lines[copied:start])
+            results[number - 1] = HunkResult(number, len(out) + 1)
+            out.extend([change.text for change in hunk.dst])
+            copied = end
+        out.extend(lines[copied:])
+        return (out, results)
+
+    def next_hunk(self, compact=False):
+        return EdHunk()
+
+def strip_newline(lines):
+    # Apply a '\ No newline at end of file' marker to the last line.
+    if lines and lines[-1].endswith('\n'):
+        lines[-1] = lines[-1][:-1]
+
+def body_line(op, text):
+    # A line of a hunk body as a list, with a marker if the text has no
+    # newline at its end.
+    if text.endswith('\n'):
+        return [op + text]
+    return [op + text + '\n', '\\ No newline at end of file\n']
+
+class UniHunk(Hunk):
+    __slots__ = ()
+
+    def iter_lines(self):
+        yield self.header_line(len(self.src), len(self.dst))
+        for (op, change) in self.iter_changes():
+            for line in body_line(op, change.text):
+                yield line
+
+    def header_line(self, ptrn_lines, repl_lines):
+        """Return the @@ line for the given line counts."""
+        def span(line, count):
+            if count == 0:
+                line -= 1     # see parse()
+            if count == 1:
+                return '%d' % (line,)
+            return '%d,%d' % (line, count)
+        line = '@@ -%s +%s @@' % (span(self.srcline, ptrn_lines),
+                                  span(self.dstline, repl_lines))
+        if self.section is not None:
+            line += ' ' + self.section
+        return line + '\n'
+
+    def read_src_count(self, reader):
+        if not reader.get_line():
+            return 0
+        match = re_unihunk.match(reader.line)
+        if not match:
+            return 0
+        return 1 if match.group(2) is None else int(match.group(2))
+
+    def parse(self, reader, headers_only=False):
+        if not reader.get_line():
+            return False
+        match = re_unihunk.match(reader.line)
+        if not match:
+            reader.set_pos(reader.get_pos(-1))
+            return False
+        self.begin = reader.get_pos(-1)
+        self.srcline = int(match.group(1))
+        ptrn_lines = match.group(2)
+        if ptrn_lines is None:
+            ptrn_lines = 1
+        else:
+            ptrn_lines = int(ptrn_lines)
+            if ptrn_lines == 0:
+                self.srcline += 1     # append rather than insert
+        self.dstline = int(match.group(3))
+        repl_lines = match.group(4)
+        if repl_lines is None:
+            repl_lines = 1
+        else:
+            repl_lines = int(repl_lines)
+            if repl_lines == 0:
+                self.dstline += 1     # append rather than insert
+        self.section = match.group(5)
+        if headers_only:
+            ok = self.skip_body(reader, ptrn_lines, repl_lines)
+        else:
+            ok = self.parse_body(reader, ptrn_lines, repl_lines)
+        if not ok:
+            return False
+        self.end = reader.get_pos(-1)
+        return True
+
+    def parse_body(self, reader, ptrn_lines, repl_lines):
+        src = self.src = []
+        dst = self.dst = []
+        last = None             # the last body line read
+        while ptrn_lines > 0 or repl_lines > 0:
+            (start, lines) = self.next_lines(reader, ptrn_lines, repl_lines)
+            counts = self.count_lines(lines, ptrn_lines, repl_lines)
+            if counts is not None:
+                (removed, added) = counts[1:]
+                context = len(lines) - removed - added
+                ptrn_lines -= removed + context
+                repl_lines -= added + context
+                changes = [Change(line[0], line[1:]) for line in lines]
+                if added == 0:
+                    src.extend(changes)
+                    dst.extend([c for c in changes if c.op == ' '])
+                elif removed == 0:
+                    src.extend([c for c in changes if c.op == ' '])
+                    dst.extend(changes)
+                else:
+                    src.extend([c for c in changes if c.op != '+'])
+                    dst.extend([c for c in changes if c.op != '-'])
+                last = changes[-1]
+                continue
+
+            for (k, line) in enumerate(lines):
+                if line is None:
+                    if repl_lines >= 3:
+                        break        # unexpected EOF
+                    line = ' \n'     # assume blank lines got chopped
+
+                ch = line[0]
+                if ch == '-':
+                    if ptrn_lines <= 0:
+                        break
+                    ptrn_lines -= 1
+
+                    change = Change(ch, line[1:])
+                    src.append(change)
+                    last = change
+                elif ch in ' =\t\n':
+                    if ptrn_lines <= 0 or repl_lines <= 0:
+                        break
+                    ptrn_lines -= 1
+                    repl_lines -= 1
+
+                    if ch in '\t\n':
+                        # assume the space got eaten
+                        change = Change(' ', line)
+                    else:
+                        change = Change(' ', line[1:])
+                    src.append(change)
+                    dst.append(change)
+                    last = change
+                elif ch == '+':
+                    if repl_lines <= 0:
+                        break
+                    repl_lines -= 1
+
+                    change = Change(ch, line[1:])
+                    dst.append(change)
+                    last = change
+                elif ch == '\\' and last is not None:
+                    # '\ No newline at end of file' for the line before
+                    if last.text.endswith('\n'):
+                        last.text = last.text[:-1]
+                else:
+                    break
+            else:
+                continue
+            return self.unread(reader, start, k)
+        if last is not None and self.skip_marker(reader):
+            if last.text.endswith('\n'):
+                last.text = last.text[:-1]
+        return True
+
+    @staticmethod
+    def next_lines(reader, ptrn_lines, repl_lines):
+        """Return the reader position and the next block of body lines.
+
+        The body has at least max(ptrn_lines, repl_lines) more lines, so
+        a block of that size never reads past the hunk.  A line which
+        get_line() could not read is returned as None.
+        """
+        start = reader.get_pos()
+        count = max(ptrn_lines, repl_lines)
+        lines = reader.get_lines(count)
+        if len(lines) < count:
+            lines.append(None)
+        return (start, lines)
+
+    @staticmethod
+    def count_lines(lines, ptrn_lines, repl_lines):
+        """Check a block of body lines as a whole.
+
+        Returns the first characters of the lines and the number of
+        removed and added lines if the block contains only ' ', '-' and
+        '+' lines within the remaining counts; these are valid in any
+        order.  Returns None for anything else (a missing line, chopped
+        blank lines, bad lines), which the line by line loop handles.
+        """
+        if not lines or lines[-1] is None:
+            return None
+        heads = ''.join([line[0] for line in lines])
+        removed = heads.count('-')
+        added = heads.count('+')
+        context = len(lines) - removed - added
+        if (heads.count(' ') != context
+            or removed + context > ptrn_lines
+            or added + context > repl_lines):
+            return None
+        return (heads, removed, added)
+
+    @staticmethod
+    def skip_marker(reader):
+        """Consume a '\\ No newline' marker after the body, and return
+        whether there was one.  Any other line is left unread."""
+        if reader.get_line(False):
+            if reader.line.startswith('\\'):
+                return True
+            reader.set_pos(reader.get_pos(-1))
+        return False
+
+    @staticmethod
+    def unread(reader, start, k):
+        """Leave the reader after line k of the block read from start,
+        where reading line by line would have stopped, and fail."""
+        reader.set_pos(start)
+        while k >= 0:
+            reader.get_line()
+            k -= 1
+        return False
+
+    def skip_body(self, reader, ptrn_lines, repl_lines):
+        # Same checks as parse_body(), but nothing is stored: blocks of
+        # lines are checked by their first characters (see
+        # Reader.get_heads()), and only the rest go line by line.
+        started = False
+        while ptrn_lines > 0 or repl_lines > 0:
+            start = reader.get_pos()
+            heads = reader.get_heads(max(ptrn_lines, repl_lines))
+            if heads:
+                removed = heads.count('-')
+                added = heads.count('+')
+                context = len(heads) - removed - added
+                if (heads.count(' ') == context
+                    and removed + context <= ptrn_lines
+                    and added + context <= repl_lines):
+                    ptrn_lines -= removed + context
+                    repl_lines -= added + context
+                    started = True
+                    continue
+            reader.set_pos(start)
+
+            (start, lines) = self.next_lines(reader, ptrn_lines, repl_lines)
+            for (k, line) in enumerate(lines):
+                if line is None:
+                    if repl_lines >= 3:
+                        break        # unexpected EOF
+                    ch = ' '         # assume blank lines got chopped
+                else:
+                    ch = line[0]
+
+                if ch == '-':
+                    if ptrn_lines <= 0:
+                        break
+                    ptrn_lines -= 1
+                elif ch in ' =\t\n':
+                    if ptrn_lines <= 0 or repl_lines <= 0:
+                        break
+                    ptrn_lines -= 1
+                    repl_lines -= 1
+                elif ch == '+':
+                    if repl_lines <= 0:
+                        break
+                    repl_lines -= 1
+                elif ch != '\\' or not started:
+                    break
+                started = True
+            else:
+                continue
+            return self.unread(reader, start, k)
+        if started:
+            self.skip_marker(reader)
+        return True
+
+_flip_ops = { ord('-'): '+', ord('+'): '-' }
+
+class ChangeView(object):
+    """Read-only sequence of Change objects over a compact hunk body.
+
+    Each access creates new Change objects with the op and text of the
+    line, so changing them does not change the hunk, and context lines
+    are not shared with the other side.
+    """
+
+    __slots__ = [ 'ops', 'lines', 'skip', 'index' ]
+
+    def __init__(self, ops, lines, skip):
+        self.ops = ops
+        self.lines = lines
+        self.skip = skip
+        self.index = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self.ops) - self.ops.count(self.skip)
+
+    def __iter__(self):
+        skip = self.skip
+        for op, text in zip(self.ops, self.lines):
+            if op != skip:
+                yield Change(op, text)
+
+    def __getitem__(self, i):
+        if self.index is None:
+            skip = self.skip
+            self.index = [k for k, op in enumerate(self.ops) if op != skip]
+        if isinstance(i, slice):
+            return [Change(self.ops[k], self.lines[k]) for k in self.index[i]]
+        k = self.index[i]
+        return Change(self.ops[k], self.lines[k])
+
+class CompactUniHunk(UniHunk):
+    """Unified hunk which stores its body as one op character per line
+    (' ', '-' or '+') in ops, and the line texts in lines, instead of
+    a Change object per line.  src and dst are views over them.
+    """
+
+    __slots__ = [ 'ops', 'lines' ]
+
+    def __init__(self, srcline=None, dstline=None, section=None,
+                 ops='', lines=None):
+        self.srcline = srcline
+        self.dstline = dstline
+        self.section = section
+        self.ops = ops
+        self.lines = [] if lines is None else lines
+        self.begin = self.end = None
+
+    def __repr__(self):
+        return '%s(srcline=%s, dstline=%s, section=%s, ops=%s, lines=%s)' % (
+            self.__class__.__name__, repr(self.srcline), repr(self.dstline),
+            repr(self.section), repr(self.ops), repr(self.lines))
+
+    def __getstate__(self):
+        # src and dst are views, not state
+        return (None, dict((name, getattr(self, name)) for name in (
+            'srcline', 'dstline', 'section', 'ops', 'lines', 'begin', 'end')))
+
+    def iter_lines(self):
+        yield self.header_line(len(self.ops) - self.ops.count('+'),
+                               len(self.ops) - self.ops.count('-'))
+        for (op, text) in zip(self.ops, self.lines):
+            for line in body_line(op, text):
+                yield line
+
+    def reversed(self):
+        """Return the hunk with its two sides swapped.  The list of
+        lines is shared unless lines need to be reordered so that
+        removed lines come first again.
+        """
+        ops = self.ops.translate(_flip_ops)
+        lines = self.lines
+        if '+-' in ops:
+            (runs, new_lines) = ([], [])
+            for match in re_opruns.finditer(ops):
+                (run, body) = (match.group(), lines[match.start():match.end()])
+                if run[0] == ' ':
+                    new_lines.extend(body)
+                else:
+                    new_lines.extend([line for (op, line) in zip(run, body)
+                                      if op == '-'])
+                    new_lines.extend([line for (op, line) in zip(run, body)
+                                      if op == '+'])
+                    run = '-' * run.count('-') + '+' * run.count('+')
+                runs.append(run)
+            (ops, lines) = (''.join(runs), new_lines)
+        return CompactUniHunk(self.dstline, self.srcline, self.section,
+                              ops, lines)
+
+    @property
+    def src(self):
+        return ChangeView(self.ops, self.lines, '+')
+
+    @property
+    def dst(self):
+        return ChangeView(self.ops, self.lines, '-')
+
+    def parse_body(self, reader, ptrn_lines, repl_lines):
+        ops = []
+        lines = self.lines = []
+        self.ops = ''
+        while ptrn_lines > 0 or repl_lines > 0:
+            (start, body) = self.next_lines(reader, ptrn_lines, repl_lines)
+            counts = self.count_lines(body, ptrn_lines, repl_lines)
+            if counts is not None:
+                (heads, removed, added) = counts
+                context = len(body) - removed - added
+                ptrn_lines -= removed + context
+                repl_lines -= added + context
+                ops.append(heads)
+                lines.extend([line[1:] for line in body])
+                continue
+
+            for (k, line) in enumerate(body):
+                if line is None:
+                    if repl_lines >= 3:
+                        break        # unexpected EOF
+                    line = ' \n'     # assume blank lines got chopped
+
+                ch = line[0]
+                if ch == '-':
+                    if ptrn_lines <= 0:
+                        break
+                    ptrn_lines -= 1
+                    ops.append(ch)
+                    lines.append(line[1:])
+                elif ch in ' =\t\n':
+                    if ptrn_lines <= 0 or repl_lines <= 0:
+                        break
+                    ptrn_lines -= 1
+                    repl_lines -= 1
+                    ops.append(' ')
+                    if ch in '\t\n':
+                        # assume the space got eaten
+                        lines.append(line)
+                    else:
+                        lines.append(line[1:])
+                elif ch == '+':
+                    if repl_lines <= 0:
+                        break
+                    repl_lines -= 1
+                    ops.append(ch)
+                    lines.append(line[1:])
+                elif ch == '\\' and lines:
+                    # '\ No newline at end of file' for the line before
+                    strip_newline(lines)
+                else:
+                    break
+            else:
+                continue
+            return self.unread(reader, start, k)
+        if lines and self.skip_marker(reader):
+            strip_newline(lines)
+        self.ops = ''.join(ops)
+        return True
+
+class UniPatch(Patch):
+    __slots__ = ()
+
+    diff_type = UNI_DIFF
+
+    def next_hunk(self, compact=False):
+        return CompactUniHunk() if compact else UniHunk()
+
+def context_range(match):
+    """Return the first line and the line count of a *** or --- range
+    of a context hunk.  A single number is one line, or none for 0; it
+    is also written for an empty range after a line (see ContextHunk).
+    """
+    first = int(match.group(1))
+    last = match.group(2)
+    if last is None:
+        return (first, 1 if first else 0)
+    return (first, int(last) - first + 1)
+
+class ContextHunk(Hunk):
+    """Hunk of a context diff: a *** range and the old lines, then
+    a --- range and the new lines.  Either section is left out if it
+    contains only context.
+
+    The hunk is read in one pass, each section a block at a time.
+    Removed and changed ('!') lines of the old section become '-'
+    changes in src, added and changed lines of the new section '+'
+    changes in dst, and context lines are shared by src and dst, as in
+    UniHunk.
+    """
+
+    __slots__ = ()
+
+    range_marks = ('', '')  # after the *** and --- ranges
+
+    def read_src_count(self, reader):
+        if not reader.get_line():
+            return 0
+        if reader.line.startswith('********') and not reader.get_line():
+            return 0
+        match = re_ctxold.match(reader.line)
+        if not match:
+            return 0
+        return context_range(match)[1]
+
+    def parse(self, reader, headers_only=False):
+        if not reader.get_line():
+            return False
+        start = reader.get_pos(-1)
+        if reader.line.startswith('********') and not reader.get_line():
+            return False
+        match = re_ctxold.match(reader.line)
+        if not match:
+            reader.set_pos(start)
+            return False
+        (srcline, ptrn_lines) = context_range(match)
+
+        if not reader.get_line():
+            return False
+        old = None
+        if not reader.line.startswith('--- '):
+            old = self.read_section(reader, ptrn_lines, '-')
+            if old is None or not self.skip_markers(reader, old[1]):
+                return False
+        match = re_ctxnew.match(reader.line)
+        if not match:
+            return False
+        (dstline, repl_lines) = context_range(match)
+
+        new = None
+        if reader.get_line():
+            line = reader.line
+            if line[:1] in ' +!' and line[1:2] in (' ', '\t'):
+                new = self.read_section(reader, repl_lines, '+')
+                if new is None:
+                    return False
+                if reader.get_line():
+                    if reader.line.startswith('\\'):
+                        strip_newline(new[1])
+                    else:
+                        reader.set_pos(reader.get_pos(-1))
+            else:
+                reader.set_pos(reader.get_pos(-1))
+        if old is None and new is None:
+            return False
+
+        # A section which is left out has the context of the other one.
+        if old is None:
+            ptrn_lines = new[0].count(' ')
+        elif new is None:
+            repl_lines = old[0].count(' ')
+        if ptrn_lines == 0:
+            srcline += 1      # append rather than insert
+        if repl_lines == 0:
+            dstline += 1      # append rather than insert
+        self.begin = start
+        self.srcline = srcline
+        self.dstline = dstline
+        if not headers_only:
+            if old is not None:
+                src = [Change(' ' if head == ' ' else '-', line[2:])
+                       for (head, line) in zip(*old)]
+                context = [change for change in src if change.op == ' ']
+            if new is not None:
+                if old is None:
+                    context = [Change(' ', line[2:])
+                               for (head, line) in zip(*new) if head == ' ']
+                elif len(context) != new[0].count(' '):
+                    return False
+                it = iter(context)
+                dst = [next(it) if head == ' ' else Change('+', line[2:])
+                       for (head, line) in zip(*new)]
+            else:
+                dst = context
+            self.src = src if old is not None else context
+            self.dst = dst
+        self.end = reader.get_pos(-1)
+        return True
+
+    @staticmethod
+    def read_section(reader, count, op):
+        """Read the count lines of a section, the first of which is in
+        reader.line.  Returns their first characters and the lines in
+        '<op> <text>' form, or None if they are not valid lines of the
+        section (op and '!' changes, or context).
+
+        '\\ No newline' markers are dropped with the newline of the
+        line before them.
+        """
+        lines = [reader.line]
+        while len(lines) < count:
+            block = reader.get_lines(count - len(lines))
+            if not block:
+                return None
+            for line in block:
+                if line.startswith('\\'):
+                    strip_newline(lines)
+                else:
+                    lines.append(line)
+        seps = ''.join([line[1:2] for line in lines])
+        if seps.count(' ') + seps.count('\t') != len(lines):
+            # blank context lines may have lost their spaces
+            lines = [line if line[1:2] in (' ', '\t')
+                     else '  \n' if line == '\n'
+                     else line[0] + ' \n' if line[1:] == '\n'
+                     else None for line in lines]
+            if None in lines:
+                return None
+        heads = ''.join([line[0] for line in lines])
+        if heads.count(' ') + heads.count(op) + heads.count('!') != count:
+            return None
+        return (heads, lines)
+
+    @staticmethod
+    def skip_markers(reader, lines):
+        """Read the line after a section, skipping a '\\ No newline'
+        marker for its last line."""
+        if not reader.get_line():
+            return False
+        if reader.line.startswith('\\'):
+            strip_newline(lines)
+            return reader.get_line()
+        return True
+
+    def iter_lines(self):
+        (old, new, run) = ([], [], [])
+        def flush():
+            mark = '!' if len(set(op for (op, change) in run)) > 1 else None
+            old.extend([(mark or op, change) for (op, change) in run
+                        if op == '-'])
+            new.extend([(mark or op, change) for (op, change) in run
+                        if op == '+'])
+            del run[:]
+        for (op, change) in self.iter_changes():
+            if op != ' ':
+                run.append((op, change))
+                continue
+            flush()
+            old.append((op, change))
+            new.append((op, change))
+        flush()
+
+        yield '***************\n'
+        for (prefix, line, count, mark, section) in (
+                ('***', self.srcline, len(self.src), self.range_marks[0], old),
+                ('---', self.dstline, len(self.dst), self.range_marks[1], new)):
+            yield '%s %s%s\n' % (prefix, diff_range(line, count), mark)
+            if any(op != ' ' for (op, change) in section):
+                for (op, change) in section:
+                    for line in body_line(op + ' ', change.text):
+                        yield line
+
+class ContextPatch(Patch):
+    __slots__ = ()
+
+    diff_type = CONTEXT_DIFF
+    file_prefixes = ('***', '---')
+
+    def next_hunk(self, compact=False):
+        return ContextHunk()
+
+class NewContextHunk(ContextHunk):
+    """Hunk of a new-style context diff, as written by diff -c, with
+    '*** a,b ****' and '--- c,d ----' ranges.
+    """
+
+    __slots__ = ()
+
+    range_marks = (' ****', ' ----')
+
+class NewContextPatch(Patch):
+    __slots__ = ()
+
+    diff_type = NEW_CONTEXT_DIFF
+    file_prefixes = ('***', '---')
+
+    def next_hunk(self, compact=False):
+        return NewContextHunk()
+
+def _binary_line_length(line):
+    # The number of bytes a line of a git binary hunk encodes, from its
+    # first character: A-Z for 1-26, a-z for 27-52.
+    c = line[:1]
+    if 'A' <= c <= 'Z':
+        return ord(c) - ord('A') + 1
+    if 'a' <= c <= 'z':
+        return ord(c) - ord('a') + 27
+    return None
+
+def _b85_lines(lines, batch=1024):
+    """Decode the base85 lines of a git binary hunk and yield the data
+    in pieces.  Full lines are decoded batch lines at a time.
+    """
+    import base64
+
+    full = []
+    for line in lines:
+        length = _binary_line_length(line)
+        if length is None or len(line) != (length + 3) // 4 * 5 + 1:
+            raise ValueError('Corrupt binary patch line %r' % (line,))
+        if length == 52:
+            full.append(line[1:])
+            if len(full) < batch:
+                continue
+        if full:
+            yield base64.b85decode(''.join(full))
+            full = []
+        if length < 52:
+            yield base64.b85decode(line[1:])[:length]
+    if full:
+        yield base64.b85decode(''.join(full))
+
+def _delta_varint(delta, pos):
+    # A size in the header of a git delta: 7 bits per byte, low first.
+    value = shift = 0
+    while True:
+        byte = delta[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (value, pos)
+
+def _apply_delta(source, delta):
+    """Apply a git delta to the bytes of source and return the result
+    as a bytearray.
+
+    Copy instructions are carried out with memoryview slices, so the
+    only copy of the data made is into the result.
+    """
+    try:
+        (size, pos) = _delta_varint(delta, 0)
+        if size != len(source):
+            raise ValueError('Delta does not apply to a file of %d bytes'
+                             % (len(source),))
+        (size, pos) = _delta_varint(delta, pos)
+        result = bytearray(size)
+        source = memoryview(source)
+        delta = memoryview(delta)
+        out = 0
+        while pos < len(delta):
+            cmd = delta[pos]
+            pos += 1
+            if cmd & 0x80:
+                (offset, length) = (0, 0)
+                for bit in range(4):
+                    if cmd & (1 << bit):
+                        offset |= delta[pos] << (8 * bit)
+                        pos += 1
+                for bit in range(3):
+                    if cmd & (0x10 << bit):
+                        length |= delta[pos] << (8 * bit)
+                        pos += 1
+                if length == 0:
+                    length = 0x10000
+                if offset + length > len(source):
+                    raise ValueError('Delta copies beyond the source')
+                chunk = source[offset:offset + length]
+            elif cmd:
+                (chunk, length) = (delta[pos:pos + cmd], cmd)
+                pos += cmd
+            else:
+                raise ValueError('Unexpected delta opcode 0')
+            if out + length > size or len(chunk) != length:
+                raise ValueError('Corrupt delta')
+            result[out:out + length] = chunk
+            out += length
+    except IndexError:
+        raise ValueError('Truncated delta')
+    if out != size:
+        raise ValueError('Corrupt delta')
+    return result
+
+class GitBinaryHunk(Hunk):
+    """One hunk of a git binary patch: the new file contents ('literal')
+    or a delta against the old ones ('delta'), zlib-compressed and
+    base85-encoded in lines.  A patch has a forward hunk, and usually
+    a reverse one which turns the new file back into the old.
+
+    size is the size of the inflated data, and lines are the encoded
+    lines without their newlines.  src and dst are empty.
+    """
+
+    __slots__ = [ 'method', 'size', 'lines', 'reverse' ]
+
+    def __init__(self, method=None, size=None, lines=None, reverse=False):
+        Hunk.__init__(self)
+        self.method = method
+        self.size = size
+        self.lines = [] if lines is None else lines
+        self.reverse = reverse
+
+    def __repr__(self):
+        return '%s(method=%s, size=%s, lines=<%d lines>, reverse=%s)' % (
+            self.__class__.__name__, repr(self.method), repr(self.size),
+            len(self.lines), repr(self.reverse))
+
+    def parse(self, reader, headers_only=False):
+        if not reader.get_line(False):
+            return False
+        start = reader.get_pos(-1)
+        self.reverse = not reader.line.startswith('GIT binary patch')
+        if not self.reverse and not reader.get_line(False):
+            return False
+        match = re_binhunk.match(reader.line)
+        if not match:
+            reader.set_pos(start)
+            return False
+        self.begin = start
+        self.method = match.group(1)
+        self.size = int(match.group(2))
+        lines = self.lines = []
+        while reader.get_line(False):
+            line = reader.line.rstrip('\r\n')
+            if not line:
+                break
+            if not headers_only:
+                lines.append(line)
+        self.end = reader.get_pos(-1)
+        return True
+
+    def iter_lines(self):
+        if not self.reverse:
+            yield 'GIT binary patch\n'
+        yield '%s %d\n' % (self.method, self.size)
+        for line in self.lines:
+            yield line + '\n'
+        yield '\n'
+
+    def reversed(self):
+        return GitBinaryHunk(self.method, self.size, self.lines,
+                             not self.reverse)
+
+    def iter_data(self):
+        """Decode and inflate the hunk, and yield the data in pieces.
+        Only one piece of the encoded and the inflated data is held in
+        memory at a time.
+        """
+        import zlib
+
+        inflate = zlib.decompressobj()
+        try:
+            for piece in _b85_lines(self.lines):
+                data = inflate.decompress(piece)
+                if data:
+                    yield data
+            data = inflate.flush()
+        except zlib.error as e:
+            raise ValueError('Corrupt binary patch: %s' % (e,))
+        if data:
+            yield data
+        if not inflate.eof:
+            raise ValueError('Truncated binary patch')
+
+    def data(self):
+        """Return the decoded and inflated data of the hunk as a
+        bytearray, which is not copied again.
+        """
+        data = bytearray()
+        for piece in self.iter_data():
+            data += piece
+            if len(data) > self.size:
+                break
+        if len(data) != self.size:
+            raise ValueError('Binary patch has %d bytes instead of %d'
+                             % (len(data), self.size))
+        return data
+
+    def apply(self, source):
+        """Return the file patched from source, as a bytearray."""
+        if self.method == 'literal':
+            return self.data()
+        return _apply_delta(source, self.data())
+
+class GitBinaryPatch(Patch):
+    """Git binary patch.  It applies to the contents of a file as bytes
+    rather than to a list of lines.  The index hashes in the header are
+    not checked.
+    """
+
+    __slots__ = ()
+
+    diff_type = GIT_BINARY_DIFF
+    binary = True
+
+    def apply(self, data, max_fuzz=2):
+        """Apply the forward hunk to data (bytes).
+
+        Returns the new data and a list with one HunkResult.  If the
+        hunk does not apply, data is returned unchanged.
+        """
+        hunks = [hunk for hunk in self.hunks if not hunk.reverse]
+        if not hunks:
+            return (data, [HunkResult(1)])
+        try:
+            return (hunks[0].apply(data), [HunkResult(1, 1)])
+        except ValueError:
+            return (data, [HunkResult(1)])
+
+    def reversed(self):
+        """Return the reverse patch (see Patch.reversed()).  This needs
+        the reverse hunk, which old versions of git did not write.
+        """
+        if not any(hunk.reverse for hunk in self.hunks):
+            raise ValueError('Binary patch has no reverse hunk')
+        header = Header(self.header.new, self.header.old, self.header.index)
+        return GitBinaryPatch(header, [hunk.reversed()
+                                       for hunk in reversed(self.hunks)])
+
+    def next_hunk(self, compact=False):
+        return GitBinaryHunk()
 
 class FileHeader(object):
+    __slots__ = [ 'lines' ]
+
     def __init__(self, lines=None):
         if lines is None:
             self.lines = []
@@ -499,25 +2708,257 @@ class FileHeader(object):
     def __repr__(self):
         return '%s(lines=%s)' % (self.__class__.__name__, repr(self.lines))
 
+# Line classes for the header scanner in PatchFile.next_patch.
+(_SCAN_OLD, _SCAN_NEW, _SCAN_GIT, _SCAN_CMD, _SCAN_CONTEXT, _SCAN_INDEX,
+ _SCAN_PREREQ) = range(7)
+
+@functools.lru_cache(maxsize=None)
+def _scan_table(diff_type):
+    """Return the header scanner setup for diff_type.
+
+    The table maps the first character of a line to the only branch of
+    the scanner which can match it; all other lines are skipped with a
+    single lookup.  The flags tell which diff types may be detected.
+    """
+    normal = diff_type in (ANY_DIFF, NORMAL_DIFF)
+    ed = diff_type in (ANY_DIFF, ED_DIFF)
+    context = diff_type in (ANY_DIFF, CONTEXT_DIFF, NEW_CONTEXT_DIFF)
+    unified = diff_type in (ANY_DIFF, UNI_DIFF)
+
+    table = { '-': _SCAN_OLD, '+': _SCAN_NEW,
+              'I': _SCAN_INDEX, 'P': _SCAN_PREREQ }
+    if normal or ed:
+        for c in '0123456789':
+            table[c] = _SCAN_CMD
+    if context:
+        table['*'] = _SCAN_CONTEXT
+    if unified:
+        # diff --git and its extended headers.
+        for c in 'dinorcG':
+            table[c] = _SCAN_GIT
+    return (table, normal, ed, context, unified)
+
+class ParseStats(object):
+    """Counters and cumulative times of a parse, collected by passing
+    an instance to PatchFile(stats=...).  A PatchFile without one runs
+    no instrumentation code.
+
+    Lines and times are kept per phase:
+
+    header       scanning for patch headers (PatchFile.scan_patch())
+    hunks        parsing hunks (Patch.parse())
+    names        file names, with C string unescaping
+    timestamps   FileInfo.set_timestr(); the time stamps themselves are
+                 parsed on first access, after the parse
+    seeks        seeking in the file of a FileReader (Reader.set_pos());
+                 other readers only set a line number
+
+    names, timestamps and seeks happen within header and hunks, and are
+    included in their times, too.  Only header and hunks count lines.
+    seeks is the number of set_pos() calls, backtracks the number of
+    those which go back, and bytes the size of the input consumed: the
+    offsets of a FileReader or MmapReader, or the UTF-8 encoded lines
+    of other readers.
+    """
+
+    phases = ('header', 'hunks', 'names', 'timestamps', 'seeks')
+
+    def __init__(self):
+        import time
+
+        self.clock = time.perf_counter
+        self.patches = 0
+        self.hunks = 0
+        self.bytes = 0
+        self.seeks = 0
+        self.backtracks = 0
+        self.lines = dict.fromkeys(('header', 'hunks'), 0)
+        self.times = dict.fromkeys(self.phases, 0.0)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.as_dict())
+
+    def as_dict(self):
+        """Return all counters in a flat dict, with keys like
+        'lines.header' and 'time.hunks' (in seconds) for the phases.
+        """
+        result = dict(patches=self.patches, hunks=self.hunks,
+                      bytes=self.bytes, seeks=self.seeks,
+                      backtracks=self.backtracks)
+        for (phase, count) in self.lines.items():
+            result['lines.' + phase] = count
+        for (phase, seconds) in self.times.items():
+            result['time.' + phase] = seconds
+        return result
+
+    def merge(self, other):
+        """Add the counters of another ParseStats to these."""
+        self.patches += other.patches
+        self.hunks += other.hunks
+        self.bytes += other.bytes
+        self.seeks += other.seeks
+        self.backtracks += other.backtracks
+        for phase in self.lines:
+            self.lines[phase] += other.lines[phase]
+        for phase in self.times:
+            self.times[phase] += other.times[phase]
+
+    def timed(self, phase, func, *args):
+        """Call func(*args) and add its time to phase."""
+        start = self.clock()
+        try:
+            return func(*args)
+        finally:
+            self.times[phase] += self.clock() - start
+
+    def seek(self, old, new):
+        """Count a Reader.set_pos() call from line old to line new."""
+        self.seeks += 1
+        if new < old:
+            self.backtracks += 1
+
+    def next_patch(self, patchfile, reader, need_header):
+        """PatchFile.next_patch(), instrumented."""
+        clock = self.clock
+        times = self.times
+        saved = reader.stats
+        reader.stats = self
+        try:
+            begin = end = reader.get_pos()
+            patch = None
+            while patch is None:
+                scan = reader.get_pos()
+                start = clock()
+                found = patchfile.scan_patch(reader, need_header)
+                middle = clock()
+                times['header'] += middle - start
+                if found is None:
+                    end = reader.get_pos()
+                    self.lines['header'] += end - scan
+                    return None
+                (patch, start) = found
+                self.lines['header'] += start - scan
+                patch = patchfile.parse_patch(reader, patch, start)
+                times['hunks'] += clock() - middle
+                end = reader.get_pos()
+                self.lines['hunks'] += end - start
+        finally:
+            reader.stats = saved
+            self.bytes += self.count_bytes(reader, begin, end)
+        self.patches += 1
+        self.hunks += len(patch.hunks)
+        return patch
+
+    @staticmethod
+    def count_bytes(reader, start, end):
+        """Return the size of lines start to end (exclusive)."""
+        if start >= end:
+            return 0
+        line2pos = getattr(reader, 'line2pos', None)
+        if line2pos is not None and end < len(line2pos):
+            return line2pos[end] - line2pos[start]
+        pos = reader.get_pos()
+        lines = reader.get_raw_lines(start, end)
+        reader.set_pos(pos)
+        return sum(len(line.encode('utf-8', 'surrogateescape'))
+                   for line in lines)
+
 class PatchFile(object):
-    def __init__(self, reader, diff_type=ANY_DIFF, need_header=True):
+    # The (begin, end) positions of all patches parsed from the input,
+    # when known; write() leaves them out of the text between patches.
+    spans = None
+
+    def __init__(self, reader=None, diff_type=ANY_DIFF, need_header=True,
+                 headers_only=False, compact=False, stats=None):
         self.diff_type = diff_type
+        self.stats = stats
+        self.headers_only = headers_only
+        self.compact = compact
         self.header = None
+        # The revision of the last Prereq: line found, if any.
+        self.revision = None
         self.patches = []
+        if reader is not None:
+            self.patches.extend(self.iter_patches(reader, need_header))
+            self.spans = _patch_spans(self.patches)
+
+    def iter_patches(self, reader, need_header=True):
+        """Parse patches from a Reader and yield them one by one.
+
+        Patches are not added to self.patches, so memory use does not
+        grow with the input.  The file header is available in self.header
+        as soon as the first patch has been yielded.
+        """
         startpos = reader.get_pos()
-        while self.add_patch(reader, need_header):
+        patch = self.next_patch(reader, need_header)
+        while patch is not None:
             if self.header is None:
                 self.header = FileHeader(
-                    reader.get_raw_lines(startpos,
-                                         self.patches[-1].header.begin))
+                    reader.get_raw_lines(startpos, patch.begin))
+            yield patch
+            patch = self.next_patch(reader, need_header)
         if self.header is None:
             self.header = FileHeader(reader.get_raw_lines(startpos))
 
+    @property
+    def diff_type(self):
+        return self._diff_type
+
+    @diff_type.setter
+    def diff_type(self, diff_type):
+        self._diff_type = diff_type
+        self._scan = _scan_table(diff_type)
+
+    def iter_filtered(self, reader, patch_filter, need_header=True):
+        """Parse patches from a Reader and yield those which patch_filter
+        (a PatchFilter) keeps.
+
+        Hunk bodies are skipped while parsing, as with headers_only, and
+        only loaded where the filter needs them.  The patches can be
+        written out with Patch.write() and the same reader, which copies
+        their text from the input.
+        """
+        headers_only = self.headers_only
+        self.headers_only = True
+        try:
+            for patch in self.iter_patches(reader, need_header):
+                patch = patch_filter.apply(patch, reader)
+                if patch is not None:
+                    yield patch
+        finally:
+            self.headers_only = headers_only
+
     def add_patch(self, reader, need_header=True):
+        patch = self.next_patch(reader, need_header)
+        if patch is None:
+            return False
+        self.patches.append(patch)
+        if self.spans is not None:
+            self.spans.append((patch.begin, patch.end))
+        return True
+
+    def next_patch(self, reader, need_header=True):
+        if self.stats is not None:
+            return self.stats.next_patch(self, reader, need_header)
+        patch = None
+        while patch is None:
+            found = self.scan_patch(reader, need_header)
+            if found is None:
+                return None
+            patch = self.parse_patch(reader, *found)
+        return patch
+
+    def scan_patch(self, reader, need_header=True):
+        """Scan for the header of the next patch.  Returns the patch
+        with its Header (not parsed yet) and the reader position where
+        its hunks begin, or None at the end of the input.
+        """
         # Ed and normal format patches don't have filename headers.
         if self.diff_type in (ED_DIFF, NORMAL_DIFF):
             need_header = False
 
+        (table, normal, ed, context, unified) = self._scan
+        stats = self.stats
         edcmdpos = None
         git_diff = False
         exthdrs = False
@@ -528,132 +2969,109 @@ class PatchFile(object):
         while patch is None and reader.get_raw_line():
             indent = reader.strip_indent()
             line = reader.line
-            strip_cr = (line[-2:] == '\r\n')
-            if (self.diff_type in (ANY_DIFF, NORMAL_DIFF)
-                and not need_header
-                and re_cmd.match(line)):
-                reader.strip_cr = strip_cr
-
-                if not reader.get_raw_line():
-                    break
-                indent = reader.strip_indent()
-                line = reader.line
-                if line.startswith('< ') or line.startswith('> '):
-                    start = reader.get_pos(-2)
-                    reader.indent = indent
-                    patch = NormalPatch()
-            elif (self.diff_type in (ANY_DIFF, ED_DIFF)
-                  and not need_header
-                  and edcmdpos is None
-                  and get_edcmd(line)):
-                edcmdpos = reader.get_pos(-1)
-                reader.indent = indent    # assume this for now
-                reader.strip_cr = strip_cr
-            elif (self.diff_type in (ANY_DIFF, CONTEXT_DIFF, NEW_CONTEXT_DIFF)
-                  and line.startswith('*** ')):
-                hdr.begin = reader.get_pos(-1)
-                # Swap with OLD below.
-                hdr.new.set_spec(line[4:])
-                need_header = False
-            elif line.startswith('+++ '):
-                hdr.new.set_spec(line[4:])
-                reader.strip_cr = strip_cr
-                need_header = False
-            elif line.startswith('Index:'):
-                if hdr.begin is None:
-                    hdr.begin = reader.get_pos(-1)
-                hdr.index = line[6:].lstrip()
-                if hdr.index.startswith('"'):
-                    s = parse_c_name(hdr.index)
-                    if s is not None:
-                        hdr.index = s
-                reader.strip_cr = strip_cr
-                need_header = False
-            elif line.startswith('Prereq:'):
-                if hdr.begin is None:
-                    hdr.begin = reader.get_pos(-1)
-                revisions = line[7:].lstrip().split()
-                if len(revisions) > 0:
-                    self.revision = revisions[0]
-            elif (self.diff_type in (ANY_DIFF, UNI_DIFF)
-                  and line.startswith('diff --git ')):
-                if exthdrs:
-                    hdr.end = reader.get_pos(-2)
-                    start = reader.get_pos(-1)
-                    # Patch contains no hunks; any diff type will do.
-                    patch = UniPatch(hdr)
-                else:
-                    hdr.begin = reader.get_pos(-1)
-                    hdr.old.name = None
-                    hdr.new.name = None
-                    (old_name, s) = parse_name(line[11:])
-                    if old_name is not None and len(s) > 0:
-                        (new_name, s) = parse_name(s.lstrip())
-                        if s.isspace():
-                            hdr.old.name = old_name
-                            hdr.new.name = new_name
-                    git_diff = True
-                    need_header = False
-            elif git_diff and line.startswith('index '):
-                match = re_gitindex.match(line[6:])
-                if match:
-                    mode = match.group(1)
-                    if mode is not None:
-                        hdr.old.mode = hdr.new.mode = fetchmode(mode)
-                    exthdrs = True
-            elif git_diff and line.startswith('old mode '):
-                hdr.old.mode = fetchmode(line[9:])
-                exthdrs = True
-            elif git_diff and line.startswith('new mode '):
-                hdr.new.mode = fetchmode(line[9:])
-                exthdrs = True
-            elif git_diff and line.startswith('deleted file mode '):
-                hdr.old.mode = fetchmode(line[9:])
-                exthdrs = True
-            elif git_diff and line.startswith('new file mode '):
-                hdr.new.mode = fetchmode(line[14:])
-                exthdrs = True
-            elif git_diff and line.startswith('rename from '):
-                hdr.old.rename = True
-                exthdrs = True
-            elif git_diff and line.startswith('rename to '):
-                hdr.new.rename = True
-                exthdrs = True
-            elif git_diff and line.startswith('copy from '):
-                hdr.old.copy = True
-                exthdrs = True
-            elif git_diff and line.startswith('copy to '):
-                hdr.new.copy = True
-                exthdrs = True
-            elif git_diff and line.startswith('GIT binary patch'):
-                hdr.end = reader.get_pos(-2)
-                start = reader.get_pos(-1)
-                patch = GitBinaryPatch(hdr)
-            else:
+            strip_cr = (line[-2:] == '\r\n')
+            kind = table.get(line[0])
+            if kind is None:
+                pass
+            elif kind == _SCAN_OLD:
                 i = 0
                 while line.startswith('- ', i):
                     i += 2
                 if line.startswith('--- ', i):
                     if hdr.begin is None:
                         hdr.begin = reader.get_pos(-1)
-                    hdr.old.set_spec(line[i+4:])
-                    if hdr.old.stamp is not None:
+                    hdr.old.set_spec(line[i+4:], stats)
+                    # Only look at the stamp (and parse it) if the
+                    # nesting would change.
+                    if (i // 2 != reader.rfc934_nesting
+                        and hdr.old.stamp is not None):
                         reader.rfc934_nesting = i // 2
                     reader.strip_cr = strip_cr
                     need_header = False
+            elif kind == _SCAN_NEW:
+                if line.startswith('+++ '):
+                    hdr.new.set_spec(line[4:], stats)
+                    reader.strip_cr = strip_cr
+                    need_header = False
+            elif kind == _SCAN_GIT:
+                if unified and line.startswith('diff --git '):
+                    if exthdrs:
+                        hdr.end = reader.get_pos(-2)
+                        start = reader.get_pos(-1)
+                        # Patch contains no hunks; any diff type will do.
+                        patch = UniPatch(hdr)
+                    else:
+                        hdr.begin = reader.get_pos(-1)
+                        if stats is None:
+                            names = parse_git_names(line[11:])
+                        else:
+                            names = stats.timed('names', parse_git_names,
+                                                line[11:])
+                        (hdr.old.name, hdr.new.name) = names
+                        git_diff = True
+                        need_header = False
+                elif git_diff and line.startswith('GIT binary patch'):
+                    hdr.end = reader.get_pos(-2)
+                    start = reader.get_pos(-1)
+                    patch = GitBinaryPatch(hdr)
+                elif git_diff and self._git_exthdr(hdr, line):
+                    exthdrs = True
+            elif kind == _SCAN_CMD:
+                if need_header:
+                    pass
+                elif normal and re_cmd.match(line):
+                    reader.strip_cr = strip_cr
+
+                    if not reader.get_raw_line():
+                        break
+                    indent = reader.strip_indent()
+                    line = reader.line
+                    if line.startswith('< ') or line.startswith('> '):
+                        start = reader.get_pos(-2)
+                        reader.indent = indent
+                        patch = NormalPatch()
+                elif ed and edcmdpos is None and get_edcmd(line):
+                    edcmdpos = reader.get_pos(-1)
+                    reader.indent = indent    # assume this for now
+                    reader.strip_cr = strip_cr
+            elif kind == _SCAN_CONTEXT:
+                if line.startswith('*** '):
+                    hdr.begin = reader.get_pos(-1)
+                    # Swap with OLD below.
+                    hdr.new.set_spec(line[4:], stats)
+                    need_header = False
+            elif kind == _SCAN_INDEX:
+                if line.startswith('Index:'):
+                    if hdr.begin is None:
+                        hdr.begin = reader.get_pos(-1)
+                    hdr.index = line[6:].lstrip()
+                    if hdr.index.startswith('"'):
+                        if stats is None:
+                            s = parse_c_name(hdr.index)
+                        else:
+                            s = stats.timed('names', parse_c_name, hdr.index)
+                        if s is not None:
+                            hdr.index = s
+                    reader.strip_cr = strip_cr
+                    need_header = False
+            elif kind == _SCAN_PREREQ:
+                if line.startswith('Prereq:'):
+                    if hdr.begin is None:
+                        hdr.begin = reader.get_pos(-1)
+                    revisions = line[7:].lstrip().split()
+                    if len(revisions) > 0:
+                        self.revision = revisions[0]
 
             if not need_header:
                 if edcmdpos is not None and line == '.\n':
                     start = edcmdpos
                     patch = EdPatch()
-                elif (self.diff_type in (ANY_DIFF, UNI_DIFF)
-                      and line.startswith('@@ -')):
+                elif unified and line.startswith('@@ -'):
                     reader.indent = indent
                     hdr.end = reader.get_pos(-2)
                     start = reader.get_pos(-1)
                     patch = UniPatch(hdr)
-                elif (self.diff_type in (ANY_DIFF, CONTEXT_DIFF, NEW_CONTEXT_DIFF)
-                      and line.startswith('********')):
+                elif context and line.startswith('********'):
                     previndent = indent
                     if not reader.get_raw_line():
                         break
@@ -668,8 +3086,10 @@ class PatchFile(object):
 
                         reader.indent = indent
                         reader.strip_cr = strip_cr
-                        hdr.end = reader.get_pos(-2)
-                        start = reader.get_pos(-1)
+                        # The first hunk begins at its separator line,
+                        # like the others.
+                        hdr.end = reader.get_pos(-3)
+                        start = reader.get_pos(-2)
                         # if this is a new context diff the character
                         # just before the newline is a '*'.
                         if re.search(r'\*\r?\n$', line):
@@ -688,10 +3108,1531 @@ class PatchFile(object):
                 # Patch contains no hunks; any diff type will do.
                 patch = UniPatch(hdr)
             else:
-                return False
+                return None
+        return (patch, start)
+
+    def parse_patch(self, reader, patch, start):
+        """Parse the hunks of a patch found by scan_patch().
 
+        Returns None if the patch has neither a header nor a hunk, after
+        moving the reader past the line where it was found, so that the
+        next scan does not find it again.
+        """
         reader.set_pos(start)
-        patch.parse(reader)
+        patch.parse(reader, self.headers_only, self.compact)
+        if not patch.hunks and reader.get_pos() <= patch.begin:
+            reader.set_pos(start + 1)
+            return None
         self.end = reader.get_pos(-1)
-        self.patches.append(patch)
+        return patch
+
+    @staticmethod
+    def _git_exthdr(hdr, line):
+        """Parse a git extended header line into hdr."""
+        if line.startswith('index '):
+            match = re_gitindex.match(line[6:])
+            if not match:
+                return False
+            mode = match.group(1)
+            if mode:
+                hdr.old.mode = hdr.new.mode = fetchmode(mode)
+        elif line.startswith('old mode '):
+            hdr.old.mode = fetchmode(line[9:])
+        elif line.startswith('new mode '):
+            hdr.new.mode = fetchmode(line[9:])
+        elif line.startswith('deleted file mode '):
+            hdr.old.mode = fetchmode(line[18:])
+            # for patches without --- and +++ lines, such as binary ones
+            hdr.new.set_name('/dev/null')
+        elif line.startswith('new file mode '):
+            hdr.new.mode = fetchmode(line[14:])
+            hdr.old.set_name('/dev/null')
+        elif line.startswith('rename from '):
+            hdr.old.rename = True
+        elif line.startswith('rename to '):
+            hdr.new.rename = True
+        elif line.startswith('copy from '):
+            hdr.old.copy = True
+        elif line.startswith('copy to '):
+            hdr.new.copy = True
+        else:
+            return False
+        return True
+
+    def write(self, fileobj, reader=None, encoding=None):
+        """Write the file header and all patches to a text or binary
+        file; see Patch.write().  encoding defaults to that of
+        a MmapReader, or UTF-8.
+
+        With the reader, the text between two patches which were parsed
+        from it, and after the last one, is copied, too.  Patches of the
+        input which are not in self.patches are left out of that text.
+        """
+        if encoding is None:
+            encoding = getattr(reader, 'encoding', 'utf-8')
+        write = line_writer(fileobj, encoding)
+        pos = None
+        if self.header is not None:
+            write(self.header.lines)
+            pos = len(self.header.lines)
+        for patch in self.patches:
+            if reader is not None and patch.begin is not None:
+                if pos is not None and pos < patch.begin:
+                    write(self._text_between(reader, pos, patch.begin))
+                pos = None if patch.end is None else patch.end + 1
+            patch.write(fileobj, reader, encoding)
+        if reader is not None and pos is not None:
+            write(self._text_between(reader, pos, None))
+
+    def _text_between(self, reader, begin, end):
+        # The raw lines from begin to end (or to the end of the input)
+        # which are not part of a patch.
+        if self.spans is not None:
+            lines = []
+            for (start, stop) in self.spans[
+                    bisect.bisect_left(self.spans, (begin,)):]:
+                if end is not None and start >= end:
+                    break
+                lines.extend(reader.get_raw_lines(begin, start))
+                begin = stop + 1
+            lines.extend(reader.get_raw_lines(begin, end))
+            return lines
+        patchfile = PatchFile(diff_type=self.diff_type, headers_only=True)
+        saved = (reader.get_pos(), reader.indent, reader.rfc934_nesting,
+                 reader.strip_cr)
+        lines = []
+        try:
+            reader.set_pos(begin)
+            while True:
+                found = patchfile.scan_patch(reader)
+                if found is None:
+                    break
+                (patch, start) = found
+                if end is not None and (
+                        start if patch.begin is None else patch.begin) >= end:
+                    break
+                patch = patchfile.parse_patch(reader, patch, start)
+                if patch is None:
+                    continue
+                lines.extend(reader.get_raw_lines(begin, patch.begin))
+                begin = patch.end + 1
+            lines.extend(reader.get_raw_lines(begin, end))
+        finally:
+            (pos, reader.indent, reader.rfc934_nesting,
+             reader.strip_cr) = saved
+            reader.set_pos(pos)
+        return lines
+
+    def fingerprints(self, reader=None, encoding=None):
+        """Return the fingerprint of each patch; see Patch.fingerprint()."""
+        return [patch.fingerprint(reader, encoding) for patch in self.patches]
+
+    def fingerprint(self, reader=None, encoding=None, stable=True):
+        """Return the git patch-id of all patches together, as for
+        a commit.
+
+        By default this is what git patch-id --stable computes: the sum
+        of the SHA-1s of the patches, which does not depend on the order
+        of the files.  With stable false, the patches are hashed one
+        after the other, as by git patch-id --unstable.
+        """
+        return _patch_id(self.patches, reader, encoding, stable)
+
+    def apply(self, root, strip=1, max_fuzz=2, dry_run=False,
+              encoding='utf-8', workers=None):
+        """Apply all patches to files under the directory root.
+
+        With workers > 1, patches are split into groups which touch
+        disjoint sets of files (a rename or copy joins its source and
+        target), and the groups are applied in a process pool.  Patches
+        within a group keep their order.
+
+        Returns a list of ApplyResult objects, one per patch.
+        """
+        import concurrent.futures
+
+        items = list(enumerate(self.patches))
+        args = (root, strip, max_fuzz, dry_run, encoding)
+        if workers is None or workers <= 1 or len(items) <= 1:
+            return apply_patches(items, *args)
+
+        groups = self.file_groups(strip)
+        # Larger groups first, each to the currently smallest batch.
+        groups.sort(key=len, reverse=True)
+        nbatches = min(len(groups), workers * 4)
+        batches = [[] for i in range(nbatches)]
+        for group in groups:
+            min(batches, key=len).extend(group)
+
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = {}
+            for batch in batches:
+                batch.sort()
+                batch_items = [(number, self.patches[number])
+                               for number in batch]
+                futures[executor.submit(apply_patches, batch_items,
+                                        *args)] = batch
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    for number in futures[future]:
+                        results.append(ApplyResult(number=number,
+                                                   error=str(e)))
+        results.sort(key=lambda result: result.number)
+        return results
+
+    def reversed(self):
+        """Return a PatchFile which undoes this one: the patches are
+        reversed (see Patch.reversed()), in reverse order.
+        """
+        result = PatchFile(diff_type=self.diff_type,
+                           headers_only=self.headers_only,
+                           compact=self.compact)
+        result.header = self.header
+        result.patches = [patch.reversed() for patch in reversed(self.patches)]
+        return result
+
+    def combine(self, other, strip=1, context=3):
+        """Return a PatchFile with the patches of this one followed by
+        those of other, combined file by file (see Patch.combine()).
+        Files are matched up by name with strip leading components
+        removed.  Patches that are not combined are kept as they are;
+        write the result without a reader.
+        """
+        result = PatchFile(diff_type=UNI_DIFF)
+        result.patches = _fold_patches(self.patches + other.patches, strip,
+                                       context)
+        return result
+
+    def interdiff(self, other, strip=1, context=3):
+        """Return a PatchFile with the differences between the patches
+        of this one and those of other, file by file, where both apply
+        to the same tree (see Patch.interdiff()).  Files that only this
+        one patches are reverted, and patches of files that only other
+        patches are kept.  Write the result without a reader.
+        """
+        result = PatchFile(diff_type=UNI_DIFF)
+        later = {}
+        theirs = _fold_patches(other.patches, strip, context)
+        for (number, patch) in enumerate(theirs):
+            key = (_file_key(patch.header.old, strip)
+                   or _file_key(patch.header.new, strip))
+            later.setdefault(key, number)
+        for patch in _fold_patches(self.patches, strip, context):
+            key = (_file_key(patch.header.old, strip)
+                   or _file_key(patch.header.new, strip))
+            number = later.pop(key, None)
+            if number is None:
+                other_patch = UniPatch(Header(patch.header.old,
+                                              patch.header.old))
+            else:
+                other_patch = theirs[number]
+                theirs[number] = None
+            diff = patch.interdiff(other_patch, context)
+            if diff.hunks:
+                result.patches.append(diff)
+        result.patches.extend([patch for patch in theirs
+                               if patch is not None])
+        return result
+
+    def file_groups(self, strip=1):
+        """Split patch numbers into groups that touch disjoint files.
+
+        Each group is a list of patch numbers in ascending order.
+        """
+        parent = {}
+        def find(key):
+            root = key
+            while parent[root] != root:
+                root = parent[root]
+            while parent[key] != root:
+                (parent[key], key) = (root, parent[key])
+            return root
+
+        for number, patch in enumerate(self.patches):
+            keys = [('patch', number)]
+            for info in (patch.header.old, patch.header.new):
+                name = strip_name(info.name, strip)
+                if name is not None:
+                    keys.append(('file', os.path.normpath(name)))
+            for key in keys:
+                parent.setdefault(key, key)
+            first = find(keys[0])
+            for key in keys[1:]:
+                parent[find(key)] = first
+
+        groups = {}
+        for number in range(len(self.patches)):
+            groups.setdefault(find(('patch', number)), []).append(number)
+        return list(groups.values())
+
+def apply_patches(items, root, strip=1, max_fuzz=2, dry_run=False,
+                  encoding='utf-8'):
+    """Apply (number, patch) pairs in order with Patch.apply_tree().
+
+    Returns a list of ApplyResult objects.
+    """
+    results = []
+    for number, patch in items:
+        try:
+            result = patch.apply_tree(root, strip, max_fuzz, dry_run,
+                                      encoding)
+        except NotImplementedError:
+            result = ApplyResult(error='Unsupported patch type')
+        result.number = number
+        results.append(result)
+    return results
+
+def parse_ranges(spec):
+    """Parse a filterdiff style list of ranges such as '1,3-5,8-' into
+    a list of (first, last) pairs; last is None for open ranges.
+    """
+    ranges = []
+    for part in spec.split(','):
+        (first, dash, last) = part.strip().partition('-')
+        first = int(first) if first else 1
+        if not dash:
+            last = first
+        elif last:
+            last = int(last)
+        else:
+            last = None
+        ranges.append((first, last))
+    return ranges
+
+def in_ranges(ranges, first, last):
+    # Check whether [first, last] overlaps any of the ranges.
+    for (low, high) in ranges:
+        if last >= low and (high is None or first <= high):
+            return True
+    return False
+
+class PatchFilter(object):
+    """Patch selection in the style of filterdiff.
+
+    include and exclude are lists of glob patterns matched against the
+    old and new file names with strip leading components removed (as
+    filterdiff -p, default 0); a patch is kept if one of its names
+    matches an include pattern (or there are none) and none matches an
+    exclude pattern.  added_only and removed_only keep only patches
+    which create or delete files.  hunks (hunk numbers, from 1) and
+    lines (line numbers in the old file) are range lists as accepted by
+    parse_ranges() and select hunks; patches without selected hunks are
+    dropped.
+    """
+
+    def __init__(self, include=None, exclude=None, strip=0, hunks=None,
+                 lines=None, added_only=False, removed_only=False):
+        self.include = [] if include is None else list(include)
+        self.exclude = [] if exclude is None else list(exclude)
+        self.strip = strip
+        if isinstance(hunks, str):
+            hunks = parse_ranges(hunks)
+        if isinstance(lines, str):
+            lines = parse_ranges(lines)
+        self.hunks = hunks
+        self.lines = lines
+        self.added_only = added_only
+        self.removed_only = removed_only
+
+    def __repr__(self):
+        return ('%s(include=%s, exclude=%s, strip=%s, hunks=%s, lines=%s, '
+                'added_only=%s, removed_only=%s)' % (
+                    self.__class__.__name__, repr(self.include),
+                    repr(self.exclude), repr(self.strip), repr(self.hunks),
+                    repr(self.lines), repr(self.added_only),
+                    repr(self.removed_only)))
+
+    def match_header(self, header):
+        """Check whether a patch with this header can be kept, before
+        looking at its hunks."""
+        import fnmatch
+
+        if self.added_only and not header.old.is_null():
+            return False
+        if self.removed_only and not header.new.is_null():
+            return False
+        if not self.include and not self.exclude:
+            return True
+        names = []
+        for name in (header.old.name, header.new.name, header.index):
+            if name is not None:
+                if len(name) >= 2 and name[0] == name[-1] == '"':
+                    name = name[1:-1]
+                name = strip_name(name, self.strip)
+                if name is not None and name not in names:
+                    names.append(name)
+        for pattern in self.exclude:
+            for name in names:
+                if fnmatch.fnmatchcase(name, pattern):
+                    return False
+        if not self.include:
+            return True
+        for pattern in self.include:
+            for name in names:
+                if fnmatch.fnmatchcase(name, pattern):
+                    return True
+        return False
+
+    def select_hunks(self, hunks, reader=None):
+        """Return the selected hunks.  The line ranges of hunks parsed
+        with headers_only are taken from their headers in reader (see
+        Hunk.src_count()); their bodies are not loaded."""
+        selected = []
+        for (number, hunk) in enumerate(hunks, 1):
+            if self.hunks is not None and not in_ranges(self.hunks,
+                                                       number, number):
+                continue
+            if self.lines is not None:
+                last = hunk.srcline + max(hunk.src_count(reader), 1) - 1
+                if not in_ranges(self.lines, hunk.srcline, last):
+                    continue
+            selected.append(hunk)
+        return selected
+
+    def apply(self, patch, reader=None):
+        """Return patch if it is kept as a whole, a new patch with the
+        selected hunks if only some are kept, or None."""
+        if not self.match_header(patch.header):
+            return None
+        if self.hunks is None and self.lines is None:
+            return patch
+        if reader is None or patch.reader_state is None:
+            hunks = self.select_hunks(patch.hunks, reader)
+        else:
+            saved = (reader.indent, reader.rfc934_nesting, reader.strip_cr)
+            (reader.indent, reader.rfc934_nesting,
+             reader.strip_cr) = patch.reader_state
+            try:
+                hunks = self.select_hunks(patch.hunks, reader)
+            finally:
+                (reader.indent, reader.rfc934_nesting,
+                 reader.strip_cr) = saved
+        if not hunks:
+            return None
+        if len(hunks) == len(patch.hunks):
+            return patch
+        selected = type(patch)(patch.header, hunks)
+        selected.reader_state = patch.reader_state
+        return selected
+
+class _Edit(object):
+    """A hunk as an edit script from an old to a new version of a file:
+    a list of (op, change) pairs (see Hunk.iter_changes()) which starts
+    at line old of the old and at line new of the new version.
+    """
+
+    __slots__ = [ 'old', 'new', 'old_len', 'new_len', 'ops' ]
+
+    def __init__(self, old, new, old_len, new_len, ops):
+        self.old = old
+        self.new = new
+        self.old_len = old_len
+        self.new_len = new_len
+        self.ops = ops
+
+    @classmethod
+    def from_hunk(cls, hunk):
+        if not hunk.src and not hunk.dst:
+            raise ValueError('Hunk body not loaded')
+        if any(change.text is None for change in hunk.src):
+            raise ValueError('Hunk does not contain the lines it removes')
+        return cls(hunk.srcline, hunk.dstline, len(hunk.src),
+                   len(hunk.dst), list(hunk.iter_changes()))
+
+    def reversed(self):
+        swap = { '-': '+', '+': '-', ' ': ' ' }
+        return _Edit(self.new, self.old, self.new_len, self.old_len,
+                     [(swap[op], change) for (op, change) in self.ops])
+
+class _OffsetMap(object):
+    """Line number translation across a sorted list of edits.
+
+    Lines of the version the edits are positioned in (the new version
+    of the edits, or with old, the old version) which lie before an
+    edit or group of edits are translated to the other version by
+    adding the size differences of the edits before them; these are
+    kept as prefix sums and found by binary search.
+    """
+
+    def __init__(self, edits, old=False):
+        self.ends = []
+        self.offsets = [ 0 ]
+        for edit in edits:
+            if old:
+                (start, length, other) = (edit.old, edit.old_len,
+                                          edit.new_len)
+            else:
+                (start, length, other) = (edit.new, edit.new_len,
+                                          edit.old_len)
+            self.ends.append(start + length)
+            self.offsets.append(self.offsets[-1] + other - length)
+
+    def translate(self, line):
+        # Edits which end at line touch it and are not before it.
+        return line + self.offsets[bisect.bisect_left(self.ends, line)]
+
+def _cancel_changes(ops):
+    """Turn lines which a run of changes removes and adds again at its
+    start or end into context."""
+    result = []
+    i = 0
+    while i < len(ops):
+        if ops[i][0] == ' ':
+            result.append(ops[i])
+            i += 1
+            continue
+        j = i
+        while j < len(ops) and ops[j][0] != ' ':
+            j += 1
+        removed = [change for (op, change) in ops[i:j] if op == '-']
+        added = [change for (op, change) in ops[i:j] if op == '+']
+        common = min(len(removed), len(added))
+        head = 0
+        while head < common and removed[head].text == added[head].text:
+            head += 1
+        tail = 0
+        while (tail < common - head
+               and removed[-1 - tail].text == added[-1 - tail].text):
+            tail += 1
+        result.extend([(' ', change) for change in removed[:head]])
+        result.extend([('-', change)
+                       for change in removed[head:len(removed) - tail]])
+        result.extend([('+', change)
+                       for change in added[head:len(added) - tail]])
+        result.extend([(' ', change)
+                       for change in removed[len(removed) - tail:]])
+        i = j
+    return result
+
+def _make_hunks(ops, old, new, context):
+    """Build unified hunks from (op, change) pairs starting at lines old
+    and new, with at most context lines of context around changes.
+    Context Change objects are shared between src and dst.
+
+    Context before and after the changes of a hunk is cut to the same
+    length, except at the start of the file: patch takes a hunk with
+    less context on one side to be anchored at the start or end of
+    the file, which is not known here.
+    """
+    ops = _cancel_changes(ops)
+    changed = [i for (i, (op, change)) in enumerate(ops) if op != ' ']
+    if not changed:
+        return []
+    if context is None:
+        context = len(ops)
+    windows = []
+    for i in changed:
+        (first, last) = (max(i - context, 0), min(i + context + 1, len(ops)))
+        if windows and first <= windows[-1][1]:
+            windows[-1][1] = last
+            windows[-1][3] = i
+        else:
+            windows.append([first, last, i, i])
+
+    hunks = []
+    k = 0
+    for (first, last, head, tail) in windows:
+        (before, after) = (head - first, last - 1 - tail)
+        if before > after:
+            first = head - after
+        for (op, change) in ops[k:first]:
+            old += op != '+'
+            new += op != '-'
+        if after > before and (old > 1 or new > 1):
+            last = tail + 1 + before
+        hunk = UniHunk(old, new)
+        for (op, change) in ops[first:last]:
+            if change.op != op:
+                change = Change(op, change.text)
+            if op != '+':
+                hunk.src.append(change)
+                old += 1
+            if op != '-':
+                hunk.dst.append(change)
+                new += 1
+        hunks.append(hunk)
+        k = last
+    return hunks
+
+def _compose(first, second, context=3):
+    """Combine edits from version 0 to 1 of a file with edits from
+    version 1 to 2 into unified hunks from version 0 to 2.
+
+    Edits of both lists which overlap or touch in version 1 are merged
+    into one group; the lines of version 1 in the group are then known
+    from the edits, and each line is kept, removed or added depending
+    on what the two edits do with it.  Lines between groups are left
+    alone by both lists, so only their line numbers change.
+    """
+    first = sorted(first, key=lambda edit: edit.new)
+    second = sorted(second, key=lambda edit: edit.old)
+    to_old = _OffsetMap(first)
+    to_new = _OffsetMap(second, old=True)
+    spans = [(edit.new, edit.new + edit.new_len, 0, edit) for edit in first]
+    spans.extend([(edit.old, edit.old + edit.old_len, 1, edit)
+                  for edit in second])
+    spans.sort(key=lambda span: span[:3])
+
+    groups = []
+    for (start, end, side, edit) in spans:
+        if groups and start <= groups[-1][1]:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append((side, edit))
+        else:
+            groups.append([start, end, [(side, edit)]])
+
+    hunks = []
+    for (lo, hi, edits) in groups:
+        lines = [None] * (hi - lo)
+        flags = [0] * (hi - lo)     # 1: not in version 0, 2: not in 2
+        outside = ({}, {})          # lines only in version 0 or 2
+        for (side, edit) in edits:
+            k = (edit.old if side else edit.new) - lo
+            gone = '+' if side else '-'
+            for (op, change) in edit.ops:
+                if op == gone:
+                    outside[side].setdefault(k, []).append(change)
+                    continue
+                if lines[k] is None:
+                    lines[k] = change
+                elif lines[k].text != change.text:
+                    raise ValueError('Patches do not apply in sequence '
+                                     '(line %d)' % (lo + k,))
+                if op != ' ':
+                    flags[k] |= 2 if side else 1
+                k += 1
+
+        ops = []
+        for k in range(hi - lo + 1):
+            for change in outside[0].get(k, ()):
+                ops.append(('-', change))
+            for change in outside[1].get(k, ()):
+                ops.append(('+', change))
+            if k == hi - lo:
+                break
+            if lines[k] is None:
+                raise ValueError('Patches do not apply in sequence '
+                                 '(line %d)' % (lo + k,))
+            if flags[k] == 0:
+                ops.append((' ', lines[k]))
+            elif flags[k] == 1:
+                ops.append(('+', lines[k]))
+            elif flags[k] == 2:
+                ops.append(('-', lines[k]))
+        hunks.extend(_make_hunks(ops, to_old.translate(lo),
+                                 to_new.translate(lo), context))
+    return hunks
+
+def _file_key(info, strip):
+    # The name by which combine() and interdiff() match up files.
+    if info.is_null():
+        return None
+    name = strip_name(info.name, strip)
+    if name is None:
+        return None
+    return os.path.normpath(name)
+
+def _as_unified(patch):
+    """Return patch as a UniPatch, sharing its header and changes."""
+    if isinstance(patch, UniPatch):
+        return patch
+    hunks = [UniHunk(hunk.srcline, hunk.dstline, hunk.section, hunk.src,
+                     hunk.dst) for hunk in patch.hunks]
+    return UniPatch(patch.header, hunks)
+
+def _fold_patches(patches, strip, context):
+    """Combine patches to the same file, in order, into one."""
+    result = []
+    files = {}
+    for patch in patches:
+        number = files.pop(_file_key(patch.header.old, strip), None)
+        if number is None:
+            number = len(result)
+            result.append(_as_unified(patch))
+        else:
+            result[number] = result[number].combine(patch, context)
+        key = _file_key(result[number].header.new, strip)
+        if key is not None:
+            files[key] = number
+    return result
+
+def _shift_patch(patch, offset):
+    """Move the line positions recorded in a patch by offset lines."""
+    for obj in [patch, patch.header] + patch.hunks:
+        if obj.begin is not None:
+            obj.begin += offset
+        if obj.end is not None:
+            obj.end += offset
+
+def _same_patch(a, b):
+    # Patches found at the same place are equal if their headers are;
+    # the hunks only depend on the position and reader state.
+    if (type(a) is not type(b) or a.begin != b.begin or a.end != b.end
+        or a.reader_state != b.reader_state):
+        return False
+    (x, y) = (a.header, b.header)
+    return ((x.begin, x.end, x.index) == (y.begin, y.end, y.index)
+            and all((f.name, f.timestr, f.mode, f.copy, f.rename)
+                    == (g.name, g.timestr, g.mode, g.copy, g.rename)
+                    for (f, g) in ((x.old, y.old), (x.new, y.new))))
+
+def _next_patch_at(patchfile, reader, state, need_header):
+    """Run patchfile.next_patch() from the reader state of a previous
+    one, and return the patch and the state after it.
+
+    A state is (line, offset, indent, rfc934_nesting, strip_cr, end,
+    revision): the line and byte offset at which the next scan starts,
+    the reader settings, PatchFile.end and the Prereq: revision seen
+    while finding the patch.  Line numbers are relative to the line
+    the reader's table starts at.
+    """
+    reader.lineno = state[0]
+    (reader.indent, reader.rfc934_nesting, reader.strip_cr) = state[2:5]
+    revision = patchfile.revision
+    patchfile.revision = None
+    patch = patchfile.next_patch(reader, need_header)
+    found = patchfile.revision
+    if found is None:
+        patchfile.revision = revision
+    if patch is None:
+        return (None, None)
+    lineno = reader.get_pos()
+    return (patch, (lineno, reader.line2pos[lineno], reader.indent,
+                    reader.rfc934_nesting, reader.strip_cr, patchfile.end,
+                    found))
+
+def _parse_chunk(path, begin, end, diff_type, need_header, headers_only,
+                 compact, encoding):
+    """Parse the patches whose scan starts between byte offsets begin
+    and end of a file.
+
+    Returns the number of lines between begin and end (None if the
+    parser stopped before end), and a list of (patch, state) pairs with
+    line numbers relative to begin.
+    """
+    with open(path, 'rb') as f:
+        reader = MmapReader(f, encoding=encoding)
+    with reader:
+        reader.line2pos = [ begin ]
+        patchfile = PatchFile(diff_type=diff_type, headers_only=headers_only,
+                              compact=compact)
+        state = (0, begin, 0, 0, False)
+        results = []
+        while state[1] < end:
+            (patch, state) = _next_patch_at(patchfile, reader, state,
+                                            need_header)
+            if patch is None:
+                break
+            results.append((patch, state))
+        nlines = bisect.bisect_left(reader.line2pos, end)
+        if nlines == len(reader.line2pos) or reader.line2pos[nlines] != end:
+            nlines = None
+        return (nlines, results)
+
+def _split_points(buf, nchunks):
+    """Return byte offsets at which to split a patch file into about
+    nchunks pieces.  Each is the start of a line which likely begins
+    a patch; parse_parallel() checks that the pieces fit together.
+    """
+    size = len(buf)
+    points = [0]
+    for i in range(1, nchunks):
+        target = max(size * i // nchunks, points[-1] + 1)
+        limit = size * (i + 1) // nchunks
+        found = -1
+        for marker in (b'\ndiff --git ', b'\nIndex: '):
+            found = buf.find(marker, target - 1, limit)
+            if found >= 0:
+                break
+        else:
+            found = buf.find(b'\n--- ', target - 1, limit)
+            while found >= 0:
+                eol = buf.find(b'\n', found + 1, limit)
+                if eol < 0:
+                    found = -1
+                elif buf[eol + 1:eol + 5] == b'+++ ':
+                    break
+                else:
+                    found = buf.find(b'\n--- ', eol, limit)
+        if found >= 0 and found + 1 > points[-1]:
+            points.append(found + 1)
+    points.append(size)
+    return points
+
+def parse_parallel(path, workers=None, diff_type=ANY_DIFF, need_header=True,
+                   headers_only=False, compact=False, encoding='utf-8',
+                   chunk_size=1 << 22):
+    """Parse a patch file on a process pool.
+
+    The file is split at lines which likely begin a patch (diff --git,
+    Index:, or --- followed by +++), and each worker parses its chunk
+    with its own MmapReader.  The results are checked and stitched back
+    together here: where a chunk does not start in the state the serial
+    parser would reach it in, the patches in question are parsed again
+    serially.  The resulting PatchFile is the same as that of
+    PatchFile(MmapReader(f), diff_type, need_header, ...).
+
+    On a single CPU, with workers <= 1, or for a file of less than two
+    chunks, the file is parsed serially without starting a pool.
+    """
+    import concurrent.futures
+
+    with open(path, 'rb') as f:
+        reader = MmapReader(f, encoding=encoding)
+    with reader:
+        patchfile = PatchFile(diff_type=diff_type, headers_only=headers_only,
+                              compact=compact)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        nchunks = min(workers * 4, reader.size // chunk_size)
+        if workers <= 1 or nchunks <= 1 or (os.cpu_count() or 1) <= 1:
+            patchfile.patches.extend(patchfile.iter_patches(reader,
+                                                            need_header))
+            patchfile.spans = _patch_spans(patchfile.patches)
+            return patchfile
+
+        points = _split_points(reader.buf, nchunks)
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(_parse_chunk, path, begin, end,
+                                       diff_type, need_header, headers_only,
+                                       compact, encoding)
+                       for (begin, end) in zip(points, points[1:])]
+            chunks = []
+            for future in futures:
+                try:
+                    chunks.append(future.result())
+                except Exception:
+                    chunks.append((None, []))   # leave it to the serial parser
+
+        # Shift the chunks to absolute line numbers, and index their patches
+        # by position.
+        starts = {}
+        base = 0
+        for (number, (nlines, results)) in enumerate(chunks):
+            for (k, (patch, state)) in enumerate(results):
+                _shift_patch(patch, base)
+                results[k] = (patch, (state[0] + base,) + state[1:5] +
+                              (state[5] + base, state[6]))
+                starts[patch.begin] = (number, k)
+            if nlines is None:
+                break
+            base += nlines
+
+        # The first chunk starts where a serial parse does.
+        patches = patchfile.patches
+        state = (0, 0, 0, 0, False)
+        for (patch, state) in chunks[0][1]:
+            patches.append(patch)
+            if state[6] is not None:
+                patchfile.revision = state[6]
+            patchfile.end = state[5]
+        while True:
+            # The patch after state, found serially.  The reader's line table
+            # starts at the line of state, so line numbers are relative.
+            base = state[0]
+            reader.line2pos = [ state[1] ]
+            (patch, after) = _next_patch_at(patchfile, reader,
+                                            (0,) + state[1:], need_header)
+            if patch is None:
+                break
+            _shift_patch(patch, base)
+            state = (after[0] + base,) + after[1:5] + (after[5] + base, None)
+            patches.append(patch)
+            patchfile.end = state[5]
+
+            # If a worker found the same patch and ended up in the same
+            # state, the rest of its chunk is what a serial parse would give.
+            (number, k) = starts.get(patch.begin, (None, None))
+            if number is None:
+                continue
+            results = chunks[number][1]
+            if (not _same_patch(patch, results[k][0])
+                or results[k][1][:6] != state[:6]):
+                continue
+            for (patch, state) in results[k + 1:]:
+                patches.append(patch)
+                if state[6] is not None:
+                    patchfile.revision = state[6]
+            patchfile.end = state[5]
+
+        reader.line2pos = [ 0 ]
+        reader.lineno = 0
+        patchfile.header = FileHeader(reader.get_raw_lines(
+            0, patches[0].begin if patches else None))
+        patchfile.spans = _patch_spans(patches)
+    return patchfile
+
+def fingerprint_files(paths, workers=None, diff_type=ANY_DIFF,
+                      encoding='utf-8'):
+    """Fingerprint the patches in many patch files on a process pool.
+
+    Returns a dict from fingerprint (see Patch.fingerprint()) to a list
+    of (path, line) pairs: where the patches with that fingerprint begin,
+    in the order of paths.  Each file is parsed with a MmapReader and
+    compact hunks, and its patches are hashed with the reader.
+    """
+    import concurrent.futures
+    import itertools
+
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(paths) <= 1:
+        results = [_fingerprint_file(path, diff_type, encoding)
+                   for path in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(
+                _fingerprint_file, paths, itertools.repeat(diff_type),
+                itertools.repeat(encoding),
+                chunksize=max(1, len(paths) // (workers * 16))))
+    index = {}
+    for (path, result) in zip(paths, results):
+        for (fingerprint, line) in result:
+            index.setdefault(fingerprint, []).append((path, line))
+    return index
+
+def _fingerprint_file(path, diff_type, encoding):
+    """Return (fingerprint, line) for each patch in a file."""
+    with open(path, 'rb') as f:
+        reader = MmapReader(f, encoding=encoding)
+    with reader:
+        patchfile = PatchFile(diff_type=diff_type, compact=True)
+        return [(patch.fingerprint(reader), patch.begin)
+                for patch in patchfile.iter_patches(reader)]
+
+class PatchIndex(object):
+    """Sidecar index of patch and hunk positions in a patch file.
+
+    The index maps file names to patch numbers, records the line range
+    of every patch and hunk, and keeps the line-to-byte-offset table of
+    the file.  It is tied to the file by its size, modification time and
+    SHA-256 digest.  Lookups by name are binary searches, and a patch is
+    re-parsed by jumping straight to its recorded position.
+    """
+
+    magic = b'patchutils-index 2\n'
+    suffix = '.pidx'
+
+    def __init__(self, size=None, mtime=None, digest=None,
+                 diff_type=ANY_DIFF, need_header=True, encoding='utf-8',
+                 line2pos=None, patches=None, names=None):
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.diff_type = diff_type
+        self.need_header = need_header
+        self.encoding = encoding
+        self.line2pos = array.array('q') if line2pos is None else line2pos
+        # Each entry is [scanpos, reader_state, begin, end, hunks], where
+        # scanpos and reader_state describe the reader just before
+        # PatchFile.next_patch() found the patch, and hunks is a list of
+        # [begin, end] line ranges.
+        self.patches = [] if patches is None else patches
+        # Sorted list of [name, patch number].
+        self.names = [] if names is None else names
+
+    def __repr__(self):
+        return '%s(size=%s, mtime=%s, digest=%s, patches=%d)' % (
+            self.__class__.__name__, repr(self.size), repr(self.mtime),
+            repr(self.digest), len(self.patches))
+
+    @classmethod
+    def build(cls, path, diff_type=ANY_DIFF, need_header=True,
+              encoding='utf-8'):
+        """Scan a patch file and create its index."""
+        import hashlib
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            reader = MmapReader(f, encoding=encoding)
+        with reader:
+            index = cls(st.st_size, st.st_mtime_ns,
+                        hashlib.sha256(reader.buf).hexdigest(),
+                        diff_type, need_header, encoding)
+            patchfile = PatchFile(diff_type=diff_type, headers_only=True)
+            names = set()
+            while True:
+                scanpos = reader.get_pos()
+                state = [reader.indent, reader.rfc934_nesting,
+                         reader.strip_cr]
+                patch = patchfile.next_patch(reader, need_header)
+                if patch is None:
+                    break
+                number = len(index.patches)
+                index.patches.append(
+                    [scanpos, state, patch.begin, patch.end,
+                     [[hunk.begin, hunk.end] for hunk in patch.hunks]])
+                hdr = patch.header
+                for name in (hdr.old.name, hdr.new.name, hdr.index):
+                    if name is not None:
+                        names.add((name, number))
+            index.names = sorted([name, number] for (name, number) in names)
+            index.line2pos.extend(reader.line2pos)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        """Read an index file written by save()."""
+        import json
+
+        with open(path, 'rb') as f:
+            if f.readline() != cls.magic:
+                raise ValueError('%s is not a patch index' % path)
+            meta = json.loads(f.readline().decode('ascii'))
+            line2pos = array.array('q')
+            line2pos.frombytes(f.read())
+        if meta.pop('byteorder') != sys.byteorder:
+            line2pos.byteswap()
+        return cls(line2pos=line2pos, **meta)
+
+    def save(self, path):
+        """Write the index to a file."""
+        import json
+
+        meta = {
+            'size': self.size,
+            'mtime': self.mtime,
+            'digest': self.digest,
+            'diff_type': self.diff_type,
+            'need_header': self.need_header,
+            'encoding': self.encoding,
+            'byteorder': sys.byteorder,
+            'patches': self.patches,
+            'names': self.names,
+        }
+        tmppath = path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(self.magic)
+            f.write(json.dumps(meta, separators=(',', ':')).encode('ascii'))
+            f.write(b'\n')
+            f.write(self.line2pos.tobytes())
+        os.rename(tmppath, path)
+
+    @classmethod
+    def get(cls, path, diff_type=ANY_DIFF, need_header=True,
+            encoding='utf-8', check_hash=False):
+        """Return the index of a patch file, using the sidecar file
+        next to it if it is up to date, and (re)building it otherwise.
+        """
+        idxpath = path + cls.suffix
+        try:
+            index = cls.load(idxpath)
+            if (index.diff_type == diff_type
+                and index.need_header == need_header
+                and index.encoding == encoding
+                and index.is_current(path, check_hash)):
+                return index
+        except (IOError, OSError, ValueError):
+            pass
+        index = cls.build(path, diff_type, need_header, encoding)
+        try:
+            index.save(idxpath)
+        except (IOError, OSError):
+            pass                # read-only location; use it unsaved
+        return index
+
+    def is_current(self, path, check_hash=False):
+        """Check that the index still matches the patch file."""
+        st = os.stat(path)
+        if st.st_size != self.size or st.st_mtime_ns != self.mtime:
+            return False
+        if check_hash:
+            import hashlib
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            return digest.hexdigest() == self.digest
         return True
+
+    def find(self, name):
+        """Return the numbers of all patches which touch a file."""
+        i = bisect.bisect_left(self.names, [name])
+        numbers = []
+        while i < len(self.names) and self.names[i][0] == name:
+            numbers.append(self.names[i][1])
+            i += 1
+        return numbers
+
+    def hunks(self, number):
+        """Return the [begin, end] line ranges of hunks in a patch."""
+        return self.patches[number][4]
+
+    def reader(self, f):
+        """Create a MmapReader for the indexed file, with its line table
+        filled in from the index.
+        """
+        reader = MmapReader(f, encoding=self.encoding)
+        reader.line2pos = array.array('q', self.line2pos)
+        return reader
+
+    def load_patch(self, reader, number, headers_only=False):
+        """Parse one indexed patch without scanning the file before it."""
+        (scanpos, state, begin, end) = self.patches[number][:4]
+        if len(reader.line2pos) < len(self.line2pos):
+            reader.line2pos = array.array('q', self.line2pos)
+        reader.set_pos(scanpos)
+        (reader.indent, reader.rfc934_nesting, reader.strip_cr) = state
+        patchfile = PatchFile(diff_type=self.diff_type,
+                              headers_only=headers_only)
+        patch = patchfile.next_patch(reader, self.need_header)
+        if patch is None or patch.begin != begin or patch.end != end:
+            raise ValueError('Patch index does not match the file')
+        return patch
+
+    def load_patches(self, reader, name, headers_only=False):
+        """Parse all patches which touch a file."""
+        return [self.load_patch(reader, number, headers_only)
+                for number in self.find(name)]
+
+# Classes which PatchCache entries refer to by name.
+_cache_classes = dict((cls.__name__, cls) for cls in (
+    Patch, UniPatch, ContextPatch, NewContextPatch, NormalPatch, EdPatch,
+    GitBinaryPatch, Hunk, UniHunk, CompactUniHunk, ContextHunk,
+    NewContextHunk, NormalHunk, EdHunk, GitBinaryHunk))
+
+class PatchCache(object):
+    """Directory of parsed patch files, keyed by the SHA-256 digest of
+    their contents and the parse options, so that identical input is
+    parsed only once.
+
+    Entries hold the PatchFile as nested tuples of plain values written
+    with marshal; loading one builds the objects directly, without any
+    parsing.  Entries are touched when they are used, and the least
+    recently used ones are removed when the directory grows beyond
+    max_size bytes.
+    """
+
+    magic = b'patchutils-cache 4\n'
+    suffix = '.pcache'
+
+    def __init__(self, directory, max_size=1 << 28):
+        self.directory = directory
+        self.max_size = max_size
+
+    def __repr__(self):
+        return '%s(%s, max_size=%d)' % (
+            self.__class__.__name__, repr(self.directory), self.max_size)
+
+    @staticmethod
+    def key(data, diff_type=ANY_DIFF, need_header=True, headers_only=False,
+            compact=False, encoding='utf-8'):
+        """Return the cache key of a buffer parsed with these options."""
+        import hashlib
+
+        digest = hashlib.sha256(data)
+        digest.update(repr((diff_type, need_header, headers_only, compact,
+                            encoding, sys.version_info[:2])).encode('ascii'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def parse(self, path, diff_type=ANY_DIFF, need_header=True,
+              headers_only=False, compact=False, encoding='utf-8'):
+        """Return the PatchFile of a patch file, from the cache if the
+        same contents have been parsed with the same options before.
+        """
+        with open(path, 'rb') as f, MmapReader(f, encoding=encoding) as reader:
+            key = self.key(reader.buf, diff_type, need_header,
+                           headers_only, compact, encoding)
+            patchfile = self.get(key)
+            if patchfile is None:
+                patchfile = PatchFile(reader, diff_type, need_header,
+                                      headers_only, compact)
+                self.put(key, patchfile)
+        return patchfile
+
+    def get(self, key):
+        """Return the cached PatchFile for key, or None."""
+        import marshal
+
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                if f.readline() != self.magic:
+                    return None
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            patchfile = self.decode(marshal.loads(data))
+        except (ValueError, EOFError, TypeError, KeyError, IndexError):
+            # a corrupt entry; parse again and replace it
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass            # read-only location
+        return patchfile
+
+    def put(self, key, patchfile):
+        """Store a PatchFile under key, and make room for it."""
+        import marshal
+
+        data = marshal.dumps(self.encode(patchfile))
+        path = self.path(key)
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmppath, 'wb') as f:
+                f.write(self.magic)
+                f.write(data)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            return          # read-only location; nothing is cached
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the directory holds
+        at most max_size bytes."""
+        entries = []
+        total = 0
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.suffix):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total += st.st_size
+        except OSError:
+            return
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for (size, path) in [entry[1:] for entry in entries]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass        # removed by another process
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self):
+        """Remove all entries."""
+        max_size = self.max_size
+        self.max_size = -1
+        try:
+            self.evict()
+        finally:
+            self.max_size = max_size
+
+    @classmethod
+    def encode(cls, patchfile):
+        """Return a PatchFile as nested tuples of plain values."""
+        return (patchfile.diff_type, patchfile.headers_only,
+                patchfile.compact,
+                None if patchfile.header is None else patchfile.header.lines,
+                getattr(patchfile, 'end', None),
+                patchfile.revision, patchfile.spans,
+                [cls.encode_patch(patch) for patch in patchfile.patches])
+
+    @classmethod
+    def decode(cls, data):
+        """Rebuild a PatchFile from encode()."""
+        (diff_type, headers_only, compact, header, end, revision, spans,
+         patches) = data
+        patchfile = PatchFile(diff_type=diff_type, headers_only=headers_only,
+                              compact=compact)
+        if header is not None:
+            patchfile.header = FileHeader(header)
+        if end is not None:
+            patchfile.end = end
+        patchfile.revision = revision
+        if spans is not None:
+            patchfile.spans = spans
+        decode_patch = cls.decode_patch
+        patchfile.patches = [decode_patch(patch) for patch in patches]
+        return patchfile
+
+    @staticmethod
+    def encode_info(info):
+        stamp = info._stamp
+        if stamp is _epoch or (stamp is not None and not info.timestr):
+            stamp = 1           # /dev/null
+        else:
+            stamp = 0
+        return (info.name, info.timestr, info.mode, info.copy, info.rename,
+                stamp)
+
+    @staticmethod
+    def decode_info(data):
+        info = FileInfo.__new__(FileInfo)
+        (info.name, info.timestr, info.mode, info.copy, info.rename,
+         stamp) = data
+        if stamp:
+            info._stamp = _epoch
+        elif info.timestr:
+            info._stamp = _unparsed
+        else:
+            info._stamp = None
+        return info
+
+    @classmethod
+    def encode_patch(cls, patch):
+        hdr = patch.header
+        encode_info = cls.encode_info
+        return (type(patch).__name__, patch.begin, patch.end,
+                patch.reader_state,
+                (encode_info(hdr.old), encode_info(hdr.new), hdr.index,
+                 hdr.begin, hdr.end),
+                [cls.encode_hunk(hunk) for hunk in patch.hunks])
+
+    @classmethod
+    def decode_patch(cls, data):
+        (kind, begin, end, reader_state, header, hunks) = data
+        patch_class = _cache_classes[kind]
+        patch = patch_class.__new__(patch_class)
+        (old, new, index, hdr_begin, hdr_end) = header
+        hdr = patch.header = Header.__new__(Header)
+        hdr.old = cls.decode_info(old)
+        hdr.new = cls.decode_info(new)
+        (hdr.index, hdr.begin, hdr.end) = (index, hdr_begin, hdr_end)
+        (patch.begin, patch.end, patch.reader_state) = (
+            begin, end, reader_state)
+        decode_hunk = cls.decode_hunk
+        patch.hunks = [decode_hunk(hunk) for hunk in hunks]
+        return patch
+
+    @staticmethod
+    def encode_hunk(hunk):
+        kind = type(hunk).__name__
+        common = (kind, hunk.srcline, hunk.dstline, hunk.section,
+                  hunk.begin, hunk.end)
+        if isinstance(hunk, CompactUniHunk):
+            return common + (hunk.ops, hunk.lines)
+        if isinstance(hunk, GitBinaryHunk):
+            return common + (hunk.method, hunk.size, hunk.lines,
+                             hunk.reverse)
+        (src, dst) = (hunk.src, hunk.dst)
+        # Context lines are shared by src and dst if they are the same
+        # objects, as after parsing; dst then only stores the others.
+        src_context = [change for change in src if change.op == ' ']
+        dst_context = [change for change in dst if change.op == ' ']
+        shared = (len(src_context) == len(dst_context)
+                  and all(a is b for (a, b) in zip(src_context, dst_context)))
+        return common + (
+            ''.join([change.op for change in src]),
+            [change.text for change in src],
+            ''.join([change.op for change in dst]),
+            [change.text for change in dst
+             if not shared or change.op != ' '],
+            shared)
+
+    @staticmethod
+    def decode_hunk(data):
+        kind = data[0]
+        hunk_class = _cache_classes[kind]
+        hunk = hunk_class.__new__(hunk_class)
+        (hunk.srcline, hunk.dstline, hunk.section,
+         hunk.begin, hunk.end) = data[1:6]
+        if hunk_class is CompactUniHunk:
+            (hunk.ops, hunk.lines) = data[6:]
+            return hunk
+        if hunk_class is GitBinaryHunk:
+            (hunk.method, hunk.size, hunk.lines, hunk.reverse) = data[6:]
+            hunk.src = []
+            hunk.dst = []
+            return hunk
+        (src_ops, src_texts, dst_ops, dst_texts, shared) = data[6:]
+        src = hunk.src = [Change(op, text)
+                          for (op, text) in zip(src_ops, src_texts)]
+        if not shared:
+            hunk.dst = [Change(op, text)
+                        for (op, text) in zip(dst_ops, dst_texts)]
+            return hunk
+        context = iter([change for change in src if change.op == ' '])
+        texts = iter(dst_texts)
+        hunk.dst = [next(context) if op == ' ' else Change(op, next(texts))
+                    for op in dst_ops]
+        return hunk
+
+class SeriesEntry(object):
+    """One patch of a PatchSeries: a file, or a byte range of a file
+    (begin and end are None for the whole file).  strip and reverse
+    are the -pN and -R options of a quilt series file.
+    """
+
+    __slots__ = [ 'name', 'path', 'begin', 'end', 'strip', 'reverse' ]
+
+    def __init__(self, name, path, begin=None, end=None, strip=1,
+                 reverse=False):
+        self.name = name
+        self.path = path
+        self.begin = begin
+        self.end = end
+        self.strip = strip
+        self.reverse = reverse
+
+    def __repr__(self):
+        return '%s(%s, %s, begin=%s, end=%s, strip=%d, reverse=%s)' % (
+            self.__class__.__name__, repr(self.name), repr(self.path),
+            repr(self.begin), repr(self.end), self.strip, self.reverse)
+
+    def read(self):
+        """Return the bytes of the entry."""
+        with open(self.path, 'rb') as f:
+            if self.begin is None:
+                return f.read()
+            f.seek(self.begin)
+            return f.read(self.end - self.begin)
+
+def parse_series_entry(entry, diff_type=ANY_DIFF, need_header=True,
+                       headers_only=False, compact=False, encoding='utf-8'):
+    """Parse a SeriesEntry into a PatchFile.
+
+    Line numbers are relative to the start of the entry; text before the
+    first patch, like the mail headers and commit message, ends up in
+    the FileHeader.  An entry with reverse is returned reversed (see
+    PatchFile.reversed()); its hunk bodies are always read.
+    """
+    reader = MmapReader(entry.read(), encoding=encoding)
+    if entry.reverse:
+        return PatchFile(reader, diff_type, need_header, False,
+                         compact).reversed()
+    return PatchFile(reader, diff_type, need_header, headers_only, compact)
+
+class PatchSeries(object):
+    """An ordered list of patches, read from a quilt series file or
+    split from an mbox (as written by git format-patch), which can be
+    parsed concurrently.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = [] if entries is None else entries
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, repr(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    @classmethod
+    def from_quilt(cls, path, directory=None):
+        """Read a quilt series file.
+
+        Patch names are relative to directory, which defaults to the
+        directory of the series file.  Comments and unknown options are
+        ignored.
+        """
+        if directory is None:
+            directory = os.path.dirname(path)
+        entries = []
+        with open(path) as f:
+            for line in f:
+                words = line.split('#', 1)[0].split()
+                if not words:
+                    continue
+                entry = SeriesEntry(words[0],
+                                    os.path.join(directory, words[0]))
+                for word in words[1:]:
+                    if word.startswith('-p') and word[2:].isdigit():
+                        entry.strip = int(word[2:])
+                    elif word == '-R':
+                        entry.reverse = True
+                entries.append(entry)
+        return cls(entries)
+
+    @classmethod
+    def from_mbox(cls, path):
+        """Split an mbox file into one entry per message.
+
+        Messages start at "From " lines with a date.  Each entry is named
+        after the Subject: of its message.
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls()
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            starts = [m.start() for m in re_mbox_from.finditer(buf)]
+            if not starts or starts[0] != 0:
+                starts.insert(0, 0)
+            entries = []
+            for (begin, end) in zip(starts, starts[1:] + [len(buf)]):
+                # Only look for the subject in the mail headers.
+                limit = buf.find(b'\n\n', begin, end)
+                match = re_mbox_subject.search(buf, begin,
+                                               end if limit < 0 else limit)
+                if match is not None:
+                    name = match.group(1).decode('utf-8', 'replace')
+                else:
+                    name = '%s:%d' % (path, len(entries) + 1)
+                entries.append(SeriesEntry(name, path, begin, end))
+            return cls(entries)
+        finally:
+            buf.close()
+
+    def parse(self, workers=None, processes=True, max_in_flight=None,
+              diff_type=ANY_DIFF, need_header=True, headers_only=False,
+              compact=False, encoding='utf-8'):
+        """Parse the entries and yield (entry, PatchFile) pairs in order.
+
+        With workers > 1, entries are parsed on a process pool, or on
+        a thread pool without processes; threads only help where the
+        entries are slow to read.  At most max_in_flight entries
+        (default: twice the workers) are submitted or finished but not
+        yet yielded, which bounds memory use for long series.  An
+        exception raised by a parse is raised here when its entry is
+        reached.
+        """
+        import collections
+        import concurrent.futures
+
+        args = (diff_type, need_header, headers_only, compact, encoding)
+        if workers is None or workers <= 1:
+            for entry in self.entries:
+                yield (entry, parse_series_entry(entry, *args))
+            return
+
+        if max_in_flight is None:
+            max_in_flight = workers * 2
+        max_in_flight = max(max_in_flight, 1)
+        if processes:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+        with executor:
+            pending = collections.deque()
+            entries = iter(self.entries)
+            try:
+                for entry in entries:
+                    if len(pending) >= max_in_flight:
+                        (done, future) = pending.popleft()
+                        yield (done, future.result())
+                    pending.append((entry, executor.submit(
+                        parse_series_entry, entry, *args)))
+                while pending:
+                    (done, future) = pending.popleft()
+                    yield (done, future.result())
+            finally:
+                for (entry, future) in pending:
+                    future.cancel()
+
+    def apply(self, root, max_fuzz=2, dry_run=False, encoding='utf-8',
+              workers=None, diff_type=ANY_DIFF):
+        """Apply the entries in order to files under the directory root,
+        each with its strip option, and reversed if it has reverse.
+
+        With workers > 1, the entries are parsed ahead on a process pool
+        (see parse()) while they are applied here.  With dry_run, each
+        entry is checked against the files as they are, without the
+        changes of the entries before it.  Returns a list of
+        (entry, [ApplyResult, ...]) pairs.
+        """
+        return [(entry, patchfile.apply(root, entry.strip, max_fuzz,
+                                        dry_run, encoding))
+                for (entry, patchfile) in self.parse(
+                    workers, diff_type=diff_type, encoding=encoding)]
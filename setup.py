@@ -19,6 +19,11 @@ setuptools.setup(
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
         "Operating System :: OS Independent",
     ],
+    #-- Optional dependencies
+    extras_require = {
+        # time stamps in formats other than those written by GNU diff
+        'dateutil': ['python-dateutil'],
+    },
     #-- Python "stand alone" modules
     py_modules = [
         'patchutils',
@@ -0,0 +1,223 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+def parse(text):
+    reader = patchutils.LineReader(text.splitlines(True))
+    return patchutils.PatchFile(reader).patches
+
+def test_fuzz_at_start_of_file():
+    # GNU patch 2.7.6: Hunk #1 succeeded at 1 with fuzz 2 (offset -1 lines).
+    (patch,) = parse('--- a/f\n'
+                     '+++ b/f\n'
+                     '@@ -2,5 +2,6 @@\n'
+                     ' l1\n'
+                     ' l2\n'
+                     ' l3\n'
+                     '+chg808982\n'
+                     ' l4\n'
+                     ' l5\n')
+    lines = ['chg177194\n', 'l1\n', 'l3\n', 'l4\n']
+    (out, results) = patch.apply(lines)
+    assert out == ['chg177194\n', 'l1\n', 'l3\n', 'chg808982\n', 'l4\n']
+    (result,) = results
+    assert (result.line, result.offset, result.fuzz) == (1, -1, 2)
+
+def test_reverse_ed_script():
+    reader = patchutils.LineReader(['2c\n', 'two\n', '.\n'])
+    (patch,) = patchutils.PatchFile(reader,
+                                    diff_type=patchutils.ED_DIFF).patches
+    with pytest.raises(ValueError):
+        patch.reversed()
+
+def test_context_diff_chopped_blank_line():
+    # The blank context line has lost both of its leading spaces.
+    (patch,) = parse('*** a/f\n'
+                     '--- b/f\n'
+                     '***************\n'
+                     '*** 1,3 ****\n'
+                     '  one\n'
+                     '\n'
+                     '! three\n'
+                     '--- 1,3 ----\n'
+                     '  one\n'
+                     '\n'
+                     '! 3\n')
+    lines = ['one\n', '\n', 'three\n']
+    (out, results) = patch.apply(lines, max_fuzz=0)
+    assert out == ['one\n', '\n', '3\n']
+    (result,) = results
+    assert (result.line, result.fuzz) == (1, 0)
+
+def test_ed_script_deleted_lines():
+    reader = patchutils.LineReader(['2,3d\n'])
+    (patch,) = patchutils.PatchFile(reader,
+                                    diff_type=patchutils.ED_DIFF).patches
+    (hunk,) = patch.hunks
+    assert len(hunk.src) == 2 and hunk.src[0] is not hunk.src[1]
+    (out, results) = patch.apply(['1\n', '2\n', '3\n', '4\n'])
+    assert out == ['1\n', '4\n']
+    with pytest.raises(ValueError):
+        patch.combine(patch)
+
+def check_newline_markers(old, new, body):
+    for compact in (False, True):
+        reader = patchutils.LineReader(('--- a/f\n+++ b/f\n' + body)
+                                       .splitlines(True))
+        (patch,) = patchutils.PatchFile(reader, compact=compact).patches
+        (out, results) = patch.apply(old.splitlines(True))
+        assert ''.join(out) == new
+        assert [result.fuzz for result in results] == [0]
+
+def test_no_newline_old_side():
+    check_newline_markers('a\nb\nc', 'a\nb\nd\n',
+                          '@@ -1,3 +1,3 @@\n'
+                          ' a\n'
+                          ' b\n'
+                          '-c\n'
+                          '\\ No newline at end of file\n'
+                          '+d\n')
+
+def test_no_newline_new_side():
+    check_newline_markers('a\nb\nc\n', 'a\nb\nd',
+                          '@@ -1,3 +1,3 @@\n'
+                          ' a\n'
+                          ' b\n'
+                          '-c\n'
+                          '+d\n'
+                          '\\ No newline at end of file\n')
+
+def test_no_newline_both_sides():
+    check_newline_markers('a\nb\nc', 'a\nb\nd',
+                          '@@ -1,3 +1,3 @@\n'
+                          ' a\n'
+                          ' b\n'
+                          '-c\n'
+                          '\\ No newline at end of file\n'
+                          '+d\n'
+                          '\\ No newline at end of file\n')
+
+def test_no_newline_mismatch():
+    # GNU patch 2.7.6: Hunk #1 FAILED at 1.
+    (patch,) = parse('--- a/f\n'
+                     '+++ b/f\n'
+                     '@@ -1 +1 @@\n'
+                     '-d\n'
+                     '\\ No newline at end of file\n'
+                     '+b\n')
+    (out, results) = patch.apply(['d\n', 'Z\n'])
+    assert out == ['d\n', 'Z\n']
+    assert results[0].line is None
+
+def test_hunk_end_before_comment():
+    # A '#' comment line after the body is not part of the hunk.
+    for (marker, end) in (('', 4), ('\\ No newline at end of file\n', 5)):
+        text = ('--- a/f\n'
+                '+++ b/f\n'
+                '@@ -1 +1 @@\n'
+                '-a\n'
+                '+b\n' + marker +
+                '# comment\n')
+        for compact in (False, True):
+            reader = patchutils.LineReader(text.splitlines(True))
+            (patch,) = patchutils.PatchFile(reader, compact=compact).patches
+            (hunk,) = patch.hunks
+            assert (hunk.begin, hunk.end) == (2, end)
+
+def test_fuzz_without_compared_lines():
+    # GNU patch 2.7.6: Hunk #1 succeeded at 4 with fuzz 1 (offset -1 lines).
+    (patch,) = parse('--- a/f\n'
+                     '+++ b/f\n'
+                     '@@ -5 +5,2 @@\n'
+                     ' b\n'
+                     '+b\n')
+    (out, results) = patch.apply(['Z\n', 'b\n', 'd\n', 'Z\n'])
+    assert out == ['Z\n', 'b\n', 'd\n', 'Z\n', 'b\n']
+    (result,) = results
+    assert (result.line, result.offset, result.fuzz) == (4, -1, 1)
+
+def test_insert_beyond_end_of_file():
+    # GNU patch 2.7.6 appends the line, which ends the file
+    (patch,) = parse('--- a/f\n'
+                     '+++ b/f\n'
+                     '@@ -3,0 +4 @@\n'
+                     '+d\n'
+                     '\\ No newline at end of file\n')
+    (out, results) = patch.apply(['c\n'])
+    assert out == ['c\n', 'd']
+    assert results[0].line is not None
+
+def test_trailing_context_not_frozen():
+    # GNU patch 2.7.6: Hunk #2 succeeded at 5 with fuzz 2.
+    (patch,) = parse('--- a/f\n'
+                     '+++ b/f\n'
+                     '@@ -2,5 +2,5 @@\n'
+                     ' 2\n'
+                     '-3\n'
+                     '+x\n'
+                     ' 4\n'
+                     ' 5\n'
+                     ' 6\n'
+                     '@@ -5,3 +5,3 @@\n'
+                     ' 5\n'
+                     ' 6\n'
+                     '-7\n'
+                     '+y\n')
+    lines = ['%d\n' % i for i in range(1, 11)]
+    (out, results) = patch.apply(lines)
+    assert ''.join(out) == '1\n2\nx\n4\n5\n6\ny\n8\n9\n10\n'
+    assert [(result.line, result.fuzz) for result in results] == [(2, 0),
+                                                                  (5, 2)]
+
+def tree_files(root):
+    files = {}
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path) as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+def test_parallel_apply(tmp_path):
+    patches = []
+    for n in range(6):
+        patches.append('--- a/f%d\n+++ b/f%d\n@@ -1,2 +1,2 @@\n'
+                       ' a\n-b\n+b%d\n' % (n, n, n))
+    patches.append('diff --git a/old b/new\n'
+                   'similarity index 90%\n'
+                   'rename from old\n'
+                   'rename to new\n'
+                   '--- a/old\n+++ b/new\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n')
+    patches.append('--- a/f1\n+++ b/f1\n@@ -1,2 +1,2 @@\n a\n-b1\n+B1\n')
+    patches.append('--- a/new\n+++ b/new\n@@ -1,2 +1,2 @@\n-a\n+A\n c\n')
+    patches.append('--- /dev/null\n+++ b/added\n@@ -0,0 +1 @@\n+x\n')
+    patches.append('--- a/missing\n+++ b/missing\n@@ -1 +1 @@\n-a\n+b\n')
+    reader = patchutils.LineReader(''.join(patches).splitlines(True))
+    patchfile = patchutils.PatchFile(reader)
+    assert len(patchfile.patches) == 11
+    groups = sorted(patchfile.file_groups())
+    assert [1, 7] in groups and [6, 8] in groups
+    assert len(groups) == 9
+
+    trees = []
+    for workers in (None, 2):
+        root = tmp_path / ('tree%s' % (workers,))
+        root.mkdir()
+        for name in ['f%d' % (n,) for n in range(6)] + ['old']:
+            (root / name).write_text('a\nb\n')
+        results = patchfile.apply(str(root), workers=workers)
+        trees.append((tree_files(str(root)),
+                      [(result.number, result.name, result.error is None,
+                        [(hunk.line, hunk.offset, hunk.fuzz)
+                         for hunk in result.hunks])
+                       for result in results]))
+    assert trees[0] == trees[1]
+    (files, results) = trees[0]
+    assert files['f1'] == 'a\nB1\n'
+    assert files['new'] == 'A\nc\n' and 'old' not in files
+    assert files['added'] == 'x\n'
+    assert [result[0] for result in results] == list(range(11))
+    assert not results[10][2]
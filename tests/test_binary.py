@@ -0,0 +1,106 @@
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+# git diff --cached --binary of old_blob() changed to new_blob(), and
+# of a new file with NEW_FILE in it.
+TEXT = (
+    'diff --git a/blob.bin b/blob.bin\n'
+    'index 516c5ef795713b90f861c96bfcc793bf361e5415'
+    '..f8068bc7ff7c6b61809aaabd04b35099fcc91bd0 100644\n'
+    'GIT binary patch\n'
+    'delta 28\n'
+    'ccmdlXzDIn+3uZ0`IN1D&`4~G(Nn&OW0BhX`YXATM\n'
+    '\n'
+    'delta 23\n'
+    'fcmdlZzC(P&3udmKtADSxOo;p-v3>I==40#tkckW(\n'
+    '\n'
+    'diff --git a/new.bin b/new.bin\n'
+    'new file mode 100644\n'
+    'index 0000000000000000000000000000000000000000'
+    '..5040a666cea8883807b5cd86e0edbe57a079544c\n'
+    'GIT binary patch\n'
+    'literal 515\n'
+    'zcmZQzWMXDvWn<^y<l^Sx<>MC+6cQE@6%&_`l#-T_m6KOcR8m$^Ra4i{)Y8_`)zddH\n'
+    'zG%_|ZH8Z!cw6eCbwX=6{baHlab#wRd^z!!c_45x13<?ej4GWKmjEatljf+o6OiE5k\n'
+    'zO-s+n%*xKm&C4$+EGjN3Ei136tg5c5t*dWnY-(<4ZENr7?CS36?dzW~anj@|Q>RUz\n'
+    'zF>}`JIdkXDU$Ah|;w4L$Enl&6)#^2C*R9{Mant54TeofBv2)k%J$v`<KXCBS;Uh<n\n'
+    'z9Y1mM)af&4&z-+;@zUihSFc^aar4&gJ9qEhfAH|p<0ns_J%91?)$2EJ-@X6v@zduo\n'
+    'UU%!3-@$=X3KY#!IXBhQA0N|ki1ONa4\n'
+    '\n'
+    'literal 0\n'
+    'HcmV?d00001\n'
+    '\n'
+)
+
+def old_blob():
+    rng = random.Random(5)
+    return bytes(rng.getrandbits(8) for i in range(3000))
+
+def new_blob():
+    data = bytearray(old_blob())
+    data[1000:1010] = bytes(10)
+    return bytes(data + b'tail')
+
+NEW_FILE = bytes(range(256)) * 2 + bytes(range(3))
+
+def parse(text=TEXT):
+    reader = patchutils.LineReader(text.splitlines(True))
+    return patchutils.PatchFile(reader).patches
+
+def test_parse():
+    (delta, literal) = parse()
+    assert isinstance(delta, patchutils.GitBinaryPatch)
+    assert [(hunk.method, hunk.size, hunk.reverse)
+            for hunk in delta.hunks] == [('delta', 28, False),
+                                         ('delta', 23, True)]
+    assert [(hunk.method, hunk.size, hunk.reverse)
+            for hunk in literal.hunks] == [('literal', 515, False),
+                                           ('literal', 0, True)]
+    assert literal.header.old.name is None
+    assert literal.header.new.name == 'b/new.bin'
+
+def test_apply_delta():
+    (delta, literal) = parse()
+    (data, results) = delta.apply(old_blob())
+    assert bytes(data) == new_blob()
+    assert not results[0].failed
+    (data, results) = delta.reversed().apply(new_blob())
+    assert bytes(data) == old_blob()
+    assert not results[0].failed
+
+def test_apply_literal():
+    (delta, literal) = parse()
+    assert literal.hunks[0].data() == NEW_FILE
+    assert b''.join(literal.hunks[0].iter_data()) == NEW_FILE
+    (data, results) = literal.apply(b'')
+    assert bytes(data) == NEW_FILE
+    (data, results) = literal.reversed().apply(NEW_FILE)
+    assert bytes(data) == b''
+
+def test_delta_to_wrong_file():
+    (delta, literal) = parse()
+    (data, results) = delta.apply(old_blob()[1:])
+    assert data == old_blob()[1:]
+    assert results[0].failed
+
+def test_corrupt():
+    (delta, literal) = parse()
+    lines = literal.hunks[0].lines
+    # a character which is not base85, and a line of the wrong length
+    for bad in ('"' + lines[1][1:], lines[1][:-1]):
+        hunk = patchutils.GitBinaryHunk('literal', 515,
+                                        lines[:1] + [bad] + lines[2:])
+        with pytest.raises(ValueError):
+            hunk.data()
+    (delta, literal) = parse(TEXT.replace('literal 515', 'literal 514'))
+    with pytest.raises(ValueError, match='instead of 514'):
+        literal.hunks[0].data()
+    (data, results) = literal.apply(b'')
+    assert data == b''
+    assert results[0].failed
@@ -0,0 +1,42 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+PATCH = ('--- a/f\n'
+         '+++ b/f\n'
+         '@@ -1 +1 @@\n'
+         '-one\n'
+         '+two\n')
+
+def test_corrupt_entry_is_replaced(tmp_path):
+    path = tmp_path / 'p.diff'
+    path.write_text(PATCH)
+    cache = patchutils.PatchCache(str(tmp_path / 'cache'))
+    patchfile = cache.parse(str(path))
+    (entry,) = os.listdir(cache.directory)
+    entry = os.path.join(cache.directory, entry)
+    with open(entry, 'wb') as f:
+        # valid marshal data, but not an encoded PatchFile
+        f.write(cache.magic + b'N')
+    assert cache.get(os.path.basename(entry)[:-len(cache.suffix)]) is None
+    assert not os.path.exists(entry)
+    again = cache.parse(str(path))
+    assert repr(again.patches) == repr(patchfile.patches)
+    assert os.path.exists(entry)
+
+def test_cached_patches_are_unchanged(tmp_path):
+    path = tmp_path / 'p.diff'
+    path.write_text('text\n' + PATCH + PATCH.replace('f\n', 'g\n'))
+    cache = patchutils.PatchCache(str(tmp_path / 'cache'))
+    cache.parse(str(path))
+    patchfile = cache.parse(str(path))
+    assert patchfile.spans == [(1, 5), (6, 10)]
+    with open(str(path), 'rb') as f, patchutils.MmapReader(f) as reader:
+        assert all(patch.unchanged(reader) for patch in patchfile.patches)
+        del patchfile.patches[0]
+        out = io.BytesIO()
+        patchfile.write(out, reader)
+    assert out.getvalue() == ('text\n' + PATCH.replace('f\n', 'g\n')).encode()
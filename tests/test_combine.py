@@ -0,0 +1,159 @@
+import io
+import os
+import sys
+import random
+import difflib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+V0 = ['%d\n' % (n,) for n in range(1, 21)]
+
+def diff(a, b, name='f'):
+    """Parse the unified diff of a and b, like diff -u a/name b/name."""
+    text = ''.join(difflib.unified_diff(a, b, 'a/' + name, 'b/' + name))
+    reader = patchutils.LineReader(text.splitlines(True))
+    return patchutils.PatchFile(reader)
+
+def patch_of(text):
+    reader = patchutils.LineReader(text.splitlines(True))
+    return patchutils.PatchFile(reader)
+
+def write(patchfile):
+    out = io.StringIO()
+    patchfile.write(out)
+    return out.getvalue()
+
+def apply(patchfile, lines):
+    (patch,) = patchfile.patches
+    (out, results) = patch.apply(lines)
+    assert not any(result.failed for result in results)
+    return out
+
+def edit(lines, changes):
+    """Return lines with (index, old count, new lines) changes made,
+    at indexes of the original lines."""
+    lines = list(lines)
+    for (index, count, new) in sorted(changes, reverse=True):
+        lines[index:index + count] = new
+    return lines
+
+def test_combine_overlapping():
+    v1 = edit(V0, [(4, 2, ['five\n', 'six\n'])])
+    v2 = edit(v1, [(5, 1, ['SIX\n', 'seven\n'])])
+    combined = diff(V0, v1).combine(diff(v1, v2))
+    assert write(combined) == ('--- a/f\n'
+                               '+++ b/f\n'
+                               '@@ -2,8 +2,9 @@\n'
+                               ' 2\n'
+                               ' 3\n'
+                               ' 4\n'
+                               '-5\n'
+                               '-6\n'
+                               '+five\n'
+                               '+SIX\n'
+                               '+seven\n'
+                               ' 7\n'
+                               ' 8\n'
+                               ' 9\n')
+
+def test_combine_cancelling():
+    v1 = edit(V0, [(9, 1, ['ten\n'])])
+    combined = diff(V0, v1).combine(diff(v1, V0))
+    assert combined.patches[0].hunks == []
+
+def test_combine_adjacent():
+    # the changes touch in the intermediate version: one hunk
+    v1 = edit(V0, [(4, 1, ['five\n'])])
+    v2 = edit(v1, [(5, 1, ['six\n'])])
+    combined = diff(V0, v1).combine(diff(v1, v2))
+    (patch,) = combined.patches
+    assert len(patch.hunks) == 1
+    assert apply(combined, V0) == v2
+
+def test_combine_offset():
+    # lines inserted by the first patch move the second one's hunk
+    v1 = edit(V0, [(0, 0, ['a\n', 'b\n', 'c\n'])])
+    v2 = edit(v1, [(18, 1, ['sixteen\n'])])
+    combined = diff(V0, v1).combine(diff(v1, v2))
+    (patch,) = combined.patches
+    assert [(hunk.srcline, len(hunk.src), hunk.dstline, len(hunk.dst))
+            for hunk in patch.hunks] == [(1, 3, 1, 6), (13, 7, 16, 7)]
+    assert apply(combined, V0) == v2
+
+def test_combine_files_of_one_side():
+    v1 = edit(V0, [(2, 1, [])])
+    first = patch_of(write(diff(V0, v1, 'f')) + write(diff(V0, v1, 'g')))
+    second = patch_of(write(diff(v1, V0, 'g')) + write(diff(V0, v1, 'h')))
+    combined = first.combine(second)
+    assert [(patch.header.old.name, len(patch.hunks))
+            for patch in combined.patches] == [
+        ('a/f', 1), ('a/g', 0), ('a/h', 1)]
+
+def test_interdiff():
+    v1 = edit(V0, [(4, 1, ['five\n']), (10, 0, ['new\n'])])
+    v2 = edit(V0, [(4, 2, ['FIVE\n', 'six\n']), (10, 0, ['new\n']),
+                   (15, 1, [])])
+    interdiff = diff(V0, v1).interdiff(diff(V0, v2))
+    assert write(interdiff) == ('--- b/f\n'
+                                '+++ b/f\n'
+                                '@@ -2,8 +2,8 @@\n'
+                                ' 2\n'
+                                ' 3\n'
+                                ' 4\n'
+                                '-five\n'
+                                '-6\n'
+                                '+FIVE\n'
+                                '+six\n'
+                                ' 7\n'
+                                ' 8\n'
+                                ' 9\n'
+                                '@@ -14,7 +14,6 @@\n'
+                                ' 13\n'
+                                ' 14\n'
+                                ' 15\n'
+                                '-16\n'
+                                ' 17\n'
+                                ' 18\n'
+                                ' 19\n')
+
+def test_interdiff_same_patch():
+    v1 = edit(V0, [(4, 1, ['five\n'])])
+    assert diff(V0, v1).interdiff(diff(V0, v1)).patches == []
+
+def test_interdiff_files_of_one_side():
+    v1 = edit(V0, [(2, 1, [])])
+    v2 = edit(V0, [(2, 1, ['three\n'])])
+    first = patch_of(write(diff(V0, v1, 'f')) + write(diff(V0, v1, 'g')))
+    second = patch_of(write(diff(V0, v2, 'g')) + write(diff(V0, v2, 'h')))
+    interdiff = first.interdiff(second)
+    # f is reverted, g changed from v1 to v2, and h kept
+    assert [(patch.header.old.name, patch.header.new.name)
+            for patch in interdiff.patches] == [
+        ('b/f', 'a/f'), ('b/g', 'b/g'), ('a/h', 'b/h')]
+    (revert, change, keep) = interdiff.patches
+    assert revert.apply(v1)[0] == V0
+    assert change.apply(v1)[0] == v2
+    assert keep.apply(V0)[0] == v2
+
+def test_random_edits():
+    rng = random.Random(3)
+    def random_edit(lines):
+        changes = []
+        for index in sorted(rng.sample(range(len(lines)), 4)):
+            new = ['%d.%d\n' % (index, rng.randint(0, 99))
+                   for k in range(rng.randint(0, 3))]
+            changes.append((index, rng.randint(0, 1), new))
+        return edit(lines, changes)
+    for n in range(200):
+        v1 = random_edit(V0)
+        v2 = random_edit(v1)
+        v3 = random_edit(V0)
+        for context in (0, 1, 3):
+            combined = diff(V0, v1).combine(diff(v1, v2), context=context)
+            if combined.patches[0].hunks:
+                assert apply(combined, V0) == v2
+            interdiff = diff(V0, v1).interdiff(diff(V0, v3),
+                                               context=context)
+            if interdiff.patches:
+                assert apply(interdiff, v1) == v3
@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+TEXT = ('--- a/f\n'
+        '+++ b/f\n'
+        '@@ -1,3 +1,3 @@\n'
+        ' a\n'
+        '-b\n'
+        '+B\n'
+        ' c\n'
+        '@@ -20,3 +20,3 @@\n'
+        ' t\n'
+        '-u\n'
+        '+U\n'
+        ' v\n'
+        '@@ -40 +40 @@\n'
+        '-x\n'
+        '+X\n')
+
+def test_line_filter_uses_hunk_headers():
+    reader = patchutils.LineReader(TEXT.splitlines(True))
+    patchfile = patchutils.PatchFile(reader, headers_only=True)
+    (patch,) = patchfile.patches
+    patch_filter = patchutils.PatchFilter(lines='3,22')
+    selected = patch_filter.apply(patch, reader)
+    assert [hunk.srcline for hunk in selected.hunks] == [1, 20]
+    # the bodies are not loaded
+    assert all(not hunk.src and not hunk.dst for hunk in patch.hunks)
+    assert [hunk.src_count(reader) for hunk in patch.hunks] == [3, 3, 1]
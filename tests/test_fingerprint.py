@@ -0,0 +1,77 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+def parse(text, diff_type):
+    reader = patchutils.LineReader(text.splitlines(True))
+    return patchutils.PatchFile(reader, diff_type=diff_type).patches
+
+def test_normal_diff():
+    (patch,) = parse('2c2\n< b\n---\n> c\n', patchutils.NORMAL_DIFF)
+    (moved,) = parse('5c5\n< b\n---\n> c\n', patchutils.NORMAL_DIFF)
+    (other,) = parse('2c2\n< b\n---\n> d\n', patchutils.NORMAL_DIFF)
+    assert patch.fingerprint() == moved.fingerprint()
+    assert patch.fingerprint() != other.fingerprint()
+
+def test_ed_script():
+    (patch,) = parse('2c\nc\n.\n', patchutils.ED_DIFF)
+    (moved,) = parse('5c\nc\n.\n', patchutils.ED_DIFF)
+    assert patch.fingerprint() == moved.fingerprint()
+
+def test_fingerprint_files(tmp_path):
+    paths = []
+    for (name, text) in (('a.diff', '2c2\n< b\n---\n> c\n'),
+                         ('b.diff', '1d0\n< a\n7c7\n< b\n---\n> c\n')):
+        path = tmp_path / name
+        path.write_text(text)
+        paths.append(str(path))
+    (patch,) = parse('2c2\n< b\n---\n> c\n', patchutils.NORMAL_DIFF)
+    index = patchutils.fingerprint_files(paths, workers=1,
+                                         diff_type=patchutils.NORMAL_DIFF)
+    assert index[patch.fingerprint()] == [(paths[0], 0)]
+
+def test_pure_rename_matches_git():
+    text = ('diff --git a/a b/a2\n'
+            'similarity index 100%\n'
+            'rename from a\n'
+            'rename to a2\n'
+            'diff --git a/b b/b\n'
+            'index 422c2b7..55dce13 100644\n'
+            '--- a/b\n'
+            '+++ b/b\n'
+            '@@ -1,2 +1,2 @@\n'
+            ' a\n'
+            '-b\n'
+            '+B\n'
+            'diff --git a/c b/c\n'
+            'old mode 100644\n'
+            'new mode 100755\n')
+    reader = patchutils.LineReader(text.splitlines(True))
+    patchfile = patchutils.PatchFile(reader)
+    # recorded output of git patch-id --stable and --unstable
+    assert (patchfile.fingerprint(reader)
+            == 'd2e56158f007c5db682b16ade53ebbb15640df84')
+    assert (patchfile.fingerprint(reader, stable=False)
+            == '55b19243ec8c0b6444dc18c0ed059b7b79585aa0')
+
+def test_form_feed_and_vertical_tab_are_hashed():
+    # git patch-id strips only ' ', '\t', '\n' and '\r'.  (splitlines()
+    # would also split at '\f' and '\v'.)
+    text = ('diff --git a/f b/f\n'
+            'index 3386298..d41ade9 100644\n'
+            '--- a/f\n'
+            '+++ b/f\n'
+            '@@ -1,3 +1,3 @@\n'
+            '-a\fb\n'
+            '-x\vy\n'
+            '+ab\n'
+            '+xy\n'
+            ' keep\n')
+    reader = patchutils.LineReader(
+        [line + '\n' for line in text.split('\n')[:-1]])
+    patchfile = patchutils.PatchFile(reader)
+    # recorded output of git patch-id --stable
+    assert (patchfile.fingerprint(reader)
+            == 'e4975cd299e4b6363aac1f200da3104b1f842d2e')
@@ -0,0 +1,66 @@
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import patchutils
+import bench_parse
+
+def summary(patch):
+    return ((repr(patch), patch.begin, patch.end, patch.header.begin,
+             patch.header.end, patch.reader_state)
+            + tuple((hunk.begin, hunk.end) for hunk in patch.hunks))
+
+def write_corpus(tmp_path):
+    path = str(tmp_path / 'series.mbox')
+    with open(path, 'w', newline='') as f:
+        f.writelines(bench_parse.corpus_small_git(random.Random(1)))
+    return path
+
+def test_index_load_patch(tmp_path):
+    path = write_corpus(tmp_path)
+    with open(path, 'rb') as f, patchutils.MmapReader(f) as reader:
+        patches = patchutils.PatchFile(reader).patches
+    index = patchutils.PatchIndex.get(path)
+    assert os.path.exists(path + patchutils.PatchIndex.suffix)
+    index = patchutils.PatchIndex.load(path + patchutils.PatchIndex.suffix)
+    assert index.is_current(path, check_hash=True)
+    assert len(index.patches) == len(patches)
+    with open(path, 'rb') as f, index.reader(f) as reader:
+        for number in (0, 1, len(patches) // 2, len(patches) - 1):
+            patch = index.load_patch(reader, number)
+            assert summary(patch) == summary(patches[number])
+            assert index.hunks(number) == [[hunk.begin, hunk.end]
+                                           for hunk in patch.hunks]
+        name = patches[5].header.new.name
+        expected = [patch for patch in patches
+                    if name in (patch.header.old.name, patch.header.new.name)]
+        assert ([summary(patch) for patch in index.load_patches(reader, name)]
+                == [summary(patch) for patch in expected])
+
+def test_index_is_rebuilt_for_a_changed_file(tmp_path):
+    path = write_corpus(tmp_path)
+    index = patchutils.PatchIndex.get(path)
+    with open(path, 'a') as f:
+        f.write('--- a/appended\n+++ b/appended\n@@ -1 +1 @@\n-x\n+y\n')
+    assert not index.is_current(path)
+    rebuilt = patchutils.PatchIndex.get(path)
+    assert len(rebuilt.patches) == len(index.patches) + 1
+    assert rebuilt.find('b/appended') == [len(index.patches)]
+
+def test_index_detects_same_size_change(tmp_path):
+    path = write_corpus(tmp_path)
+    index = patchutils.PatchIndex.get(path)
+    st = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.seek(100)
+        byte = f.read(1)
+        f.seek(100)
+        f.write(b'X' if byte != b'X' else b'Y')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert index.is_current(path)
+    assert not index.is_current(path, check_hash=True)
+    rebuilt = patchutils.PatchIndex.get(path, check_hash=True)
+    assert rebuilt.digest != index.digest
@@ -0,0 +1,54 @@
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import patchutils
+import bench_parse
+
+def summary(patchfile):
+    result = [patchfile.header.lines]
+    for patch in patchfile.patches:
+        result.append((repr(patch), patch.begin, patch.end,
+                       patch.header.begin, patch.header.end,
+                       patch.reader_state))
+        result.extend((hunk.begin, hunk.end) for hunk in patch.hunks)
+    return result
+
+def test_parse_parallel_matches_serial(tmp_path, monkeypatch):
+    # the pool is not used on a single CPU
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    for (name, generate, diff_type) in bench_parse.CORPORA:
+        path = str(tmp_path / name)
+        with open(path, 'w', newline='') as f:
+            f.writelines(generate(random.Random(1)))
+        for compact in (False, True):
+            with open(path, 'rb') as f:
+                serial = patchutils.PatchFile(patchutils.MmapReader(f),
+                                              diff_type, compact=compact)
+            parallel = patchutils.parse_parallel(
+                path, workers=2, diff_type=diff_type, compact=compact,
+                chunk_size=1 << 14)
+            assert summary(parallel) == summary(serial), (name, compact)
+
+def test_parse_parallel_falls_back_to_serial(tmp_path, monkeypatch):
+    import concurrent.futures
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError('process pool started')
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', no_pool)
+    path = str(tmp_path / 'small.diff')
+    with open(path, 'w', newline='') as f:
+        f.writelines(bench_parse.CORPORA[0][1](random.Random(1)))
+    with open(path, 'rb') as f, patchutils.MmapReader(f) as reader:
+        serial = patchutils.PatchFile(reader)
+    assert reader.buf.closed
+    # small input
+    parallel = patchutils.parse_parallel(path, workers=4)
+    assert summary(parallel) == summary(serial)
+    # single CPU
+    monkeypatch.setattr(os, 'cpu_count', lambda: 1)
+    parallel = patchutils.parse_parallel(path, workers=4, chunk_size=1 << 10)
+    assert summary(parallel) == summary(serial)
@@ -0,0 +1,128 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+def parse(text, **kwargs):
+    reader = patchutils.LineReader(text.splitlines(True))
+    return patchutils.PatchFile(reader, **kwargs)
+
+def test_scan_does_not_parse_stamps():
+    text = ''.join(
+        '--- a/f%d\t2020-01-%02d 10:00:00.000000000 +0100\n'
+        '+++ b/f%d\t2020-02-%02d 10:00:00.000000000 +0100\n'
+        '@@ -1 +1 @@\n'
+        '-old\n'
+        '+new\n' % (n, n % 28 + 1, n, n % 28 + 1) for n in range(50))
+    patchutils.parse_timestr.cache_clear()
+    patchfile = parse(text)
+    assert len(patchfile.patches) == 50
+    assert patchutils.parse_timestr.cache_info().misses == 0
+    assert patchfile.patches[0].header.old.stamp is not None
+    assert patchutils.parse_timestr.cache_info().misses == 1
+
+def test_text_is_not_an_ed_script():
+    # Ed commands without an address only continue a hunk; they must
+    # not start a patch that yields no hunks and is then found again.
+    for (text, diff_type) in [
+            ('  a\n', patchutils.ANY_DIFF),
+            ('Some prose\n  a\nmore\n', patchutils.ANY_DIFF),
+            ('  d\n', patchutils.ANY_DIFF),
+            ('a\nx\n', patchutils.ED_DIFF),
+            ('s/.//\n', patchutils.ED_DIFF)]:
+        for stats in (None, patchutils.ParseStats()):
+            patchfile = parse(text, diff_type=diff_type, need_header=False,
+                              stats=stats)
+            assert patchfile.patches == []
+
+def test_ed_script_stops_at_stray_substitution():
+    patchfile = parse('5d\ns/.//\n', diff_type=patchutils.ED_DIFF,
+                      need_header=False)
+    assert len(patchfile.patches) == 1
+    [hunk] = patchfile.patches[0].hunks
+    assert (hunk.srcline, len(hunk.src), hunk.dst) == (5, 1, [])
+
+def test_ed_script():
+    text = '5,6c\nnew\n..\n.\ns/.//\na\nlast\n.\n2d\n0a\nfirst\n.\n'
+    patchfile = parse(text, need_header=False)
+    [patch] = patchfile.patches
+    assert isinstance(patch, patchutils.EdPatch)
+    assert [(h.srcline, len(h.src), [c.text for c in h.dst])
+            for h in patch.hunks] == [
+        (5, 2, ['new\n', '.\n', 'last\n']),
+        (2, 1, []),
+        (1, 0, ['first\n'])]
+    lines = ['%d\n' % n for n in range(1, 8)]
+    (out, results) = patch.apply(lines)
+    assert out == ['first\n', '1\n', '3\n', '4\n', 'new\n', '.\n', 'last\n',
+                   '7\n']
+    assert not any(result.failed for result in results)
+
+def test_iter_patches():
+    text = ''.join('--- a/f%d\n+++ b/f%d\n@@ -1 +1 @@\n-old\n+new\n' % (n, n)
+                   for n in range(100))
+    lines = text.splitlines(True)
+    expected = parse(text).patches
+    patchfile = patchutils.PatchFile()
+    patches = list(patchfile.iter_patches(patchutils.LineReader(lines)))
+    assert [repr(patch) for patch in patches] == [repr(patch)
+                                                  for patch in expected]
+    assert ([(patch.begin, patch.end) for patch in patches]
+            == [(patch.begin, patch.end) for patch in expected])
+    assert patchfile.patches == []
+
+    class CountingReader(patchutils.LineReader):
+        read = 0
+        def _get_line(self):
+            self.read = max(self.read, self.lineno + 1)
+            return patchutils.LineReader._get_line(self)
+        def _get_lines(self, count):
+            self.read = max(self.read, self.lineno + count)
+            return patchutils.LineReader._get_lines(self, count)
+    reader = CountingReader(lines)
+    it = patchutils.PatchFile().iter_patches(reader)
+    first = next(it)
+    assert first.header.old.name == 'a/f0'
+    second = next(it)
+    assert second.header.old.name == 'a/f1'
+    # the scan for a patch reads at most one line past it
+    assert 10 <= reader.read <= 11
+
+def test_load_hunk_with_reader_state():
+    for (indent, eol) in (('  ', '\n'), ('', '\r\n'), ('\t', '\r\n')):
+        text = ''.join(indent + line + eol for line in (
+            'Index: f', '--- a/f', '+++ b/f', '@@ -1,2 +1,2 @@',
+            ' a', '-b', '+c'))
+        (patch,) = parse(text, headers_only=True).patches
+        (hunk,) = patch.hunks
+        reader = patchutils.LineReader(text.splitlines(True))
+        assert hunk.load(reader, patch.reader_state)
+        assert [(op, c.text) for (op, c) in hunk.iter_changes()] == [
+            (' ', 'a\n'), ('-', 'b\n'), ('+', 'c\n')]
+        assert (reader.indent, reader.strip_cr) == (0, False)
+
+def test_compact_hunk_views():
+    text = ('--- a/f\n'
+            '+++ b/f\n'
+            '@@ -1,5 +1,5 @@ section\n'
+            ' a\n'
+            '-b\n'
+            '-c\n'
+            '+C\n'
+            ' d\n'
+            '+e\n'
+            ' f\n'
+            '\\ No newline at end of file\n')
+    (hunk,) = parse(text).patches[0].hunks
+    (compact,) = parse(text, compact=True).patches[0].hunks
+    assert isinstance(compact, patchutils.CompactUniHunk)
+    def ops(changes):
+        return [(change.op, change.text) for change in changes]
+    for side in ('src', 'dst'):
+        (expected, view) = (getattr(hunk, side), getattr(compact, side))
+        assert len(view) == len(expected)
+        assert ops(view) == ops(expected)
+        assert ops([view[k] for k in range(len(view))]) == ops(expected)
+        assert ops(view[-1:]) == ops(expected[-1:])
+        assert ops(view[1:3]) == ops(expected[1:3])
@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+def test_get_lines_stops_at_empty_line():
+    reader = patchutils.LineReader(['a\n', '# comment\n', 'b\n', '', 'c\n'])
+    assert reader.get_lines(5) == ['a\n', 'b\n']
+    # the empty line is consumed, as by get_line()
+    assert reader.get_pos() == 4
+    assert reader.get_lines(5) == ['c\n']
+
+def test_get_lines_matches_get_line():
+    lines = ['a\n', '', 'b', '#x', 'c\n']
+    for start in range(len(lines)):
+        reader = patchutils.LineReader(lines)
+        reader.set_pos(start)
+        expected = []
+        while reader.get_line():
+            expected.append(reader.line)
+        reader.set_pos(start)
+        assert reader.get_lines(len(lines)) == expected
+
+def test_mmap_get_heads_matches_get_lines():
+    text = b'a\n# c\n\r\nb\r\n-d\n+e\nf'
+    for strip_cr in (False, True):
+        for start in range(7):
+            for count in range(1, 8):
+                reader = patchutils.MmapReader(text)
+                reader.strip_cr = strip_cr
+                reader.set_pos(start)
+                heads = reader.get_heads(count)
+                if heads is None:
+                    continue
+                lines = [line for line in
+                         reader.get_raw_lines(start, reader.get_pos())
+                         if not line.startswith('#')]
+                reader.set_pos(start)
+                lines = reader.get_lines(len(lines))
+                assert heads == ''.join(line[:1] for line in lines)
+
+def test_headers_only_skips_bodies_like_parse():
+    text = (b'--- a/f\n'
+            b'+++ b/f\n'
+            b'@@ -1,3 +1,3 @@\n'
+            b' a\n'
+            b'# comment\n'
+            b'-b\n'
+            b'+B\n'
+            b' c\n'
+            b'@@ -10,2 +10,2 @@\n'
+            b' x\r\n'
+            b'-y\n'
+            b'\\ No newline at end of file\n'
+            b'+y\n'
+            b'--- a/g\n'
+            b'+++ b/g\n'
+            b'@@ -1 +1 @@\n'
+            b'-z\n'
+            b'+Z')
+    def spans(headers_only):
+        reader = patchutils.MmapReader(text)
+        patchfile = patchutils.PatchFile(reader, headers_only=headers_only)
+        return [(patch.begin, patch.end,
+                 [(hunk.begin, hunk.end) for hunk in patch.hunks])
+                for patch in patchfile.patches]
+    assert spans(True) == spans(False)
+    assert len(spans(True)) == 2
@@ -0,0 +1,127 @@
+import os
+import sys
+import stat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+OLD = ['%d\n' % (n,) for n in range(1, 13)]
+NEW = ['1\n', '2\n', 'three\n', '4\n', '5\n', '6\n', '7\n', '8\n',
+       '9\n', '10\n', 'eleven\n', 'new\n', '12\n']
+
+UNIFIED = ('--- a/f\n'
+           '+++ b/f\n'
+           '@@ -1,6 +1,6 @@\n'
+           ' 1\n'
+           ' 2\n'
+           '-3\n'
+           '+three\n'
+           ' 4\n'
+           ' 5\n'
+           ' 6\n'
+           '@@ -8,5 +8,6 @@\n'
+           ' 8\n'
+           ' 9\n'
+           ' 10\n'
+           '-11\n'
+           '+eleven\n'
+           '+new\n'
+           ' 12\n')
+
+CONTEXT = ('*** a/f\n'
+           '--- b/f\n'
+           '***************\n'
+           '*** 1,6 ****\n'
+           '  1\n'
+           '  2\n'
+           '! 3\n'
+           '  4\n'
+           '  5\n'
+           '  6\n'
+           '--- 1,6 ----\n'
+           '  1\n'
+           '  2\n'
+           '! three\n'
+           '  4\n'
+           '  5\n'
+           '  6\n'
+           '***************\n'
+           '*** 8,12 ****\n'
+           '  8\n'
+           '  9\n'
+           '  10\n'
+           '! 11\n'
+           '  12\n'
+           '--- 8,13 ----\n'
+           '  8\n'
+           '  9\n'
+           '  10\n'
+           '! eleven\n'
+           '! new\n'
+           '  12\n')
+
+RENAME = ('diff --git a/f b/g\n'
+          'old mode 100644\n'
+          'new mode 100755\n'
+          'similarity index 80%\n'
+          'rename from f\n'
+          'rename to g\n'
+          'index 1234567..89abcde\n'
+          '--- a/f\n'
+          '+++ b/g\n'
+          '@@ -1,2 +1,2 @@\n'
+          ' a\n'
+          '-b\n'
+          '+c\n')
+
+def parse(text, **kwargs):
+    reader = patchutils.LineReader(text.splitlines(True))
+    (patch,) = patchutils.PatchFile(reader, **kwargs).patches
+    return patch
+
+def write(patch):
+    return ''.join(patch.iter_lines())
+
+def check_reversed(patch, old, new):
+    reverse = patch.reversed()
+    assert write(reverse.reversed()) == write(patch)
+    (out, results) = patch.apply(old)
+    assert out == new
+    (out, results) = reverse.apply(new)
+    assert not any(result.failed for result in results)
+    assert out == old
+
+def test_reverse_unified():
+    for compact in (False, True):
+        patch = parse(UNIFIED, compact=compact)
+        assert (isinstance(patch.hunks[0], patchutils.CompactUniHunk)
+                == compact)
+        assert write(patch) == UNIFIED
+        check_reversed(patch, OLD, NEW)
+
+def test_reverse_context():
+    patch = parse(CONTEXT)
+    assert isinstance(patch.hunks[0], patchutils.ContextHunk)
+    check_reversed(patch, OLD, NEW)
+
+def test_reverse_rename_and_mode(tmp_path):
+    patch = parse(RENAME)
+    reverse = patch.reversed()
+    header = reverse.header
+    assert ((header.old.name, header.old.mode, header.old.rename)
+            == ('b/g', 0o100755, True))
+    assert ((header.new.name, header.new.mode, header.new.rename)
+            == ('a/f', 0o100644, True))
+    again = reverse.reversed()
+    assert write(again) == write(patch)
+
+    (tmp_path / 'f').write_text('a\nb\n')
+    os.chmod(str(tmp_path / 'f'), 0o644)
+    assert not patch.apply_tree(str(tmp_path)).failed
+    assert sorted(os.listdir(str(tmp_path))) == ['g']
+    assert (tmp_path / 'g').read_text() == 'a\nc\n'
+    assert stat.S_IMODE(os.stat(str(tmp_path / 'g')).st_mode) == 0o755
+    assert not reverse.apply_tree(str(tmp_path)).failed
+    assert sorted(os.listdir(str(tmp_path))) == ['f']
+    assert (tmp_path / 'f').read_text() == 'a\nb\n'
+    assert stat.S_IMODE(os.stat(str(tmp_path / 'f')).st_mode) == 0o644
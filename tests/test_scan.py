@@ -0,0 +1,317 @@
+"""Differential test of PatchFile.scan_patch().
+
+The header scanner dispatches on the first character of a line (see
+_scan_table()).  It is compared with reference_scan() below: the
+if/elif chain it replaced, from PatchFile.next_patch() in 14e9383,
+with the deliberate changes made since (marked in the code):
+
+- "deleted file mode" lines give the mode that follows them;
+- "new file mode" and "deleted file mode" set the other name to
+  /dev/null, and an index line without a mode keeps the modes;
+- ed commands need an address (see get_edcmd());
+- the header of a context diff ends before the '***************' line
+  of its first hunk, which begins there.
+
+Both scan the benchmark corpora and random soups of header-like lines
+with every diff type.  After an intended change to the scanner, make
+the same change to reference_scan().
+"""
+
+import os
+import re
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import patchutils
+import bench_parse
+from patchutils import (ANY_DIFF, CONTEXT_DIFF, NORMAL_DIFF, ED_DIFF,
+                        NEW_CONTEXT_DIFF, UNI_DIFF, Header, UniPatch,
+                        NormalPatch, EdPatch, ContextPatch, NewContextPatch,
+                        GitBinaryPatch, get_edcmd, fetchmode, parse_name,
+                        parse_c_name, re_cmd, re_gitindex)
+
+DIFF_TYPES = (ANY_DIFF, CONTEXT_DIFF, NORMAL_DIFF, ED_DIFF,
+              NEW_CONTEXT_DIFF, UNI_DIFF)
+
+def reference_scan(self, reader, need_header=True):
+    # The header scan of PatchFile.next_patch() in 14e9383, with the
+    # changes listed in the module docstring.  Returns (patch, start)
+    # like PatchFile.scan_patch(), or None.
+    # Ed and normal format patches don't have filename headers.
+    if self.diff_type in (ED_DIFF, NORMAL_DIFF):
+        need_header = False
+
+    edcmdpos = None
+    git_diff = False
+    exthdrs = False
+
+    reader.rfc934_nesting = 0
+    hdr = Header()
+    patch = None
+    while patch is None and reader.get_raw_line():
+        indent = reader.strip_indent()
+        line = reader.line
+        strip_cr = (line[-2:] == '\r\n')
+        if (self.diff_type in (ANY_DIFF, NORMAL_DIFF)
+            and not need_header
+            and re_cmd.match(line)):
+            reader.strip_cr = strip_cr
+
+            if not reader.get_raw_line():
+                break
+            indent = reader.strip_indent()
+            line = reader.line
+            if line.startswith('< ') or line.startswith('> '):
+                start = reader.get_pos(-2)
+                reader.indent = indent
+                patch = NormalPatch()
+        elif (self.diff_type in (ANY_DIFF, ED_DIFF)
+              and not need_header
+              and edcmdpos is None
+              and get_edcmd(line)):
+            edcmdpos = reader.get_pos(-1)
+            reader.indent = indent    # assume this for now
+            reader.strip_cr = strip_cr
+        elif (self.diff_type in (ANY_DIFF, CONTEXT_DIFF, NEW_CONTEXT_DIFF)
+              and line.startswith('*** ')):
+            hdr.begin = reader.get_pos(-1)
+            # Swap with OLD below.
+            hdr.new.set_spec(line[4:])
+            need_header = False
+        elif line.startswith('+++ '):
+            hdr.new.set_spec(line[4:])
+            reader.strip_cr = strip_cr
+            need_header = False
+        elif line.startswith('Index:'):
+            if hdr.begin is None:
+                hdr.begin = reader.get_pos(-1)
+            hdr.index = line[6:].lstrip()
+            if hdr.index.startswith('"'):
+                s = parse_c_name(hdr.index)
+                if s is not None:
+                    hdr.index = s
+            reader.strip_cr = strip_cr
+            need_header = False
+        elif line.startswith('Prereq:'):
+            if hdr.begin is None:
+                hdr.begin = reader.get_pos(-1)
+            revisions = line[7:].lstrip().split()
+            if len(revisions) > 0:
+                self.revision = revisions[0]
+        elif (self.diff_type in (ANY_DIFF, UNI_DIFF)
+              and line.startswith('diff --git ')):
+            if exthdrs:
+                hdr.end = reader.get_pos(-2)
+                start = reader.get_pos(-1)
+                # Patch contains no hunks; any diff type will do.
+                patch = UniPatch(hdr)
+            else:
+                hdr.begin = reader.get_pos(-1)
+                hdr.old.name = None
+                hdr.new.name = None
+                (old_name, s) = parse_name(line[11:])
+                if old_name is not None and len(s) > 0:
+                    (new_name, s) = parse_name(s.lstrip())
+                    if len(s) == 0 or s.isspace():
+                        hdr.old.name = old_name
+                        hdr.new.name = new_name
+                git_diff = True
+                need_header = False
+        elif git_diff and line.startswith('index '):
+            match = re_gitindex.match(line[6:])
+            if match:
+                mode = match.group(1)
+                if mode:                     # was: if mode is not None
+                    hdr.old.mode = hdr.new.mode = fetchmode(mode)
+                exthdrs = True
+        elif git_diff and line.startswith('old mode '):
+            hdr.old.mode = fetchmode(line[9:])
+            exthdrs = True
+        elif git_diff and line.startswith('new mode '):
+            hdr.new.mode = fetchmode(line[9:])
+            exthdrs = True
+        elif git_diff and line.startswith('deleted file mode '):
+            hdr.old.mode = fetchmode(line[18:])      # was line[9:]
+            hdr.new.set_name('/dev/null')            # new
+            exthdrs = True
+        elif git_diff and line.startswith('new file mode '):
+            hdr.new.mode = fetchmode(line[14:])
+            hdr.old.set_name('/dev/null')            # new
+            exthdrs = True
+        elif git_diff and line.startswith('rename from '):
+            hdr.old.rename = True
+            exthdrs = True
+        elif git_diff and line.startswith('rename to '):
+            hdr.new.rename = True
+            exthdrs = True
+        elif git_diff and line.startswith('copy from '):
+            hdr.old.copy = True
+            exthdrs = True
+        elif git_diff and line.startswith('copy to '):
+            hdr.new.copy = True
+            exthdrs = True
+        elif git_diff and line.startswith('GIT binary patch'):
+            hdr.end = reader.get_pos(-2)
+            start = reader.get_pos(-1)
+            patch = GitBinaryPatch(hdr)
+        else:
+            i = 0
+            while line.startswith('- ', i):
+                i += 2
+            if line.startswith('--- ', i):
+                if hdr.begin is None:
+                    hdr.begin = reader.get_pos(-1)
+                hdr.old.set_spec(line[i+4:])
+                if hdr.old.stamp is not None:
+                    reader.rfc934_nesting = i // 2
+                reader.strip_cr = strip_cr
+                need_header = False
+
+        if not need_header:
+            if edcmdpos is not None and line == '.\n':
+                start = edcmdpos
+                patch = EdPatch()
+            elif (self.diff_type in (ANY_DIFF, UNI_DIFF)
+                  and line.startswith('@@ -')):
+                reader.indent = indent
+                hdr.end = reader.get_pos(-2)
+                start = reader.get_pos(-1)
+                patch = UniPatch(hdr)
+            elif (self.diff_type in (ANY_DIFF, CONTEXT_DIFF, NEW_CONTEXT_DIFF)
+                  and line.startswith('********')):
+                previndent = indent
+                if not reader.get_raw_line():
+                    break
+                indent = reader.strip_indent()
+                line = reader.line
+                if (previndent == indent
+                    and line.startswith('*** ')):
+                    # 'new' and 'old' are backwards; swap them.
+                    t = hdr.old
+                    hdr.old = hdr.new
+                    hdr.new = t
+
+                    reader.indent = indent
+                    reader.strip_cr = strip_cr
+                    hdr.end = reader.get_pos(-3)     # was -2
+                    start = reader.get_pos(-2)       # was -1
+                    # if this is a new context diff the character
+                    # just before the newline is a '*'.
+                    if re.search(r'\*\r?\n$', line):
+                        patch = NewContextPatch(hdr)
+                    else:
+                        patch = ContextPatch(hdr)
+
+    if patch is None:
+        if edcmdpos is not None:
+            # nothing but deletes!?
+            start = edcmdpos
+            patch = EdPatch()
+        elif exthdrs:
+            hdr.end = reader.get_pos(-1)
+            start = reader.get_pos()
+            # Patch contains no hunks; any diff type will do.
+            patch = UniPatch(hdr)
+        else:
+            return None
+
+    return (patch, start)
+
+# Lines which some branch of the scanner looks at, and some which none
+# does.  Random sequences of these are scanned with every diff type.
+SOUP = [
+    'Some prose\n', '\n', 'a\n', 'd\n', 's/.//\n', '.\n', 'x\n',
+    '5d\n', '3,4d\n', '2a\n', '7c\n', '1,3c\n', '4i\n', '2,3a\n',
+    '1c1\n', '2,3d1\n', '0a1,2\n', '< old\n', '> new\n', '---\n',
+    '--- a/f\n', '--- a/f\t2020-01-02 10:00:00.000000000 +0100\n',
+    '- --- a/f\t2020-01-02 10:00:00.000000000 +0100\n',
+    '- - --- a/f\tThu Jan  2 10:00:00 2020\n',
+    '--- "a/q\\tf"\n', '+++ b/f\n', '+++ "b/q\\303\\251"\n',
+    '+++ b/f\t2020-01-02 10:00:01.000000000 +0100\n',
+    '*** a/f\t2020-01-02 10:00:00.000000000 +0100\n', '*** a/f\n',
+    '***************\n', '*** 1,3 ****\n', '*** 1,3 *****\n',
+    '--- 1,3 ----\n', '  ctx\n', '! chg\n',
+    '@@ -1 +1 @@\n', '@@ -1,2 +1,3 @@ func\n', '-x\n', '+y\n', ' z\n',
+    'diff --git a/f b/f\n', 'diff --git "a/q r" "b/q r"\n',
+    'diff --git a/f\n', 'index 1234567..89abcde 100644\n',
+    'index 1234567..89abcde\n', 'old mode 100644\n', 'new mode 100755\n',
+    'deleted file mode 100644\n', 'new file mode 100755\n',
+    'rename from f\n', 'rename to g\n', 'copy from f\n', 'copy to g\n',
+    'similarity index 90%\n', 'GIT binary patch\n', 'literal 0\n',
+    'Index: f\n', 'Index: "q\\tf"\n', 'Prereq: 1.2\n', 'Prereq:\n',
+]
+
+def soup(rng):
+    lines = []
+    for i in range(rng.randint(1, 16)):
+        line = rng.choice(SOUP)
+        r = rng.random()
+        if r < 0.1:
+            line = '  ' + line
+        elif r < 0.15:
+            line = '\t' + line
+        elif r < 0.25:
+            line = line[:-1] + '\r\n'
+        lines.append(line)
+    return lines
+
+def cases():
+    """Yield (name, lines, diff types) for all inputs."""
+    for (name, generate, diff_type) in bench_parse.CORPORA:
+        if name == 'giant-hunks':
+            continue    # large and nothing but hunk bodies
+        diff_types = sorted(set((diff_type, patchutils.ANY_DIFF)))
+        yield (name, generate(random.Random(1)), diff_types)
+    rng = random.Random(11)
+    for n in range(600):
+        yield ('soup-%d' % (n,), soup(rng), DIFF_TYPES)
+
+def info(fileinfo):
+    return (fileinfo.name, fileinfo.timestr, fileinfo.mode,
+            fileinfo.copy, fileinfo.rename)
+
+def walk(scan, lines, diff_type, need_header, stats=None):
+    """Scan from the start of the input and again from the line after
+    each place where a patch was found.  Returns what each scan found
+    and the reader state after it.
+    """
+    patchfile = patchutils.PatchFile(diff_type=diff_type, stats=stats)
+    reader = patchutils.LineReader(lines)
+    result = []
+    pos = 0
+    while True:
+        reader.set_pos(pos)
+        (reader.indent, reader.strip_cr) = (0, False)
+        patchfile.revision = None
+        found = scan(patchfile, reader, need_header)
+        state = (reader.get_pos(), reader.indent, reader.rfc934_nesting,
+                 reader.strip_cr, patchfile.revision)
+        if found is None:
+            result.append((None, state))
+            return result
+        (patch, start) = found
+        header = patch.header
+        result.append((type(patch).__name__, start, header.begin,
+                       header.end, info(header.old), info(header.new),
+                       header.index, state))
+        pos = start + 1
+
+def check(name, lines, diff_types, stats=None):
+    for diff_type in diff_types:
+        for need_header in (True, False):
+            expected = walk(reference_scan, lines, diff_type, need_header)
+            found = walk(patchutils.PatchFile.scan_patch, lines, diff_type,
+                         need_header, stats)
+            assert found == expected, (name, diff_type, need_header, lines)
+
+def test_scan_matches_reference():
+    for (name, lines, diff_types) in cases():
+        check(name, lines, diff_types)
+
+def test_scan_with_stats_matches_reference():
+    for (name, lines, diff_types) in cases():
+        if name.startswith('soup-'):
+            check(name, lines, diff_types, patchutils.ParseStats())
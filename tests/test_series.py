@@ -0,0 +1,81 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+def diff(old_name, new_name, old, new):
+    return ('--- %s\n+++ %s\n@@ -1 +1 @@\n-%s\n+%s\n'
+            % (old_name, new_name, old, new))
+
+def message(number, subject, patch):
+    return ('From 1234567890abcdef1234567890abcdef12345678 '
+            'Mon Sep 17 00:00:00 2001\n'
+            'From: A U Thor <author@example.com>\n'
+            'Subject: [PATCH %d] %s\n'
+            '\n'
+            'Commit message of %s.\n'
+            '---\n%s'
+            '-- \n2.20.1\n\n' % (number, subject, subject, patch))
+
+def test_from_quilt(tmp_path):
+    (tmp_path / 'patches').mkdir()
+    series = tmp_path / 'patches' / 'series'
+    series.write_text('# the series\n'
+                      'first.patch\n'
+                      '\n'
+                      'sub/second.patch -p0   # a comment\n'
+                      'third.patch -R -p2 --fuzz=3\n')
+    entries = list(patchutils.PatchSeries.from_quilt(str(series)))
+    assert [(entry.name, entry.path, entry.strip, entry.reverse)
+            for entry in entries] == [
+        ('first.patch', str(tmp_path / 'patches' / 'first.patch'), 1, False),
+        ('sub/second.patch',
+         str(tmp_path / 'patches' / 'sub' / 'second.patch'), 0, False),
+        ('third.patch', str(tmp_path / 'patches' / 'third.patch'), 2, True)]
+    entries = patchutils.PatchSeries.from_quilt(str(series), 'elsewhere')
+    assert entries.entries[0].path == os.path.join('elsewhere', 'first.patch')
+
+def test_from_mbox(tmp_path):
+    mbox = tmp_path / 'series.mbox'
+    texts = [message(1, 'Change f', diff('a/f', 'b/f', 'one', 'two')),
+             # a body line which looks like a From line, but has no date
+             message(2, 'Change g', 'From here on\n'
+                     + diff('a/g', 'b/g', 'x', 'y'))]
+    mbox.write_text(''.join(texts))
+    series = patchutils.PatchSeries.from_mbox(str(mbox))
+    assert len(series) == 2
+    assert [entry.name for entry in series] == ['[PATCH 1] Change f',
+                                                '[PATCH 2] Change g']
+    assert [entry.read().decode() for entry in series] == texts
+    for workers in (None, 2):
+        results = list(series.parse(workers))
+        assert [entry for (entry, patchfile) in results] == series.entries
+        assert [[(patch.header.old.name, patch.begin)
+                 for patch in patchfile.patches]
+                for (entry, patchfile) in results] == [[('a/f', 6)],
+                                                       [('a/g', 7)]]
+        assert results[1][1].header.lines[2] == 'Subject: [PATCH 2] Change g\n'
+
+def test_apply_series(tmp_path):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'f').write_text('one\n')
+    (tree / 'g').write_text('y\n')
+    patches = tmp_path / 'patches'
+    patches.mkdir()
+    (patches / 'a.patch').write_text(diff('a/f', 'b/f', 'one', 'two'))
+    (patches / 'b.patch').write_text(diff('f', 'f', 'two', 'three'))
+    (patches / 'c.patch').write_text(diff('x/y/g', 'x/y/g', 'x', 'y'))
+    (patches / 'series').write_text('a.patch\nb.patch -p0\nc.patch -p2 -R\n')
+    series = patchutils.PatchSeries.from_quilt(str(patches / 'series'))
+    for workers in (None, 2):
+        (tree / 'f').write_text('one\n')
+        (tree / 'g').write_text('y\n')
+        results = series.apply(str(tree), workers=workers)
+        assert [entry.name for (entry, result) in results] == [
+            'a.patch', 'b.patch', 'c.patch']
+        assert not any(result.failed for (entry, applied) in results
+                       for result in applied)
+        assert (tree / 'f').read_text() == 'three\n'
+        assert (tree / 'g').read_text() == 'x\n'
@@ -0,0 +1,67 @@
+import io
+import os
+import sys
+import random
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import patchutils
+import bench_parse
+
+def summary(patchfile):
+    return [(repr(patch), patch.begin, patch.end, patch.header.begin,
+             patch.header.end) for patch in patchfile.patches]
+
+def readers(text):
+    data = text.encode('utf-8')
+    yield patchutils.LineReader(text.splitlines(True))
+    yield patchutils.FileReader(io.TextIOWrapper(io.BytesIO(data),
+                                                 newline=''))
+    yield patchutils.MmapReader(data)
+
+def test_stats():
+    text = ''.join(bench_parse.corpus_small_git(random.Random(1))[:3000])
+    plain = patchutils.PatchFile(patchutils.LineReader(
+        text.splitlines(True)))
+    for reader in readers(text):
+        stats = patchutils.ParseStats()
+        patchfile = patchutils.PatchFile(reader, stats=stats)
+        assert summary(patchfile) == summary(plain)
+        assert reader.stats is None
+        assert 'set_pos' not in vars(reader)
+        assert stats.patches == len(plain.patches)
+        assert stats.hunks == sum(len(patch.hunks)
+                                  for patch in plain.patches)
+        assert stats.bytes == len(text.encode('utf-8'))
+        assert (stats.lines['header'] + stats.lines['hunks']
+                == len(text.splitlines()))
+        assert 0 < stats.backtracks <= stats.seeks
+        counters = stats.as_dict()
+        assert counters['patches'] == stats.patches
+        assert counters['lines.hunks'] == stats.lines['hunks']
+        assert set(counters) >= set('time.' + phase
+                                    for phase in stats.phases)
+
+def test_backtracks():
+    stats = patchutils.ParseStats()
+    stats.seek(10, 12)
+    stats.seek(12, 12)
+    stats.seek(12, 3)
+    assert (stats.seeks, stats.backtracks) == (3, 1)
+    total = patchutils.ParseStats()
+    total.merge(stats)
+    total.merge(stats)
+    assert (total.seeks, total.backtracks) == (6, 2)
+
+def test_stats_detached_after_error():
+    class FailingReader(patchutils.LineReader):
+        # hunk bodies are read in blocks
+        def _get_lines(self, count):
+            raise IOError('read error')
+    reader = FailingReader(['--- a/f\n', '+++ b/f\n', '@@ -1,2 +1,2 @@\n',
+                            ' a\n', '-b\n', '+c\n'])
+    with pytest.raises(IOError):
+        patchutils.PatchFile(reader, stats=patchutils.ParseStats())
+    assert reader.stats is None
@@ -0,0 +1,57 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+# Layouts of diff -u (with and without nanoseconds and zone) and diff -c.
+FAST = ['2020-01-02 10:00:00.000000000 +0100',
+        '2020-01-02 10:00:00.123456789 -0530',
+        '2019-12-31 23:59:59.5 +0000',
+        '2020-02-29 00:00:00 +1245',
+        '2020-01-02 10:00:00',
+        '1970-01-01 00:00:00.000000000 +0000',
+        'Thu Jan  2 10:00:00 2020',
+        'Mon Dec 31 23:59:59 2018',
+        'Sat Feb 29 12:30:05 2020']
+
+# Left to dateutil.
+OTHER = '2 Jan 2020 10:00:00 GMT'
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    patchutils.parse_timestr.cache_clear()
+    yield
+    patchutils.parse_timestr.cache_clear()
+
+def test_fast_paths_match_dateutil():
+    dateutil_parser = pytest.importorskip('dateutil.parser')
+    for timestr in FAST:
+        stamp = patchutils.parse_timestr(timestr)
+        expected = dateutil_parser.parse(timestr)
+        assert stamp == expected, timestr
+        assert stamp.utcoffset() == expected.utcoffset(), timestr
+
+def test_other_layouts_use_dateutil():
+    dateutil_parser = pytest.importorskip('dateutil.parser')
+    assert patchutils.parse_timestr(OTHER) == dateutil_parser.parse(OTHER)
+
+def test_invalid_dates():
+    # matched by the fast paths, but no such day
+    assert patchutils.parse_timestr('2019-02-29 10:00:00 +0100') is None
+    assert patchutils.parse_timestr('Fri Feb 29 10:00:00 2019') is None
+
+def test_cached():
+    first = patchutils.parse_timestr(FAST[0])
+    assert patchutils.parse_timestr(FAST[0]) is first
+    info = patchutils.parse_timestr.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+def test_without_dateutil(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'dateutil', None)
+    monkeypatch.setitem(sys.modules, 'dateutil.parser', None)
+    # the fast paths do not need dateutil; other layouts give None
+    for timestr in FAST:
+        assert patchutils.parse_timestr(timestr) is not None, timestr
+    assert patchutils.parse_timestr(OTHER) is None
@@ -0,0 +1,117 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patchutils
+
+TEXT = ('From: someone\n'
+        'Subject: two files\n'
+        '\n'
+        '--- a/f\n'
+        '+++ b/f\n'
+        '@@ -1,2 +1,2 @@\n'
+        ' a\n'
+        '-b\n'
+        '+c\n'
+        'text between\n'
+        '--- a/g\n'
+        '+++ b/g\n'
+        '@@ -1 +1 @@\n'
+        '-x\n'
+        '+y\n'
+        '-- \n'
+        'signature\n')
+
+def parse(text, **kwargs):
+    reader = patchutils.LineReader(text.splitlines(True))
+    return (reader, patchutils.PatchFile(reader, **kwargs))
+
+def write(patchfile, reader):
+    out = io.StringIO()
+    patchfile.write(out, reader)
+    return out.getvalue()
+
+def test_write_unchanged():
+    for headers_only in (False, True):
+        (reader, patchfile) = parse(TEXT, headers_only=headers_only)
+        assert len(patchfile.patches) == 2
+        assert write(patchfile, reader) == TEXT
+
+def test_write_changed_hunk():
+    (reader, patchfile) = parse(TEXT)
+    patchfile.patches[0].hunks[0].dst[1].text = 'd\n'
+    assert write(patchfile, reader) == TEXT.replace('+c\n', '+d\n')
+
+def test_write_removed_patch():
+    (reader, patchfile) = parse(TEXT)
+    del patchfile.patches[0]
+    assert write(patchfile, reader) == TEXT.replace(
+        '--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n', '')
+
+def test_write_loaded_patch_unchanged():
+    (reader, patchfile) = parse(TEXT, headers_only=True)
+    patchfile.patches[1].load(reader)
+    assert all(patch.unchanged(reader) for patch in patchfile.patches)
+    assert write(patchfile, reader) == TEXT
+
+def test_write_changed_header_and_hunk():
+    (reader, patchfile) = parse(TEXT)
+    patchfile.patches[1].header.new.name = 'b/h'
+    assert not patchfile.patches[1].unchanged(reader)
+    assert write(patchfile, reader) == TEXT.replace('+++ b/g', '+++ b/h')
+    (reader, patchfile) = parse(TEXT)
+    patchfile.patches[0].hunks[0].src[1].op = ' '
+    assert not patchfile.patches[0].unchanged(reader)
+    patchfile.patches[0].hunks[0].src[1].op = '-'
+    patchfile.patches[0].hunks[0].srcline = 5
+    assert not patchfile.patches[0].unchanged(reader)
+    assert write(patchfile, reader) == TEXT.replace('@@ -1,2', '@@ -5,2')
+
+CONTEXT = ('*** a/f\t2020-01-02 10:00:00.000000000 +0100\n'
+           '--- b/f\t2020-01-02 10:00:01.000000000 +0100\n'
+           '***************\n'
+           '*** 1,3 ****\n'
+           '  a\n'
+           '! b\n'
+           '  c\n'
+           '--- 1,3 ----\n'
+           '  a\n'
+           '! B\n'
+           '  c\n'
+           '***************\n'
+           '*** 9 ****\n'
+           '--- 9,10 ----\n'
+           '  x\n'
+           '+ y\n')
+
+def test_write_changed_context_hunk():
+    for number in (0, 1):
+        (reader, patchfile) = parse(CONTEXT)
+        (patch,) = patchfile.patches
+        assert isinstance(patch, patchutils.NewContextPatch)
+        patch.hunks[number].dst[1].text = 'z\n'
+        out = io.StringIO()
+        patch.write(out, reader)
+        expected = (CONTEXT.replace('! B\n', '! z\n') if number == 0
+                    else CONTEXT.replace('+ y\n', '+ z\n'))
+        assert out.getvalue() == expected
+
+def test_write_changed_context_patch_file():
+    text = ('Two context diffs\n'
+            + CONTEXT
+            + 'text between\n'
+            + CONTEXT.replace('a/f', 'a/g').replace('b/f', 'b/g')
+            + '-- \nsignature\n')
+    for headers_only in (False, True):
+        (reader, patchfile) = parse(text, headers_only=headers_only)
+        assert len(patchfile.patches) == 2
+        assert write(patchfile, reader) == text
+        patch = patchfile.patches[1]
+        patch.load(reader)
+        patch.hunks[0].dst[1].text = 'z\n'
+        (first, second) = text.rsplit('! B\n', 1)
+        assert write(patchfile, reader) == first + '! z\n' + second
+        # without the spans, the text between is found by scanning
+        patchfile.spans = None
+        assert write(patchfile, reader) == first + '! z\n' + second